@@ -5,4 +5,8 @@ python3.8 manage.py migrate
 python3.8 manage.py collectstatic --noinput
 python3.8 manage.py compress
 
-gunicorn hamlet.wsgi -b 0.0.0.0:8000 -w 2
+# Model arrays are memory-mapped (see hamlet.neural.loading), so workers
+# share them, but each worker builds its own autocomplete indexes and
+# similarity filters, and holds gensim's vocabulary; see docs/sysadmin.md
+# before adding workers.
+gunicorn hamlet.wsgi -b 0.0.0.0:8000 -w ${GUNICORN_WORKERS:-4}
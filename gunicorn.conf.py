@@ -0,0 +1,13 @@
+# gunicorn reads this file automatically when it is started from this
+# directory (as entrypoint.sh and the Procfile do).
+
+
+def post_worker_init(worker):
+    # Django doesn't load the neural net until something needs it, so that
+    # management commands don't have to wait for it. Load it as each worker
+    # starts, so that no visitor has to either. Likewise the autocomplete
+    # indexes.
+    from hamlet.neural.provider import warm_model
+    from hamlet.theses.ngrams import warm_ngrams
+    warm_model()
+    warm_ngrams()
@@ -0,0 +1,76 @@
+"""Pooling the citations of a set of similar theses.
+
+Several of the theses most like a document often cite the same works, and a
+work cited by many of them is more likely to matter than one cited by one.
+So rather than listing each thesis's citations in turn, we merge citations of
+the same work (as judged by citation_key) and rank works by how many of the
+theses cite them, then by how similar those theses are."""
+from collections import OrderedDict, namedtuple
+import re
+
+from .models import Citation
+
+# A work, as cited by one or more theses: citation is the fullest of the
+# citations of it, theses are the theses citing it (most similar first), and
+# score is the sum of their similarities.
+RankedCitation = namedtuple('RankedCitation', ['citation', 'theses', 'score'])
+
+_NOT_WORD = re.compile(r'[\W_]+')
+
+
+def _normalise(text):
+    return _NOT_WORD.sub(' ', text.lower()).strip()
+
+
+def citation_key(citation):
+    """A key which should be the same for citations of the same work.
+
+    Citations are extracted from OCRed text, so the same work is written
+    down in many slightly different ways; we go by the most reliable thing
+    we have for each: DOI, then ISBN, then title and year, then the whole
+    reference with punctuation, case and spacing ignored. A citation with
+    none of those can't be matched with any other, so is a work of its own."""
+    if citation.doi:
+        return 'doi:' + citation.doi.strip().lower()
+    if citation.isbn:
+        isbn = re.sub(r'[^0-9X]', '', citation.isbn.upper())
+        if isbn:
+            return 'isbn:' + isbn
+    title = _normalise(citation.title)
+    if title:
+        return 'title:{}:{}'.format(title, citation.year.strip())
+    ref = _normalise(citation.raw_ref)
+    if ref:
+        return 'ref:' + ref
+    return 'pk:{}'.format(citation.pk)
+
+
+def rank_citations(theses):
+    """Return RankedCitations for all of the citations of theses (which
+    should have score attributes, as RankedTheses do), best first. All of the
+    citations are fetched in one query."""
+    theses = list(theses)
+    by_pk = {thesis.pk: thesis for thesis in theses}
+    citations = Citation.objects.filter(thesis__in=list(by_pk)).order_by(
+        'thesis', 'pk')
+
+    works = OrderedDict()
+    for citation in citations:
+        thesis = by_pk[citation.thesis_id]
+        # Saves a query per citation if anything asks for citation.thesis.
+        citation.thesis = thesis
+        work = works.setdefault(citation_key(citation), [None, {}])
+        if work[0] is None or len(citation.raw_ref) > len(work[0].raw_ref):
+            work[0] = citation
+        work[1][thesis.pk] = thesis
+
+    ranked = []
+    for citation, citing in works.values():
+        citing = sorted(citing.values(),
+                        key=lambda thesis: -getattr(thesis, 'score', 0))
+        ranked.append(RankedCitation(
+            citation, citing,
+            sum(getattr(thesis, 'score', 0) for thesis in citing)))
+
+    ranked.sort(key=lambda work: (-len(work.theses), -work.score))
+    return ranked
@@ -1,10 +1,17 @@
 import os
 from unittest import skip
+from unittest.mock import patch
 
 from django.conf import settings
 from django.urls import reverse
 from django.test import Client, TestCase, override_settings
 
+from hamlet.theses.models import Thesis
+
+from .models import Citation
+from .ranking import citation_key, rank_citations
+from .views import LitReviewBuddyView
+
 
 @override_settings(COMPRESS_ENABLED=False)
 class ViewTests(TestCase):
@@ -57,3 +64,79 @@ class ViewTests(TestCase):
                 {"file": fp, "captcha_0": "sometext", "captcha_1": "PASSED"})
 
         assert citation in response.content.decode('utf-8')
+
+
+class RankingTests(TestCase):
+    fixtures = ['theses.json', 'departments.json', 'authors.json',
+                'contributions.json']
+
+    def setUp(self):
+        self.near = Thesis.objects.get(pk=60330)
+        self.near.score = 0.9
+        self.far = Thesis.objects.get(pk=43703)
+        self.far.score = 0.7
+
+    def test_citation_key(self):
+        assert (citation_key(Citation(doi=' 10.1000/ABC ')) ==
+                citation_key(Citation(doi='10.1000/abc', title='Other')))
+        assert (citation_key(Citation(isbn='0-306-40615-2')) ==
+                citation_key(Citation(isbn='0306406152')))
+        assert (citation_key(Citation(title='Power Sources, for devices.',
+                                      year='2002')) ==
+                citation_key(Citation(title='power sources for Devices',
+                                      year='2002')))
+        assert (citation_key(Citation(title='Power sources', year='2002')) !=
+                citation_key(Citation(title='Power sources', year='2003')))
+        assert (citation_key(Citation(raw_ref='Smith,  J. Fluids.')) ==
+                citation_key(Citation(raw_ref='smith j fluids')))
+        # Citations with nothing to go on are all different works.
+        assert (citation_key(Citation(pk=1, raw_ref='')) !=
+                citation_key(Citation(pk=2, raw_ref=' ... ')))
+
+    def test_rank_citations(self):
+        Citation.objects.create(thesis=self.far, raw_ref='Only far.')
+        Citation.objects.create(thesis=self.near, raw_ref='Only near.')
+        Citation.objects.create(thesis=self.near, raw_ref='Shared',
+                                doi='10.1/x')
+        Citation.objects.create(thesis=self.far, raw_ref='Shared, in full.',
+                                doi='10.1/X')
+
+        with self.assertNumQueries(1):
+            ranked = rank_citations([self.near, self.far])
+            for work in ranked:
+                [thesis.title for thesis in work.theses]
+
+        assert [str(work.citation) for work in ranked] == [
+            'Shared, in full.', 'Only near.', 'Only far.']
+        assert ranked[0].theses == [self.near, self.far]
+        assert abs(ranked[0].score - 1.6) < 1e-6
+
+
+@override_settings(COMPRESS_ENABLED=False)
+class PaginationTests(TestCase):
+    fixtures = ['theses.json', 'departments.json', 'authors.json',
+                'contributions.json']
+
+    def test_pages(self):
+        thesis = Thesis.objects.get(pk=43703)
+        for i in range(5):
+            Citation.objects.create(thesis=thesis,
+                                    raw_ref='Reference {}'.format(i))
+
+        url = reverse('citations:lit_review_buddy')
+        path = os.path.join(settings.BASE_DIR, 'hamlet/theses/fixtures',
+                            '1721.1-33360.txt')
+        with patch.object(LitReviewBuddyView, 'paginate_by', 2):
+            with open(path, 'rb') as fp:
+                response = self.client.post(url, {
+                    "file": fp, "captcha_0": "sometext",
+                    "captcha_1": "PASSED"})
+            assert response.context['total_suggestions'] == 5
+            assert 'We found 5 works' in response.content.decode('utf-8')
+            assert len(response.context['citations']) == 2
+
+            page_url = response.context['page_url']
+            response = self.client.get(page_url + '?page=3')
+            assert response.status_code == 200
+            assert ([str(work.citation) for work in
+                     response.context['citations']] == ['Reference 4'])
@@ -7,4 +7,6 @@ app_name = 'citations'
 urlpatterns = [
     path('lit_review_buddy/',
         views.LitReviewBuddyView.as_view(), name='lit_review_buddy'),
+    path('lit_review_buddy/<uuid:job_id>/',
+        views.LitReviewBuddyView.as_view(), name='lit_review_buddy'),
 ]
@@ -1,22 +1,40 @@
+from django.core.paginator import Paginator
 from django.shortcuts import render
-from django.views.generic.edit import FormView
+from django.urls import reverse
 
-from hamlet.common.document import factory
-from hamlet.common.forms import UploadFileForm
-from hamlet.common.inferred_vectors import get_similar_documents
+from hamlet.common import jobs
+from hamlet.common.views import UploadView
+from hamlet.theses.models import RankedTheses
 
+from .ranking import rank_citations
 
-class LitReviewBuddyView(FormView):
+
+class LitReviewBuddyView(UploadView):
     template_name = 'citations/lit_review_buddy.html'
-    form_class = UploadFileForm
+    result_url_name = 'citations:lit_review_buddy'
+    # Citations per page.
+    paginate_by = 50
+
+    def render_result(self, result):
+        simdocs = RankedTheses(result)
+        citations = rank_citations(simdocs)
+
+        page_url = None
+        if len(citations) > self.paginate_by:
+            # Later pages are fetched with GET, by which time the upload is
+            # gone; so they come from the result of its job (which, if it
+            # wasn't run as a job, we store as if it had been).
+            job_id = self.kwargs.get('job_id') or jobs.store(result)
+            page_url = reverse(self.result_url_name,
+                               kwargs={'job_id': job_id})
+
+        page = Paginator(citations, self.paginate_by).get_page(
+            self.request.GET.get('page'))
 
-    def form_valid(self, form):
         context = {}
-        doc = factory(self.request.FILES['file'])
-        simdocs = get_similar_documents(doc)
         context['suggestions'] = simdocs
-        context['total_suggestions'] = sum([
-            doc.citation_set.count() for doc in simdocs
-        ])
+        context['citations'] = page
+        context['page_url'] = page_url
+        context['total_suggestions'] = page.paginator.count
         return render(self.request, 'citations/lit_review_outcomes.html',
             context)
@@ -1,19 +1,40 @@
+import codecs
+from itertools import islice
+
 from chardet.universaldetector import UniversalDetector
+from django.conf import settings
 from django.core.exceptions import ValidationError
 import docx
 import magic
 
+from hamlet.neural.tokens import tokenize
+
+# Text files are read this many bytes at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Give up on encoding detection after this many bytes, and go with chardet's
+# best guess so far. (For plain ASCII it never becomes sure, since any number
+# of encodings agree on ASCII.)
+DETECTION_LIMIT = 64 * 1024
+
 
 def factory(fp):
     """Factory for creating a document object.
 
     A Document must implement a `words` property that consists of a list
-    of words in that document.
+    of words in that document, and an `iter_words()` method which yields
+    them one at a time. `tokens` are those words tokenised the way the
+    model's training text was (see hamlet.neural.tokens), which is what
+    inference wants, up to settings.HAMLET_UPLOAD_TOKEN_LIMIT of them. That
+    is more than inference reads, so that it can sample them from all over
+    the document (see hamlet.neural.inference.sample_tokens).
+    Only as much of the document is read as `tokens` needs.
 
     :param fp: `django.core.files.uploadedfile.UploadedFile`
     :return: document object
     """
     mimetype = magic.from_buffer(fp.read(8192), mime=True)
+    fp.seek(0)
     if mimetype in ["text/plain", "text/x-c"]:
         return TextDocument(fp)
     elif mimetype in ["application/vnd.openxmlformats-officedocument.wordprocessingml.document",
@@ -28,42 +49,105 @@ def factory(fp):
         raise ValidationError(f"Invalid document type: {mimetype}")
 
 
-class TextDocument:
-    """Document object for representing a text document."""
-    def __init__(self, doc):
-        self.doc = doc
-        self._words = []
-        self._encoding = ""
+def split_stream(texts):
+    """Yield the whitespace-separated words in a stream of text fragments, as
+    though the fragments had been joined up first."""
+    partial = ''
+    for text in texts:
+        text = partial + text
+        words = text.split()
+        # A word running off the end of this fragment may carry on into the
+        # next one.
+        partial = words.pop() if words and not text[-1].isspace() else ''
+        yield from words
+    if partial:
+        yield partial
+
+
+class BaseDocument:
+    _words = None
+    _tokens = None
+
+    def iter_words(self):
+        return self._iter_all_words()
 
     @property
     def words(self):
-        if not self._words:
-            for line in self.doc:
-                self._words.extend(line.decode(self.encoding).strip().split())
+        if self._words is None:
+            self._words = list(self.iter_words())
         return self._words
 
+    def iter_tokens(self):
+        # Tokens never span whitespace, so tokenising word by word gives the
+        # same result as tokenising the whole text, without holding it all.
+        tokens = (token for word in self.iter_words()
+                  for token in tokenize(word))
+        return islice(tokens, settings.HAMLET_UPLOAD_TOKEN_LIMIT)
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = list(self.iter_tokens())
+        return self._tokens
+
+
+class TextDocument(BaseDocument):
+    """Document object for representing a text document.
+
+    The file is read once, a chunk at a time: the first chunks are buffered
+    only until we know their encoding, and everything is decoded and split
+    into words as it's read."""
+    def __init__(self, doc):
+        self.doc = doc
+        self._encoding = ""
+
+    def _chunks(self):
+        # File.chunks() starts from the beginning of the file.
+        return self.doc.chunks(chunk_size=CHUNK_SIZE)
+
+    def _detect(self, chunks):
+        """Feed chunks to the detector until it is sure (or we've given it
+        enough). Returns the chunks it read."""
+        detector = UniversalDetector()
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            detector.feed(chunk)
+            if detector.done or size >= DETECTION_LIMIT:
+                break
+        detector.close()
+        self._encoding = detector.result['encoding'] or 'utf-8'
+        return buffered
+
+    def _iter_all_words(self):
+        chunks = self._chunks()
+        buffered = self._detect(chunks)
+        decoder = codecs.getincrementaldecoder(self.encoding)(
+            errors='replace')
+
+        def texts():
+            for chunk in buffered:
+                yield decoder.decode(chunk)
+            for chunk in chunks:
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+
+        return split_stream(texts())
+
     @property
     def encoding(self):
         if not self._encoding:
-            detector = UniversalDetector()
-            for line in self.doc:
-                detector.feed(line)
-                if detector.done:
-                    break
-            detector.close()
-            self._encoding = detector.result['encoding']
+            self._detect(self._chunks())
         return self._encoding
 
 
-class DocxDocument:
+class DocxDocument(BaseDocument):
     """Document object for representing a DOCX document."""
     def __init__(self, doc):
-        self._words = []
         self.doc = docx.Document(doc)
 
-    @property
-    def words(self):
-        if not self._words:
-            for p in self.doc.paragraphs:
-                self._words.extend(p.text.strip().split())
-        return self._words
+    def _iter_all_words(self):
+        for p in self.doc.paragraphs:
+            yield from p.text.split()
@@ -5,6 +5,9 @@ from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
 from django.utils.deconstruct import deconstructible
 
+from hamlet.theses.filters import get_partitions
+from hamlet.theses.models import Department
+
 
 # By analogy with django.core.validators.FileExtensionValidator source.
 @deconstructible
@@ -37,7 +40,39 @@ class FileSizeValidator:
                  'allowed_size': round(self.max_size / 1024)})
 
 
-class UploadFileForm(forms.Form):
+def degree_choices():
+    """The degrees of the theses we can suggest. They come from the
+    Partitions, which already hold them, so building a form doesn't query
+    the database."""
+    return [('', 'Any degree')] + [
+        (degree, degree) for degree in sorted(get_partitions().degrees)
+        if degree]
+
+
+class SimilarityFilterForm(forms.Form):
+    """Optional restrictions on which theses to suggest; see
+    hamlet.theses.filters."""
+    department = forms.ModelChoiceField(
+        queryset=Department.objects.all(), required=False,
+        empty_label='Any department')
+    year_from = forms.IntegerField(required=False, label='From year')
+    year_to = forms.IntegerField(required=False, label='To year')
+    # Callable choices are only looked up when they're needed.
+    degree = forms.ChoiceField(required=False, choices=degree_choices)
+
+    def get_subset(self):
+        """Return the hamlet.neural.index.Subset of theses these filters
+        allow, or None if they allow everything. The form must be valid."""
+        data = self.cleaned_data
+        department = data.get('department')
+        return get_partitions().subset(
+            department=department.pk if department else None,
+            year_from=data.get('year_from'),
+            year_to=data.get('year_to'),
+            degree=data.get('degree'))
+
+
+class DocumentUploadForm(forms.Form):
     allowed_extensions = ['txt', 'docx']
     allowed_mimetypes = ['text/plain',
         'application/vnd.openxmlformats-officedocument.wordprocessingml.document']  # noqa
@@ -50,3 +85,11 @@ class UploadFileForm(forms.Form):
         widget=forms.ClearableFileInput(attrs={'class': 'field field-upload'}),
         help_text='.txt or .docx only.')
     captcha = CaptchaField(help_text='Sorry, no spammers.')
+
+    def get_subset(self):
+        # No filters, so consider every thesis.
+        return None
+
+
+class UploadFileForm(SimilarityFilterForm, DocumentUploadForm):
+    """An upload, and which theses to suggest for it."""
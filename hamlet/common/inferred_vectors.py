@@ -1,24 +1,104 @@
+import hashlib
+import logging
+
 from django.conf import settings
+from django.core.cache import caches
 
-from hamlet.theses.models import Thesis
+from hamlet.common.metrics import timer
+from hamlet.neural.index import get_index
+from hamlet.neural.inference import infer_within_budget, readable_tokens
+from hamlet.neural.provider import get_model
+from hamlet.theses.models import RankedTheses
 
+logger = logging.getLogger(__name__)
 
-def get_similar_documents(doc):
-    # Only return documents above this similarity threshold. (When similarity
-    # gets too low, it becomes meaningless. "Too low" is an art, not a
-    # science.)
-    threshold = 0.65
 
-    vector = settings.NEURAL_NET.infer_vector(doc.words)
+def _cache_key(fingerprint, words):
+    """Key uploads by their text and the model that read them.
+
+    Hashing the token stream (rather than the file) means that the same text
+    matches whether it arrives as .txt or .docx, and whatever its whitespace
+    or encoding. The fingerprint means a new model never serves vectors
+    inferred by an old one."""
+    digest = hashlib.sha1()
+    for word in words:
+        digest.update(word.encode('utf-8'))
+        digest.update(b'\0')
+    return 'inferred:{}:{}'.format(fingerprint, digest.hexdigest())
+
+
+# Only return documents above this similarity threshold. (When similarity gets
+# too low, it becomes meaningless. "Too low" is an art, not a science.)
+THRESHOLD = 0.65
+
+
+def _inferred(words):
+    """Return {'vector': the inferred vector for a document with the given
+    words, 'neighbours': [(identifier, similarity)] for the theses most
+    similar to it}."""
+    index = get_index()
+
+    # Inference is by far the most expensive thing we do, and people often
+    # upload the same draft more than once (or to both tools), so remember
+    # what we found.
+    cache = caches[settings.HAMLET_INFERENCE_CACHE]
+    key = None
+    if index.fingerprint is not None:
+        key = _cache_key(index.fingerprint, words)
+    result = cache.get(key) if key else None
+
+    if result is None:
+        model = get_model()
+        with timer('inference'):
+            vector, plan = infer_within_budget(model, words)
+        if (plan.tokens < readable_tokens(plan.total) or
+                plan.epochs < model.epochs):
+            logger.info('Inferred a vector from %s of %s tokens in %s epochs '
+                        'to stay within the time budget',
+                        plan.tokens, plan.total, plan.epochs)
 
-    # Find the most similar docvecs to this inferred vector.
-    doclist = settings.NEURAL_NET.docvecs.most_similar([vector])
+        # Find the most similar docvecs to this inferred vector.
+        with timer('similarity'):
+            doclist = index.most_similar_to_vector(vector)
 
-    # Limit to the documents above our similarity threshold. This gives a
-    # list of document filenames.
-    simdocs = [doc[0] for doc in doclist if doc[1] >= threshold]
+        result = {
+            'vector': vector,
+            # Limit to the documents above our similarity threshold.
+            'neighbours': [doc for doc in doclist if doc[1] >= THRESHOLD],
+        }
+        if key:
+            cache.set(key, result)
 
-    # Turn filenames into document identifiers so we can feed them to SQL.
-    ids = [s.replace('1721.1-', '').replace('.txt', '') for s in simdocs]
+    return result
 
-    return Thesis.objects.filter(identifier__in=ids)
+
+def get_inferred_vector(words):
+    """Return the vector the model infers for a document with the given
+    words (cached, like everything else here)."""
+    return _inferred(words)['vector']
+
+
+def get_neighbours(words, subset=None):
+    """Return [(identifier, similarity)] for the theses most similar to a
+    document with the given words, most similar first, optionally only
+    considering those in subset (see hamlet.theses.filters). This doesn't
+    touch the database, so it is safe to run in a background job."""
+    result = _inferred(words)
+    if subset is None:
+        return result['neighbours']
+
+    # A filtered search can reuse the vector, which is the expensive part.
+    with timer('similarity'):
+        doclist = get_index().most_similar_to_vector(result['vector'],
+                                                     subset=subset)
+    return [doc for doc in doclist if doc[1] >= THRESHOLD]
+
+
+def get_similar_identifiers(words, subset=None):
+    """Like get_neighbours, but just the identifiers."""
+    return [doc[0] for doc in get_neighbours(words, subset)]
+
+
+def get_similar_documents(doc):
+    """Return the RankedTheses most similar to a hamlet.common.document."""
+    return RankedTheses(get_neighbours(doc.tokens))
@@ -0,0 +1,117 @@
+"""A small background queue for slow work on uploaded documents.
+
+Inferring a vector for an upload takes long enough that doing it inside the
+request ties up a worker, and under gevent it stalls every other request that
+worker is serving too. Instead, views can submit() the work here, send the
+user to a page that polls for the job's status, and show the result once it's
+done.
+
+Jobs run on a pool of settings.HAMLET_UPLOAD_WORKERS threads in each server
+process. At most settings.HAMLET_UPLOAD_QUEUE_SIZE jobs may be queued or
+running in a process at once; beyond that, submit() raises QueueFull and the
+view should ask the user to try again, rather than letting a burst of uploads
+pile up behind each other. Job status lives in the settings.HAMLET_JOB_CACHE
+cache, which must be shared between server processes, since the request that
+polls for a job is not necessarily served by the process that runs it."""
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from hamlet.common.threads import gevent_threads
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+_executor = None
+_queued = 0
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if gevent_threads():
+            # gevent's pool runs jobs on real OS threads, so they don't
+            # block the hub that every other request in this process is
+            # waiting on.
+            from gevent.threadpool import ThreadPoolExecutor
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.HAMLET_UPLOAD_WORKERS)
+    return _executor
+
+
+def _cache():
+    return caches[settings.HAMLET_JOB_CACHE]
+
+
+def _key(job_id):
+    return 'job:{}'.format(job_id)
+
+
+def _run(job_id, func, args):
+    global _queued
+    try:
+        result = func(*args)
+    except Exception:
+        logger.exception('Job %s failed', job_id)
+        _cache().set(_key(job_id), {'status': FAILED})
+    else:
+        _cache().set(_key(job_id), {'status': DONE, 'result': result})
+    finally:
+        # Jobs may query the database, and each pool thread gets its own
+        # connection, which nothing else will close.
+        connection.close()
+        with _lock:
+            _queued -= 1
+
+
+def submit(func, *args):
+    """Run func(*args) in the background and return a job id for get_job().
+
+    The result of func must be something the job cache can store. Raises
+    QueueFull if this process already has as many jobs as it will take."""
+    global _queued
+    with _lock:
+        if _queued >= settings.HAMLET_UPLOAD_QUEUE_SIZE:
+            raise QueueFull
+        _queued += 1
+
+    job_id = str(uuid.uuid4())
+    try:
+        _cache().set(_key(job_id), {'status': PENDING})
+        _get_executor().submit(_run, job_id, func, args)
+    except Exception:
+        with _lock:
+            _queued -= 1
+        raise
+    return job_id
+
+
+def store(result):
+    """Record a result worked out in the request as a finished job, so that
+    later requests (for another page of it, say) can get it back. Returns the
+    job id."""
+    job_id = str(uuid.uuid4())
+    _cache().set(_key(job_id), {'status': DONE, 'result': result})
+    return job_id
+
+
+def get_job(job_id):
+    """Return a dict with the 'status' of the job (PENDING, DONE or FAILED)
+    and, if it's DONE, its 'result'; or None if there is no such job (or it
+    finished long enough ago to have been forgotten)."""
+    return _cache().get(_key(job_id))
@@ -0,0 +1,157 @@
+"""Where does the time go?
+
+Wrap anything expensive in `with timer('name'):`. The time is added to
+
+* the current request, if there is one: TimingMiddleware reports each
+  request's timers, along with its SQL time and query count, in a
+  Server-Timing header, which browsers show in their developer tools; and
+* running totals for this server process, which metrics_view serves in the
+  Prometheus text format, along with request counts and times for each view.
+
+Totals are per process (every metric carries a pid label), so a scrape only
+sees the worker that answered it; that's fine for seeing proportions and
+trends, which is what this is for. They are only served to the addresses in
+settings.HAMLET_METRICS_ALLOWED_IPS, or with settings.HAMLET_METRICS_TOKEN."""
+import hmac
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+_local = threading.local()
+_lock = threading.Lock()
+
+# name -> [calls, seconds]
+_timers = defaultdict(lambda: [0, 0.0])
+# view name -> [requests, seconds, SQL queries]
+_views = defaultdict(lambda: [0, 0.0, 0])
+
+
+def _record(name, elapsed):
+    with _lock:
+        totals = _timers[name]
+        totals[0] += 1
+        totals[1] += elapsed
+
+    request_timers = getattr(_local, 'timers', None)
+    if request_timers is not None:
+        request_timers[name] += elapsed
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+class TimingMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def _count_query(self, execute, sql, params, many, context):
+        _local.queries += 1
+        with timer('sql'):
+            return execute(sql, params, many, context)
+
+    def __call__(self, request):
+        _local.timers = defaultdict(float)
+        _local.queries = 0
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._count_query):
+                response = self.get_response(request)
+                # Render now, so that template time (and any queries the
+                # templates make) count towards this request.
+                if hasattr(response, 'render') and callable(response.render):
+                    response.render()
+            elapsed = time.perf_counter() - start
+            timers, queries = _local.timers, _local.queries
+        finally:
+            _local.timers = None
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unknown'
+        with _lock:
+            totals = _views[view]
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += queries
+
+        entries = ['{};dur={:.1f}'.format(name, seconds * 1000)
+                   for name, seconds in sorted(timers.items())]
+        entries.append('queries;desc="{} SQL queries"'.format(queries))
+        entries.append('total;dur={:.1f}'.format(elapsed * 1000))
+        response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+def _line(name, labels, value):
+    labels = dict(labels, pid=os.getpid())
+    label_text = ','.join('{}="{}"'.format(key, str(value).replace('"', ''))
+                          for key, value in sorted(labels.items()))
+    return '{}{{{}}} {}'.format(name, label_text, value)
+
+
+def _may_see_metrics(request):
+    token = settings.HAMLET_METRICS_TOKEN
+    if token:
+        expected = 'Bearer {}'.format(token).encode('utf-8')
+        given = request.META.get('HTTP_AUTHORIZATION', '').encode('utf-8')
+        if hmac.compare_digest(given, expected):
+            return True
+    return (request.META.get('REMOTE_ADDR') in
+            settings.HAMLET_METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """Serve this process's totals in the Prometheus text format, to those
+    allowed to see them; to anyone else, there's nothing here."""
+    if not _may_see_metrics(request):
+        raise Http404
+    with _lock:
+        timers = {name: list(totals) for name, totals in _timers.items()}
+        views = {name: list(totals) for name, totals in _views.items()}
+
+    lines = [
+        '# HELP hamlet_requests_total Requests served, by view.',
+        '# TYPE hamlet_requests_total counter',
+    ]
+    lines += [_line('hamlet_requests_total', {'view': view}, totals[0])
+              for view, totals in sorted(views.items())]
+    lines += [
+        '# HELP hamlet_request_seconds_total Time spent serving requests, '
+        'by view.',
+        '# TYPE hamlet_request_seconds_total counter',
+    ]
+    lines += [_line('hamlet_request_seconds_total', {'view': view},
+                    totals[1]) for view, totals in sorted(views.items())]
+    lines += [
+        '# HELP hamlet_sql_queries_total SQL queries made, by view.',
+        '# TYPE hamlet_sql_queries_total counter',
+    ]
+    lines += [_line('hamlet_sql_queries_total', {'view': view}, totals[2])
+              for view, totals in sorted(views.items())]
+    lines += [
+        '# HELP hamlet_timer_calls_total Times each timed operation ran.',
+        '# TYPE hamlet_timer_calls_total counter',
+    ]
+    lines += [_line('hamlet_timer_calls_total', {'timer': name}, totals[0])
+              for name, totals in sorted(timers.items())]
+    lines += [
+        '# HELP hamlet_timer_seconds_total Time spent in each timed '
+        'operation.',
+        '# TYPE hamlet_timer_seconds_total counter',
+    ]
+    lines += [_line('hamlet_timer_seconds_total', {'timer': name}, totals[1])
+              for name, totals in sorted(timers.items())]
+
+    return HttpResponse('\n'.join(lines) + '\n',
+                        content_type='text/plain; version=0.0.4')
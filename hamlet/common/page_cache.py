@@ -0,0 +1,329 @@
+"""Caching whole pages, and fragments of them, between processes.
+
+A similar_to page is the same for everyone until either the model or the
+metadata it shows changes, so there is no need for every server process to
+build it afresh. Pages and fragments go in settings.HAMLET_PAGE_CACHE, which
+should be a cache every process can see (file-based, as it is by default, or
+memcached or the like on a multi-machine deployment), under keys including a
+version made of the fingerprint of the served model and a revision.
+
+Revisions are times, in milliseconds since the epoch, kept in the cache. Each
+thesis and person has its own, bumped (see hamlet.theses.signals) whenever it
+changes or anything shown with it does: a thesis's revision changes with its
+authors, advisors and departments, for instance. A page's revision is the
+latest of those of the theses and people it shows, as reported by the view
+(see CachedPageMixin.get_page_revisions), so editing one thesis only changes
+the pages that show it. There is also a global revision, which every
+revision is at least: bump_metadata_revision() invalidates everything, for
+changes we don't track one by one, and for ingests, which would otherwise
+bump a revision for every row (see batched_revisions()).
+
+CachedPageMixin caches whole pages, and answers conditional requests for them
+with 304s when nothing has changed. For fragments, the page_cache context
+processor provides page_cache and page_version (the version of everything)
+to templates, for use with the cache tag; RankedTheses.page_version is the
+narrower version for a list of suggestions:
+
+    {% load cache %}
+    {% cache None name suggestions.page_version more_keys using=page_cache %}
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, urlencode
+from django.utils.functional import lazy
+
+from hamlet.neural.index import get_index
+from hamlet.neural.provider import get_served
+
+REVISION_KEY = 'metadata-revision'
+# When anything at all last changed.
+LATEST_KEY = 'metadata-latest'
+# Bumped when any thesis changes in a way that might change which theses the
+# similarity filters pick out (see hamlet.theses.filters).
+FILTERS_REVISION = 'revision:filters'
+# Bumped when the degrees SimilarityFilterForm offers might have changed.
+DEGREES_REVISION = 'revision:degrees'
+# Bumped when anyone's contributions change, which may move the centroids of
+# authors built from the database (see hamlet.theses.centroids).
+CONTRIBUTIONS_REVISION = 'revision:contributions'
+
+_batch = threading.local()
+
+
+def get_page_cache():
+    return caches[settings.HAMLET_PAGE_CACHE]
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def thesis_revision(identifier):
+    """The revision key for the thesis with the given identifier."""
+    return 'revision:thesis:{}'.format(identifier)
+
+
+def person_revision(pk):
+    return 'revision:person:{}'.format(pk)
+
+
+def _cached_revision(key, default):
+    cache = get_page_cache()
+    revision = cache.get(key)
+    if revision is None:
+        # Either nothing has changed since the cache was emptied or
+        # something has and the revision has been evicted; we can't tell, so
+        # assume it just changed. That also makes sure the pages cached under
+        # an earlier revision aren't brought back.
+        cache.add(key, default, timeout=None)
+        revision = cache.get(key)
+    return revision
+
+
+def metadata_revision():
+    """The global revision: the time, in milliseconds since the epoch, that
+    everything was last invalidated (or at least a time since then)."""
+    return _cached_revision(REVISION_KEY, _now())
+
+
+def latest_revision():
+    """The time anything at all last changed (or at least a time since
+    then)."""
+    return max(metadata_revision(), _cached_revision(LATEST_KEY, _now()))
+
+
+def page_revision(keys=None):
+    """The latest revision of the given revision keys (see
+    thesis_revision()), or if keys is None, of anything."""
+    if keys is None:
+        return latest_revision()
+    cache = get_page_cache()
+    revisions = cache.get_many(keys) if keys else {}
+    missing = [key for key in keys if key not in revisions]
+    if missing:
+        # Most keys have never been bumped, but some may have been evicted:
+        # as in _cached_revision(), assume they just changed, but not so
+        # recently as to be later than the latest revision.
+        latest = latest_revision()
+        for key in missing:
+            revisions[key] = _cached_revision(key, latest)
+    return max([metadata_revision()] + list(revisions.values()))
+
+
+def _batching():
+    if getattr(_batch, 'depth', 0):
+        _batch.changed = True
+        return True
+    return False
+
+
+def bump_metadata_revision():
+    """Invalidate every cached page and fragment. (Two processes bumping at
+    once might agree on the same new revision, but that still invalidates
+    everything, which is all we need.)"""
+    if _batching():
+        return
+    cache = get_page_cache()
+    cache.set(REVISION_KEY, max(_now(), latest_revision() + 1), timeout=None)
+
+
+def bump_revisions(keys):
+    """Invalidate the cached pages showing any of keys (see
+    thesis_revision()). keys may be a lazy iterable, such as a queryset: it
+    isn't used at all inside batched_revisions()."""
+    if _batching():
+        return
+    keys = list(keys)
+    cache = get_page_cache()
+    # Later than anything before, even within the same millisecond.
+    now = max(_now(), latest_revision() + 1)
+    revisions = {key: now for key in keys}
+    revisions[LATEST_KEY] = now
+    cache.set_many(revisions, timeout=None)
+
+
+@contextmanager
+def batched_revisions():
+    """Within this, changes don't bump any revisions; instead, if anything
+    changed, everything is invalidated once at the end. For ingests, which
+    change so much that bumping for every row would take longer, and
+    invalidate nearly as much."""
+    _batch.depth = getattr(_batch, 'depth', 0) + 1
+    if _batch.depth == 1:
+        _batch.changed = False
+    try:
+        yield
+    finally:
+        _batch.depth -= 1
+        if not _batch.depth and _batch.changed:
+            bump_metadata_revision()
+
+
+def page_fingerprint():
+    index = get_index()
+    fingerprint = index.fingerprint
+    if fingerprint is None:
+        # We can't tell this model from any other, so only share its pages
+        # with this process.
+        fingerprint = 'process-{}-{}'.format(os.getpid(), id(index))
+    return fingerprint
+
+
+def page_version(keys=None, revision=None):
+    """The version of whatever shows the metadata with the given revision
+    keys (or any metadata, if keys is None) as the served model sees it.
+    Pass their revision instead, if it's already been looked up."""
+    if revision is None:
+        revision = page_revision(keys)
+    return '{}:{}'.format(page_fingerprint(), revision)
+
+
+def page_last_modified(keys=None, revision=None):
+    """When whatever shows the metadata with the given revision keys (or
+    any metadata) last changed: the later of when the served model was
+    written and their revision (which may be passed instead), in seconds
+    since the epoch."""
+    if revision is None:
+        revision = page_revision(keys)
+    model_file = get_served().model_file
+    return max(int(os.path.getmtime(model_file)), revision // 1000)
+
+
+def page_key(request, params=()):
+    """A key for the page at request's path, as shown with params
+    ([(name, value)]; see CachedPageMixin.get_page_params)."""
+    url = '{}?{}'.format(request.path, urlencode(sorted(params)))
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def page_etag(key, version):
+    """An ETag for the page with the given key, which changes whenever the
+    model or the metadata it shows do."""
+    tag = '{}:{}'.format(version, key)
+    return '"{}"'.format(hashlib.sha1(tag.encode('utf-8')).hexdigest())
+
+
+def page_cache(request):
+    """Context processor for caching template fragments (see above). The
+    version (of everything) is only looked up if a template uses it."""
+    return {'page_cache': settings.HAMLET_PAGE_CACHE,
+            'page_version': lazy(page_version, str)()}
+
+
+# Headers which belong to one response rather than to the page.
+UNCACHED_HEADERS = {'content-length', 'set-cookie', 'server-timing'}
+
+
+class CachedPageMixin(object):
+    """For views whose GET responses depend only on the URL path, the
+    parameters from get_page_params(), the model and the metadata with the
+    revision keys from get_page_revisions().
+
+    Successful responses are cached, so other visitors, in any process, get
+    them without the view running at all. They also carry an ETag and
+    Last-Modified, so that clients and proxies which have seen a page before
+    are told it hasn't changed (304 Not Modified) before we so much as look
+    in the cache. Which revision keys a page depends on is only known once
+    it has been made, so they are kept alongside it, for as long as the
+    model is the same.
+
+    Cached pages keep the headers the view set, apart from UNCACHED_HEADERS;
+    Server-Timing is added afresh to every response by
+    hamlet.common.metrics.TimingMiddleware."""
+    def get_page_params(self, request):
+        """Return [(name, value)] for the query parameters that make a
+        difference to the page, or None if this request shouldn't be cached
+        at all. Other query parameters are ignored, so that made-up ones
+        don't fill the cache. By default, none make a difference."""
+        return []
+
+    def get_page_revisions(self, context):
+        """Return the revision keys (see thesis_revision()) of the metadata
+        the page made from context shows, or None if it might show any. By
+        default, it might."""
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(CachedPageMixin, self).dispatch(
+                request, *args, **kwargs)
+
+        params = self.get_page_params(request)
+        if params is None:
+            return super(CachedPageMixin, self).dispatch(
+                request, *args, **kwargs)
+
+        cache = get_page_cache()
+        key = page_key(request, params)
+        fingerprint = page_fingerprint()
+        revisions = cache.get('page-revisions:' + key)
+        if revisions is not None and revisions[0] == fingerprint:
+            # We've made this page for this model before, so know what it
+            # depends on.
+            current = page_revision(revisions[1])
+            version = page_version(revision=current)
+            response = get_conditional_response(
+                request, etag=page_etag(key, version),
+                last_modified=page_last_modified(revision=current))
+            if response is None:
+                response = self._cached_response(key, version)
+            if response is not None:
+                return self._validated(response, key, version, current)
+
+        # Anything that changes from now on might not be in the page.
+        before = latest_revision()
+        response = super(CachedPageMixin, self).dispatch(
+            request, *args, **kwargs)
+        if response.status_code != 200 or response.streaming:
+            return response
+        context = getattr(response, 'context_data', None)
+        keys = None if context is None else self.get_page_revisions(context)
+        current = page_revision(keys)
+        if current > before:
+            return response
+
+        version = page_version(revision=current)
+        cache.set('page-revisions:' + key, (fingerprint, keys))
+        if request.method == 'GET':
+            self._store(response, key, version)
+        return self._validated(response, key, version, current)
+
+    def _validated(self, response, key, version, current):
+        response['ETag'] = page_etag(key, version)
+        response['Last-Modified'] = http_date(
+            page_last_modified(revision=current))
+        # Proxies may keep pages, but should check with us before reusing
+        # them.
+        patch_cache_control(response, public=True, max_age=0)
+        return response
+
+    def _cached_response(self, key, version):
+        cached = get_page_cache().get('page:{}:{}'.format(version, key))
+        if cached is None:
+            return None
+        content, headers = cached
+        response = HttpResponse(content)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    def _store(self, response, key, version):
+        def store(response):
+            headers = [(header, value) for header, value in response.items()
+                       if header.lower() not in UNCACHED_HEADERS]
+            get_page_cache().set('page:{}:{}'.format(version, key),
+                                 (response.content, headers))
+
+        if hasattr(response, 'add_post_render_callback'):
+            # Templates aren't rendered until the view has returned.
+            response.add_post_render_callback(store)
+        else:
+            store(response)
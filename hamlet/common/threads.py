@@ -0,0 +1,43 @@
+"""Running slow work off the request path, under gevent or not.
+
+In production gunicorn runs gevent workers (see the Procfile), which
+monkey-patch threading: a threading.Thread is then a greenlet, and anything
+slow it does without yielding (loading a model, building an index, numpy)
+holds up every request the worker is serving. gevent's threadpool runs
+functions on real OS threads instead, so background work should go through
+start_background() rather than threading.Thread."""
+import threading
+
+
+def gevent_threads():
+    """Whether gevent has monkey-patched threading in this process."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def _gevent_threadpool():
+    import gevent
+    return gevent.get_hub().threadpool
+
+
+class _PooledThread(object):
+    """What start_background() returns under gevent: like a Thread, as far
+    as join() goes."""
+    def __init__(self, result):
+        self.result = result
+
+    def join(self, timeout=None):
+        self.result.wait(timeout)
+
+
+def start_background(target, *args):
+    """Run target(*args) on an OS thread of its own, and return something
+    with a join() method for waiting for it."""
+    if gevent_threads():
+        return _PooledThread(_gevent_threadpool().spawn(target, *args))
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.views import View
+from django.views.generic.edit import FormView
+
+from hamlet.theses.models import RankedTheses
+
+from . import jobs
+from .metrics import timer
+from .document import factory
+from .forms import UploadFileForm
+from .inferred_vectors import get_neighbours
+
+
+class UploadView(FormView):
+    """Base for views which recommend theses for an uploaded document.
+
+    By default the most similar theses are shown with the similar_to
+    template; subclasses replace search and render_result() to show
+    something else. If
+    settings.HAMLET_ASYNC_UPLOADS is set, the search runs as a background job
+    (see hamlet.common.jobs): the upload redirects to result_url_name, which
+    should route to this same view with a job_id, and which shows a holding
+    page until the job is done."""
+    form_class = UploadFileForm
+    result_url_name = None
+    # Works out what to show for an upload from its tokens and the Subset of
+    # theses to consider; by default, the identifiers and scores of the most
+    # similar theses. It may run as a background job, so it mustn't need the
+    # request, and must return something the job cache can store.
+    # render_result() turns what it returns into a response.
+    search = staticmethod(get_neighbours)
+
+    def get(self, request, *args, **kwargs):
+        if 'job_id' in kwargs:
+            return self.job_response(kwargs['job_id'])
+        return super(UploadView, self).get(request, *args, **kwargs)
+
+    def form_valid(self, form):
+        # Read the upload now; it won't be around once the request is over.
+        with timer('parse'):
+            words = factory(self.request.FILES['file']).tokens
+        subset = form.get_subset()
+
+        if not settings.HAMLET_ASYNC_UPLOADS:
+            return self.render_result(self.search(words, subset))
+
+        try:
+            job_id = jobs.submit(self.search, words, subset)
+        except jobs.QueueFull:
+            form.add_error(None, 'We are very busy right now. Please try '
+                                 'again in a minute.')
+            response = self.form_invalid(form)
+            response.status_code = 503
+            response['Retry-After'] = '60'
+            return response
+
+        return HttpResponseRedirect(
+            reverse(self.result_url_name, kwargs={'job_id': job_id}))
+
+    def job_response(self, job_id):
+        job = jobs.get_job(job_id)
+        if job is None:
+            raise Http404('No matching upload was found')
+
+        if job['status'] == jobs.DONE:
+            return self.render_result(job['result'])
+
+        return render(self.request, 'upload_pending.html', {
+            'failed': job['status'] == jobs.FAILED,
+            'status_url': reverse('job_status', kwargs={'job_id': job_id}),
+        })
+
+    def render_result(self, result):
+        return render(self.request, 'theses/similar_to.html',
+                      {'suggestions': RankedTheses(result)})
+
+
+class JobStatusView(View):
+    """Lets the holding page poll for the status of an upload job."""
+    def get(self, request, *args, **kwargs):
+        job = jobs.get_job(kwargs['job_id'])
+        if job is None:
+            raise Http404('No matching upload was found')
+        return JsonResponse({'status': job['status']})
@@ -0,0 +1,101 @@
+"""Approximate nearest-neighbour search over document vectors.
+
+An inverted file (IVF) index: the unit-normalised document vectors are
+clustered with spherical k-means, and each document is filed under its
+nearest cluster centroid. A query is compared against the centroids first, and
+then only against the documents filed under the nprobe closest centroids. With
+about sqrt(N) clusters, a query touches a small fraction of the corpus, and
+the fraction shrinks as the corpus grows. Raising nprobe trades speed for
+recall; probing every cluster is an exact search.
+
+The index only proposes candidates; hamlet.neural.index.SimilarityIndex scores
+and ranks them. Anything with the same candidates() method can stand in for
+IVFIndex there."""
+import os
+
+import numpy as np
+
+from .loading import sidecar_path
+
+
+def _nearest_centroid(vectors, centroids, batch_size=4096):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        stop = start + batch_size
+        assignment[start:stop] = np.argmax(
+            np.dot(vectors[start:stop], centroids.T), axis=1)
+    return assignment
+
+
+class IVFIndex(object):
+    def __init__(self, centroids, offsets, rows):
+        # centroids[c] is the unit centroid of cluster c; the rows filed
+        # under it are rows[offsets[c]:offsets[c + 1]].
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, nlist=None, iterations=10, sample_size=50000,
+              seed=0):
+        """Cluster vectors (which must be unit-normalised) into nlist lists.
+
+        Centroids are trained on a random sample of at most sample_size
+        vectors, which is plenty to place them; every vector is then filed
+        under its nearest centroid."""
+        count = len(vectors)
+        nlist = min(nlist or int(np.sqrt(count)) or 1, count)
+        rng = np.random.RandomState(seed)
+
+        sample = np.asarray(vectors[np.sort(
+            rng.choice(count, min(count, sample_size), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+        for _ in range(iterations):
+            assignment = _nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            # Empty clusters keep their old centroid.
+            nonempty = norms > 0
+            centroids[nonempty] = sums[nonempty] / norms[nonempty, np.newaxis]
+
+        assignment = _nearest_centroid(vectors, centroids)
+        rows = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.searchsorted(assignment[rows], np.arange(nlist + 1))
+
+        return cls(centroids.astype(np.float32), offsets.astype(np.int64),
+                   rows)
+
+    def save(self, model_file):
+        np.save(sidecar_path(model_file, 'ivf_centroids'), self.centroids)
+        np.save(sidecar_path(model_file, 'ivf_offsets'), self.offsets)
+        np.save(sidecar_path(model_file, 'ivf_rows'), self.rows)
+
+    @classmethod
+    def load(cls, model_file):
+        """Load the index saved beside model_file, or return None if there
+        isn't one."""
+        paths = [sidecar_path(model_file, name)
+                 for name in ('ivf_centroids', 'ivf_offsets', 'ivf_rows')]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+
+        # The centroids are small and read on every query, so load them
+        # properly; the rest can stay on disk.
+        centroids = np.load(paths[0])
+        offsets = np.load(paths[1], mmap_mode='r')
+        rows = np.load(paths[2], mmap_mode='r')
+        return cls(centroids, offsets, rows)
+
+    def candidates(self, query, nprobe):
+        """Return the rows filed under the nprobe centroids nearest to
+        query."""
+        nprobe = min(nprobe, len(self))
+        sims = np.dot(self.centroids, query)
+        probes = np.argpartition(-sims, nprobe - 1)[:nprobe]
+        return np.concatenate(
+            [self.rows[self.offsets[c]:self.offsets[c + 1]] for c in probes])
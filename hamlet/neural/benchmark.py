@@ -0,0 +1,155 @@
+"""Benchmarks for the similarity code, on synthetic corpora of any size.
+
+Similarity search only cares about how many document vectors there are and
+how long they are, not what they say, so we benchmark it on random unit
+vectors standing in for a model's docvecs. That lets us see how things will
+behave as the corpus grows without having to train a model that big. Vector
+inference doesn't depend on the corpus size at all, so that is timed once, on
+the real model.
+
+See the benchmark management command."""
+import time
+
+import numpy as np
+
+from .ann import IVFIndex
+from .index import NEIGHBOUR_COUNT, SimilarityIndex, identifiers_from_model
+from .quantisation import QuantisedVectors
+
+# The corpus sizes we care about: roughly today's, and where it's heading.
+SIZES = (10000, 43000, 250000, 1000000)
+
+
+class SyntheticDocvecs(object):
+    """Just enough of gensim's Doc2VecKeyedVectors for SimilarityIndex."""
+    def __init__(self, vectors):
+        self.vectors_docs_norm = vectors
+
+    def __len__(self):
+        return len(self.vectors_docs_norm)
+
+    def init_sims(self):
+        pass
+
+    def index_to_doctag(self, row):
+        return '1721.1-{}.txt'.format(row + 1)
+
+
+class SyntheticModel(object):
+    def __init__(self, count, size=52, seed=0):
+        rng = np.random.RandomState(seed)
+        vectors = np.empty((count, size), dtype=np.float32)
+        # In chunks, so we never need a float64 copy of the whole thing.
+        for start in range(0, count, 100000):
+            chunk = rng.randn(min(100000, count - start), size)
+            chunk /= np.linalg.norm(chunk, axis=1)[:, np.newaxis]
+            vectors[start:start + len(chunk)] = chunk
+        self.docvecs = SyntheticDocvecs(vectors)
+
+
+def _summarise(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        'runs': len(ms),
+        'mean_ms': round(float(ms.mean()), 4),
+        'median_ms': round(float(np.median(ms)), 4),
+        'p95_ms': round(float(np.percentile(ms, 95)), 4),
+        'max_ms': round(float(ms.max()), 4),
+    }
+
+
+def time_calls(func, args_list):
+    """Call func(*args) for each args in args_list and summarise the
+    timings."""
+    seconds = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - start)
+    return _summarise(seconds)
+
+
+def time_once(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round((time.perf_counter() - start) * 1000, 4)
+
+
+def benchmark_size(count, size=52, queries=100, nprobe=16, seed=0,
+                   log=lambda message: None):
+    """Benchmark similarity search over a synthetic corpus of count
+    documents. Returns a dict of results for JSON."""
+    rng = np.random.RandomState(seed + 1)
+    results = {'documents': count, 'dimensions': size, 'build_ms': {}}
+
+    log('  building synthetic model')
+    model, results['build_ms']['model'] = time_once(
+        lambda: SyntheticModel(count, size, seed))
+    vectors = model.docvecs.vectors_docs_norm
+
+    # Parsing document tags into identifiers happens once per model load
+    # for models without an identifiers sidecar.
+    identifiers, results['build_ms']['identifiers_from_tags'] = time_once(
+        lambda: identifiers_from_model(model))
+
+    log('  building approximate index')
+    ann, results['build_ms']['ivf_index'] = time_once(
+        lambda: IVFIndex.build(vectors))
+    quantised, results['build_ms']['int8_vectors'] = time_once(
+        lambda: QuantisedVectors.build(vectors, 'int8'))
+
+    # Building a real neighbour table is quadratic in the corpus size, and
+    # looking things up in it takes the same time whatever it holds, so a
+    # random one will do.
+    neighbours = rng.randint(0, count, size=(count, NEIGHBOUR_COUNT),
+                             dtype=np.int64).astype(np.int32)
+    scores = np.sort(rng.rand(count, NEIGHBOUR_COUNT).astype(np.float32),
+                     axis=1)[:, ::-1]
+
+    indexes = {
+        'exact': SimilarityIndex(model, identifiers),
+        'table': SimilarityIndex(model, identifiers, neighbours, scores),
+        'ivf': SimilarityIndex(model, identifiers, ann=ann),
+        'ivf_int8': SimilarityIndex(model, identifiers, ann=ann,
+                                    quantised=quantised),
+    }
+
+    sample = [(int(identifiers[row]),)
+              for row in rng.choice(count, queries, replace=False)]
+    pairs = [(int(identifiers[a]), int(identifiers[b]))
+             for a, b in rng.randint(0, count, size=(queries, 2))]
+    query_vectors = [(rng.randn(size).astype(np.float32),)
+                     for _ in range(queries)]
+    batches = [([identifier for identifier, in sample[i:i + 10]],)
+               for i in range(0, queries, 10)]
+
+    ops = results['ms'] = {}
+    log('  timing queries')
+    ops['row_lookup'] = time_calls(indexes['exact'].row, sample)
+    ops['most_similar_table'] = time_calls(
+        lambda x: indexes['table'].most_similar(x, 10), sample)
+    for name in ('exact', 'ivf', 'ivf_int8'):
+        nprobe_for = 0 if name == 'exact' else nprobe
+        ops['most_similar_{}'.format(name)] = time_calls(
+            lambda x: indexes[name].most_similar(x, 10, nprobe=nprobe_for),
+            sample)
+        ops['most_similar_to_vector_{}'.format(name)] = time_calls(
+            lambda v: indexes[name].most_similar_to_vector(
+                v, 10, nprobe=nprobe_for),
+            query_vectors)
+    ops['most_similar_batch_of_10'] = time_calls(
+        lambda xs: indexes['exact'].most_similar_batch(xs, 10), batches)
+    ops['similarity'] = time_calls(indexes['exact'].similarity, pairs)
+
+    return results
+
+
+def benchmark_inference(model, words=2000, queries=10, seed=0):
+    """Time infer_vector on a real model, for a document of the given number
+    of words drawn from its vocabulary."""
+    rng = np.random.RandomState(seed)
+    vocabulary = list(model.wv.vocab)
+    documents = [([vocabulary[i] for i in
+                   rng.randint(0, len(vocabulary), size=words)],)
+                 for _ in range(queries)]
+    return {'words': words, 'ms': time_calls(model.infer_vector, documents)}
@@ -0,0 +1,95 @@
+"""Average document vectors for groups of theses.
+
+"Which advisors work near my topic?" means comparing a document with
+everything each advisor has supervised. Rather than searching thesis by
+thesis, we average the unit vectors of each group's theses (all the theses a
+person advised, or all of a department's) into one unit vector, its centroid,
+and keep the centroids of every group in one matrix. Ranking every advisor
+against a document is then a single matrix-vector product.
+
+The groups come from the database, which this module knows nothing about:
+Centroids.build takes the pairs of (Thesis.identifier, group key) to average
+over; see hamlet.theses.centroids. Centroid matrices can be saved beside a
+model, like its other precomputed tables, or built when first needed."""
+import os
+
+import numpy as np
+
+from .loading import sidecar_path
+
+
+class Centroids(object):
+    """One unit vector per group: vectors[i] is the centroid of the group
+    with key keys[i] (a Person or Department pk, say), which has counts[i]
+    theses in the model."""
+    def __init__(self, vectors, keys, counts):
+        self.vectors = vectors
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, index, identifiers, keys):
+        """Average the vectors in index of the theses with the given
+        identifiers by the group key beside each. Theses that aren't in the
+        model are left out, and so are groups with none in it."""
+        rows = index.rows_for(identifiers)
+        present = rows >= 0
+        rows = rows[present]
+        keys = np.asarray(keys, dtype=np.int64)[present]
+
+        group_keys, groups = np.unique(keys, return_inverse=True)
+        vectors = np.asarray(index.vectors)
+        sums = np.zeros((len(group_keys), vectors.shape[1]), dtype=np.float64)
+        np.add.at(sums, groups, vectors[rows])
+        counts = np.bincount(groups, minlength=len(group_keys))
+
+        norms = np.linalg.norm(sums, axis=1)
+        norms[norms == 0] = 1
+        return cls((sums / norms[:, np.newaxis]).astype(np.float32),
+                   group_keys, counts.astype(np.int32))
+
+    def save(self, model_file, name):
+        prefix = 'centroids_' + name
+        np.save(sidecar_path(model_file, prefix), self.vectors)
+        np.save(sidecar_path(model_file, prefix + '_keys'), self.keys)
+        np.save(sidecar_path(model_file, prefix + '_counts'), self.counts)
+
+    @classmethod
+    def load(cls, model_file, name):
+        """Load the centroids called name saved beside model_file, or return
+        None if there aren't any."""
+        prefix = 'centroids_' + name
+        paths = [sidecar_path(model_file, prefix + suffix)
+                 for suffix in ('', '_keys', '_counts')]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return cls(*(np.load(path, mmap_mode='r') for path in paths))
+
+    def vector(self, key):
+        """Return the centroid of the group with the given key, or None if
+        there is no such group. (keys are sorted, since build() gets them
+        from np.unique.)"""
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self.vectors[i]
+
+    def rank(self, vector, topn=10, exclude=()):
+        """Return [(key, similarity)] for the topn groups nearest to vector,
+        nearest first, leaving out any whose keys are in exclude."""
+        if not len(self.keys):
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        sims = np.dot(self.vectors, vector / norm if norm else vector)
+        if exclude:
+            sims[np.isin(self.keys, list(exclude))] = -np.inf
+
+        topn = min(topn, len(sims))
+        best = np.argpartition(-sims, topn - 1)[:topn]
+        best = best[np.argsort(-sims[best], kind='stable')]
+        return [(int(self.keys[i]), float(sims[i])) for i in best
+                if sims[i] > -np.inf]
@@ -0,0 +1,429 @@
+import logging
+import os
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+import numpy as np
+
+from .ann import IVFIndex
+from .loading import model_fingerprint, sidecar_path
+from .quantisation import DTYPES as QUANTISED_DTYPES, QuantisedVectors
+
+logger = logging.getLogger(__name__)
+
+# Part of the corpus to search (for instance, one department's theses): rows
+# holds the rows to consider, in ascending order, and key is a short string
+# naming the subset in cache keys.
+Subset = namedtuple('Subset', ['key', 'rows'])
+
+# How many neighbours to precompute for each document. Thesis.get_most_similar
+# never returns more than this.
+NEIGHBOUR_COUNT = 50
+
+# When searching quantised vectors, shortlist this many times as many
+# candidates as we were asked for (but at least RERANK_MINIMUM more) and rank
+# them exactly. Quantisation only nudges similarities slightly, so the true
+# nearest neighbours are all but certain to make the shortlist.
+RERANK_FACTOR = 4
+RERANK_MINIMUM = 32
+
+# similarity_matrix works out this many rows of the matrix at a time.
+MATRIX_BLOCK_SIZE = 2048
+
+
+def top_neighbours(vectors, rows, topn, batch_size=1024):
+    """Find the topn nearest neighbours of each of the given rows of vectors.
+
+    vectors must be unit-normalised, so that dot products are cosine
+    similarities. Returns (neighbours, scores): neighbours[i] holds the row
+    numbers of the documents most similar to rows[i], most similar first, and
+    scores[i] holds their similarities. A document is never its own
+    neighbour.
+
+    Rows are processed batch_size at a time, each batch with one
+    matrix-matrix product, so the scratch space needed is
+    batch_size * len(vectors) floats rather than len(rows) * len(vectors)."""
+    rows = np.asarray(rows, dtype=np.int64)
+    topn = min(topn, len(vectors) - 1)
+    neighbours = np.empty((len(rows), topn), dtype=np.int32)
+    scores = np.empty((len(rows), topn), dtype=np.float32)
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        sims = np.dot(vectors[batch], vectors.T)
+        sims[np.arange(len(batch)), batch] = -np.inf
+
+        best = np.argpartition(-sims, topn - 1, axis=1)[:, :topn]
+        best_sims = np.take_along_axis(sims, best, axis=1)
+        order = np.argsort(-best_sims, axis=1)
+
+        stop = start + len(batch)
+        neighbours[start:stop] = np.take_along_axis(best, order, axis=1)
+        scores[start:stop] = np.take_along_axis(best_sims, order, axis=1)
+
+    return neighbours, scores
+
+
+def build_neighbour_table(vectors, topn=NEIGHBOUR_COUNT, batch_size=1024):
+    """Find the topn nearest neighbours of every row of vectors; see
+    top_neighbours."""
+    return top_neighbours(vectors, np.arange(len(vectors)), topn,
+                          batch_size=batch_size)
+
+
+def identifier_from_label(label):
+    """Turn a document tag like '1721.1-12345.txt' into the Thesis.identifier
+    it stands for (12345)."""
+    return int(label.split('-')[1].split('.')[0])
+
+
+def identifiers_from_model(model):
+    """Return an array mapping each row of model's document vectors to the
+    Thesis.identifier of the document."""
+    docvecs = model.docvecs
+    return np.array([identifier_from_label(docvecs.index_to_doctag(row))
+                     for row in range(len(docvecs))], dtype=np.int64)
+
+
+def export_identifiers(model, model_file):
+    """Save the row -> Thesis.identifier array for model beside model_file, so
+    that servers never need to look at document tags."""
+    np.save(sidecar_path(model_file, 'identifiers'),
+            identifiers_from_model(model))
+
+
+def export_neighbour_table(model, model_file, topn=NEIGHBOUR_COUNT):
+    """Precompute the neighbour table for model and save it beside
+    model_file."""
+    model.docvecs.init_sims()
+    neighbours, scores = build_neighbour_table(
+        model.docvecs.vectors_docs_norm, topn=topn)
+    np.save(sidecar_path(model_file, 'neighbours'), neighbours)
+    np.save(sidecar_path(model_file, 'neighbour_scores'), scores)
+
+
+class SimilarityIndex(object):
+    """Answers "which documents are most like this one?" for a loaded model.
+
+    If the model was exported with a neighbour table, answers for documents in
+    the model are looked up from it. Other queries (uploaded documents, or
+    wanting more neighbours than the table holds) are searched for:
+
+    * if there is an approximate index, only the documents it proposes are
+      considered; otherwise every document is;
+    * if there are quantised vectors, they are used to shortlist the best
+      candidates, and only the shortlist is scored with the full-precision
+      vectors; otherwise every candidate is.
+
+    Whichever route is taken, the similarities returned are exact. Searched
+    results are kept in the settings.HAMLET_SIMILARITY_CACHE cache under the
+    model's fingerprint, so they are shared between processes (if the cache
+    backend allows) and are never served for the wrong model.
+
+    nprobe sets how much of the approximate index to search: higher is slower
+    but more accurate. It defaults to settings.HAMLET_ANN_NPROBE; 0 forces an
+    exhaustive search.
+
+    Documents are identified by their Thesis.identifier on the way in and
+    out, and by their row number in the model everywhere in between;
+    identifiers[row] is the identifier of the document in that row."""
+    def __init__(self, model, identifiers, neighbours=None, scores=None,
+                 ann=None, quantised=None, fingerprint=None):
+        self.model = model
+        self.fingerprint = fingerprint
+        self.identifiers = identifiers
+        # The reverse map, kept as a sorted array for binary search rather
+        # than as a dict, which would cost far more memory.
+        self._order = np.argsort(identifiers, kind='stable')
+        self._sorted_identifiers = np.asarray(identifiers)[self._order]
+        self.neighbours = neighbours
+        self.scores = scores
+        self.ann = ann
+        self.quantised = quantised
+
+    @classmethod
+    def load(cls, model, model_file):
+        count = len(model.docvecs)
+        neighbours = scores = None
+
+        identifiers = None
+        identifiers_path = sidecar_path(model_file, 'identifiers')
+        if os.path.exists(identifiers_path):
+            identifiers = np.load(identifiers_path, mmap_mode='r')
+            if len(identifiers) != count:
+                logger.warning('Ignoring identifiers for %s: there are %d '
+                    'but the model has %d documents', model_file,
+                    len(identifiers), count)
+                identifiers = None
+
+        if identifiers is None:
+            identifiers = identifiers_from_model(model)
+        else:
+            # Serving never needs the document tags, and for a big corpus
+            # the dict of them is a lot of memory to keep in every worker.
+            model.docvecs.doctags = {}
+            model.docvecs.offset2doctag = []
+
+        neighbours_path = sidecar_path(model_file, 'neighbours')
+        scores_path = sidecar_path(model_file, 'neighbour_scores')
+        if os.path.exists(neighbours_path) and os.path.exists(scores_path):
+            neighbours = np.load(neighbours_path, mmap_mode='r')
+            scores = np.load(scores_path, mmap_mode='r')
+
+        ann = IVFIndex.load(model_file)
+
+        quantised = None
+        if settings.HAMLET_VECTOR_DTYPE in QUANTISED_DTYPES:
+            quantised = QuantisedVectors.load(model_file,
+                                              settings.HAMLET_VECTOR_DTYPE)
+
+        # Tables left over from some other model would give nonsense
+        # answers, so make sure they at least have the right number of rows.
+        if neighbours is not None and len(neighbours) != count:
+            logger.warning('Ignoring neighbour table for %s: it has %d rows '
+                'but the model has %d documents', model_file,
+                len(neighbours), count)
+            neighbours = scores = None
+
+        if ann is not None and len(ann.rows) != count:
+            logger.warning('Ignoring approximate index for %s: it has %d rows '
+                'but the model has %d documents', model_file,
+                len(ann.rows), count)
+            ann = None
+
+        if quantised is not None and len(quantised) != count:
+            logger.warning('Ignoring quantised vectors for %s: there are %d '
+                'but the model has %d documents', model_file,
+                len(quantised), count)
+            quantised = None
+
+        return cls(model, identifiers, neighbours, scores, ann, quantised,
+                   fingerprint=model_fingerprint(model_file))
+
+    @property
+    def vectors(self):
+        """The unit-normalised document vectors."""
+        self.model.docvecs.init_sims()
+        return self.model.docvecs.vectors_docs_norm
+
+    @property
+    def cache(self):
+        return caches[settings.HAMLET_SIMILARITY_CACHE]
+
+    def _cache_key(self, *params):
+        """Return the cache key for params, or None if we can't safely cache
+        (because we don't know which model this is)."""
+        if self.fingerprint is None:
+            return None
+        return ':'.join(str(param) for param in (self.fingerprint,) + params)
+
+    def _cached(self, compute, *params):
+        """Return compute(), caching it under params and this model's
+        fingerprint."""
+        key = self._cache_key(*params)
+        if key is None:
+            return compute()
+
+        result = self.cache.get(key)
+        if result is None:
+            result = compute()
+            self.cache.set(key, result)
+        return result
+
+    def __contains__(self, identifier):
+        try:
+            self.row(identifier)
+        except KeyError:
+            return False
+        return True
+
+    def row(self, identifier):
+        """Return the row of the document with the given Thesis.identifier,
+        raising KeyError if it isn't in the model."""
+        i = np.searchsorted(self._sorted_identifiers, identifier)
+        if (i == len(self._sorted_identifiers) or
+                self._sorted_identifiers[i] != int(identifier)):
+            raise KeyError(
+                'Thesis {} is not in the model'.format(identifier))
+        return int(self._order[i])
+
+    def rows_for(self, identifiers):
+        """Return an array of the rows of the documents with the given
+        identifiers, with -1 for any that aren't in the model."""
+        identifiers = np.asarray(identifiers, dtype=np.int64)
+        i = np.searchsorted(self._sorted_identifiers, identifiers)
+        i = np.minimum(i, len(self._sorted_identifiers) - 1)
+        rows = np.asarray(self._order[i], dtype=np.int64)
+        rows[self._sorted_identifiers[i] != identifiers] = -1
+        return rows
+
+    def _identified(self, rows, sims):
+        identifiers = self.identifiers[rows]
+        return [(int(identifier), float(sim))
+                for identifier, sim in zip(identifiers, sims)]
+
+    def nearest(self, query, topn=10, exclude=(), nprobe=None, rows=None):
+        """Find the topn documents most similar to the unit vector query,
+        skipping the rows in exclude. If rows is given, only those rows are
+        searched.
+
+        Returns (rows, similarities), most similar first."""
+        if nprobe is None:
+            nprobe = settings.HAMLET_ANN_NPROBE
+        exclude = np.asarray(exclude, dtype=np.int64)
+
+        candidates = None
+        if rows is not None:
+            # Scan the whole subset. It's smaller than the corpus, so this is
+            # quick, and the approximate index (built for the whole corpus)
+            # might not propose anything from it at all.
+            candidates = np.asarray(rows, dtype=np.int64)
+            candidates = candidates[~np.isin(candidates, exclude)]
+        elif self.ann is not None and nprobe:
+            candidates = self.ann.candidates(query, nprobe)
+            candidates = candidates[~np.isin(candidates, exclude)]
+            # The probed lists were too short to fill the request, so search
+            # everything instead.
+            if len(candidates) < topn:
+                candidates = None
+
+        if self.quantised is not None:
+            candidates = self.quantised.shortlist(
+                query, max(topn * RERANK_FACTOR, topn + RERANK_MINIMUM),
+                rows=candidates, exclude=exclude)
+
+        if candidates is None:
+            sims = np.dot(self.vectors, query)
+            sims[exclude] = -np.inf
+            candidates = np.arange(len(sims))
+        else:
+            # Reading rows in order is kinder to memory-mapped vectors.
+            candidates = np.sort(candidates)
+            sims = np.dot(self.vectors[candidates], query)
+
+        topn = min(topn, len(candidates) - len(
+            np.intersect1d(candidates, exclude)))
+        if topn <= 0:
+            return candidates[:0], sims[:0]
+
+        best = np.argpartition(-sims, topn - 1)[:topn]
+        best = best[np.argsort(-sims[best])]
+        return candidates[best], sims[best]
+
+    def most_similar(self, identifier, topn=10, nprobe=None, subset=None):
+        """Return a list of up to topn (identifier, similarity) pairs for the
+        documents most similar to the one with the given identifier, most
+        similar first. If subset (a Subset) is given, only documents in it
+        are considered."""
+        row = self.row(identifier)
+
+        if subset is not None:
+            return self._cached(
+                lambda: self._identified(*self.nearest(
+                    self.vectors[row], topn, exclude=[row],
+                    rows=subset.rows)),
+                'most_similar', row, topn, subset.key)
+
+        if self.neighbours is not None and topn <= self.neighbours.shape[1]:
+            return self._identified(self.neighbours[row, :topn],
+                                    self.scores[row, :topn])
+
+        if nprobe is None:
+            nprobe = settings.HAMLET_ANN_NPROBE
+
+        return self._cached(
+            lambda: self._identified(*self.nearest(
+                self.vectors[row], topn, exclude=[row], nprobe=nprobe)),
+            'most_similar', row, topn, nprobe)
+
+    def most_similar_batch(self, identifiers, topn=10):
+        """Return a dict mapping each of identifiers to
+        most_similar(identifier, topn).
+
+        Anything not answered by the neighbour table or the cache is worked
+        out together, exactly, with one matrix-matrix product per thousand
+        documents; this is much faster than searching for each in turn."""
+        results = {}
+        missing = []
+        nprobe = settings.HAMLET_ANN_NPROBE
+
+        for identifier in set(identifiers):
+            row = self.row(identifier)
+            if (self.neighbours is not None and
+                    topn <= self.neighbours.shape[1]):
+                results[identifier] = self._identified(
+                    self.neighbours[row, :topn], self.scores[row, :topn])
+                continue
+
+            # Share cache entries with most_similar. These results are
+            # exact, which is at least as good as what it would have found.
+            key = self._cache_key('most_similar', row, topn, nprobe)
+            result = self.cache.get(key) if key else None
+            if result is None:
+                missing.append((identifier, row, key))
+            else:
+                results[identifier] = result
+
+        if missing:
+            neighbours, scores = top_neighbours(
+                self.vectors, [row for _, row, _ in missing], topn)
+            for (identifier, _, key), rows, sims in zip(missing, neighbours,
+                                                         scores):
+                results[identifier] = self._identified(rows, sims)
+                if key:
+                    self.cache.set(key, results[identifier])
+
+        return results
+
+    def similarity(self, identifier1, identifier2):
+        """Return the cosine similarity of two documents in the model."""
+        # Similarity is symmetric, so both orders can share a cache entry.
+        row1, row2 = sorted([self.row(identifier1), self.row(identifier2)])
+        return self._cached(
+            lambda: float(np.dot(self.vectors[row1], self.vectors[row2])),
+            'similarity', row1, row2)
+
+    def similarity_blocks(self, rows, block_size=MATRIX_BLOCK_SIZE):
+        """Yield (start, block) pairs which together make up the matrix of
+        similarities between the documents in rows: block[i, j] is the
+        similarity of rows[start + i] and rows[j]. Each block is one
+        matrix-matrix product, and only one is in memory at a time."""
+        vectors = np.asarray(self.vectors[np.asarray(rows, dtype=np.int64)])
+        for start in range(0, len(vectors), block_size):
+            yield start, np.dot(vectors[start:start + block_size], vectors.T)
+
+    def similarity_matrix(self, identifiers, out=None,
+                          block_size=MATRIX_BLOCK_SIZE):
+        """Return the matrix of cosine similarities between the documents
+        with the given identifiers, in that order.
+
+        The full matrix for tens of thousands of documents won't fit in
+        memory; pass out (say, an np.lib.format.open_memmap) to have it
+        written there instead."""
+        rows = self.rows_for(identifiers)
+        if (rows < 0).any():
+            raise KeyError('Not in the model: {}'.format(', '.join(
+                str(x) for x in np.asarray(identifiers)[rows < 0])))
+
+        if out is None:
+            out = np.empty((len(rows), len(rows)), dtype=np.float32)
+        for start, block in self.similarity_blocks(rows, block_size):
+            out[start:start + len(block)] = block
+        return out
+
+    def most_similar_to_vector(self, vector, topn=10, nprobe=None,
+                               subset=None):
+        """Like most_similar, but for a vector that isn't in the model (for
+        instance, one inferred from an uploaded document)."""
+        query = (vector / np.linalg.norm(vector)).astype(np.float32)
+        rows = subset.rows if subset is not None else None
+        return self._identified(*self.nearest(query, topn, nprobe=nprobe,
+                                              rows=rows))
+
+
+def get_index():
+    """Return the SimilarityIndex for the served model, loading the model and
+    its precomputed tables the first time they're needed."""
+    from .provider import get_served
+    return get_served().index
@@ -0,0 +1,178 @@
+"""Inferring vectors for new documents within a time budget.
+
+infer_vector takes time in proportion to the number of tokens times the
+number of epochs it runs for, so a long enough upload can hold a worker for as
+long as it likes. infer_within_budget() estimates how long inference will
+take, and if that is over settings.HAMLET_INFERENCE_BUDGET seconds it first
+runs fewer epochs (down to settings.HAMLET_INFERENCE_MIN_EPOCHS), and then
+reads only part of the document: evenly spaced runs of consecutive tokens, so
+that the sample covers the whole document and words keep their neighbours.
+
+gensim only ever reads the first MAX_DOCUMENT_TOKENS tokens of a document, so
+no more than that are counted, timed or handed to it: longer documents are
+always sampled, and the sample still covers them from start to finish.
+
+The estimate is settings.HAMLET_INFERENCE_COST seconds per token per epoch to
+begin with, and is then kept up to date from how long inference actually
+takes in this process. The calibrate_inference management command measures
+the cost on the machine it runs on, and how much the vectors change as epochs
+and tokens are cut, which is what HAMLET_INFERENCE_MIN_EPOCHS should be based
+on."""
+from collections import namedtuple
+import math
+import threading
+import time
+
+from django.conf import settings
+import numpy as np
+
+# Tokens are sampled in runs of this many.
+SAMPLE_RUN_LENGTH = 500
+
+# infer_vector ignores everything after this many tokens (MAX_DOCUMENT_LEN in
+# gensim's doc2vec_inner, which isn't importable).
+MAX_DOCUMENT_TOKENS = 10000
+
+# How much each new timing moves the cost estimate.
+COST_SMOOTHING = 0.2
+
+# What inference did: the epochs it ran, the tokens it read, and how many
+# tokens the document had.
+InferencePlan = namedtuple('InferencePlan', ['epochs', 'tokens', 'total'])
+
+_lock = threading.Lock()
+_cost = None
+
+
+def get_cost():
+    """Our current estimate of seconds per token per epoch."""
+    with _lock:
+        return _cost if _cost is not None else settings.HAMLET_INFERENCE_COST
+
+
+def record_cost(seconds, plan):
+    global _cost
+    work = plan.epochs * plan.tokens
+    if not work:
+        return
+    observed = seconds / work
+    with _lock:
+        if _cost is None:
+            _cost = observed
+        else:
+            _cost += COST_SMOOTHING * (observed - _cost)
+
+
+def reset_cost():
+    global _cost
+    with _lock:
+        _cost = None
+
+
+def readable_tokens(total):
+    """How many of a document's total tokens inference can read."""
+    return min(total, MAX_DOCUMENT_TOKENS)
+
+
+def plan_inference(total, epochs, budget, cost, min_epochs):
+    """Decide how many epochs to run, and how many of a document's total
+    tokens to read, to infer its vector in about budget seconds."""
+    readable = readable_tokens(total)
+    if not readable or readable * epochs * cost <= budget:
+        return InferencePlan(epochs, readable, total)
+
+    affordable = int(budget / (readable * cost))
+    if affordable >= min_epochs:
+        return InferencePlan(affordable, readable, total)
+
+    # Even min_epochs is too slow for the whole document, so read part of it.
+    # (If min_epochs is more than the model's default, we run the default.)
+    epochs = min(min_epochs, epochs)
+    tokens = max(SAMPLE_RUN_LENGTH, int(budget / (epochs * cost)))
+    return InferencePlan(epochs, min(tokens, readable), total)
+
+
+def sample_tokens(words, count):
+    """Return count of words (but no more than inference can read): evenly
+    spaced runs of consecutive words, in order."""
+    count = readable_tokens(count)
+    if count >= len(words):
+        return words
+    runs = max(1, math.ceil(count / SAMPLE_RUN_LENGTH))
+    lengths = np.diff(np.linspace(0, count, runs + 1).astype(int))
+    starts = np.linspace(0, len(words) - lengths.max(), runs).astype(int)
+    sample = []
+    for start, length in zip(starts, lengths):
+        sample.extend(words[start:start + length])
+    return sample
+
+
+def infer_within_budget(model, words, budget=None):
+    """Infer a vector for words with model, in about budget seconds
+    (settings.HAMLET_INFERENCE_BUDGET by default; None there means no limit).
+
+    Returns the vector and an InferencePlan saying what it took to get it."""
+    if budget is None:
+        budget = settings.HAMLET_INFERENCE_BUDGET
+    words = list(words)
+    if budget is None:
+        plan = InferencePlan(model.epochs, readable_tokens(len(words)),
+                             len(words))
+    else:
+        plan = plan_inference(len(words), model.epochs, budget, get_cost(),
+                              settings.HAMLET_INFERENCE_MIN_EPOCHS)
+
+    start = time.perf_counter()
+    vector = model.infer_vector(sample_tokens(words, plan.tokens),
+                                epochs=plan.epochs)
+    record_cost(time.perf_counter() - start, plan)
+    return vector, plan
+
+
+Calibration = namedtuple('Calibration',
+                         ['tokens', 'epochs', 'seconds', 'cost', 'stability',
+                          'agreement'])
+
+
+def _cosine(a, b):
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def calibrate(model, documents, token_counts, epoch_counts, repeats=3):
+    """Time inference on documents (lists of tokens) cut to each of
+    token_counts tokens and run for each of epoch_counts epochs.
+
+    For each combination, returns a Calibration with the mean seconds taken,
+    the seconds per token per epoch, and two mean cosine similarities:
+    stability, between vectors inferred twice with the same settings (inference
+    is random, so this is never quite 1); and agreement, with the vector
+    inferred from the whole document with the most epochs, which is what we
+    give up by cutting corners. (So token_counts over MAX_DOCUMENT_TOKENS
+    measure the same thing as MAX_DOCUMENT_TOKENS.)"""
+    most_epochs = max(epoch_counts)
+    references = [model.infer_vector(sample_tokens(document,
+                                                   MAX_DOCUMENT_TOKENS),
+                                     epochs=most_epochs)
+                  for document in documents]
+
+    results = []
+    for tokens in token_counts:
+        for epochs in epoch_counts:
+            seconds, costs, stability, agreement = [], [], [], []
+            for document, reference in zip(documents, references):
+                sample = sample_tokens(document, tokens)
+                vectors = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    vectors.append(model.infer_vector(sample, epochs=epochs))
+                    seconds.append(time.perf_counter() - start)
+                    costs.append(seconds[-1] / (len(sample) * epochs))
+                stability.extend(_cosine(a, b)
+                                 for a, b in zip(vectors, vectors[1:]))
+                agreement.extend(_cosine(v, reference) for v in vectors)
+            results.append(Calibration(
+                tokens, epochs, float(np.mean(seconds)),
+                float(np.median(costs)),
+                float(np.mean(stability)) if stability else 1.0,
+                float(np.mean(agreement))))
+    return results
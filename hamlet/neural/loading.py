@@ -0,0 +1,83 @@
+import hashlib
+import logging
+import os
+
+from gensim.models.doc2vec import Doc2Vec
+
+logger = logging.getLogger(__name__)
+
+# Arrays with at least this many elements are saved to their own .npy files
+# (e.g. hamlet.model.wv.vectors.npy) instead of being pickled into the main
+# model file. Only separately-saved arrays can be memory-mapped, so we set this
+# much lower than gensim's default of 10MB; the document vectors of a
+# production model fall just under that.
+SEP_LIMIT = 10000
+
+
+def sidecar_path(model_file, name):
+    """Where to keep an extra array that belongs with model_file.
+
+    Precomputed tables are only valid for the exact model they were built
+    from, so they live beside it and are deployed with it."""
+    return '{}.{}.npy'.format(model_file, name)
+
+
+def version_path(model_file):
+    return '{}.version'.format(model_file)
+
+
+def model_fingerprint(model_file):
+    """Return a short string identifying the version of the model in
+    model_file, for use in cache keys.
+
+    Exported models carry a fingerprint derived from their document vectors,
+    so every server running the same model agrees on it. For other models we
+    make do with the file's size and modification time, which at least change
+    whenever a new model is deployed."""
+    try:
+        with open(version_path(model_file), 'r') as f:
+            return f.read().strip()
+    except IOError:
+        stat = os.stat(model_file)
+        stamp = '{}:{}:{}'.format(
+            os.path.abspath(model_file), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(stamp.encode('utf-8')).hexdigest()[:16]
+
+
+def export_model(model, model_file):
+    """Save a trained model in the layout that load_model expects.
+
+    Every large array goes into its own .npy file next to model_file. We also
+    precompute the unit-normalised document vectors and save them alongside,
+    so that serving processes can share one read-only copy of them rather than
+    each computing their own the first time someone asks for similar theses.
+
+    All of the resulting files (model_file, model_file.*.npy and
+    model_file.version) need to be deployed together."""
+    model.docvecs.init_sims()
+    # Word vector norms are only needed for word-level similarity queries,
+    # which we don't do.
+    model.save(model_file, sep_limit=SEP_LIMIT, ignore=['vectors_norm'])
+
+    fingerprint = hashlib.sha1(model.docvecs.vectors_docs_norm.tobytes())
+    with open(version_path(model_file), 'w') as f:
+        f.write(fingerprint.hexdigest()[:16])
+
+
+def load_model(model_file, mmap='r'):
+    """Load a Doc2Vec model for serving.
+
+    By default the model's large arrays are memory-mapped read-only, so all
+    the processes on a machine share them via the OS page cache and adding a
+    gunicorn worker costs very little memory. This only applies to arrays that
+    were saved separately; a model that hasn't been through export_model loads
+    exactly as it would with Doc2Vec.load. Pass mmap=None to read everything
+    into process memory instead."""
+    model = Doc2Vec.load(model_file, mmap=mmap)
+
+    if getattr(model.docvecs, 'vectors_docs_norm', None) is None:
+        logger.warning('%s has no precomputed document norms; each process '
+            'will compute its own. Run the export_model management command '
+            'to fix this.', model_file)
+
+    return model
@@ -0,0 +1,43 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hamlet.neural.loading import version_path
+
+
+class Command(BaseCommand):
+    help = ('Point the running site at a different exported model; servers '
+            'will switch to it without restarting')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model_file',
+                            help="Path to the model to serve, relative to the "
+                                 "pointer file or absolute")
+
+    def handle(self, *args, **options):
+        pointer = settings.HAMLET_MODEL_POINTER
+        if not pointer:
+            raise CommandError('HAMLET_MODEL_POINTER is not set, so the '
+                               'model cannot be switched while running.')
+
+        model_file = options['model_file']
+        resolved = os.path.join(os.path.dirname(os.path.abspath(pointer)),
+                                model_file)
+        if not os.path.exists(resolved):
+            raise CommandError('{} does not exist'.format(resolved))
+        if not os.path.exists(version_path(resolved)):
+            self.stdout.write(self.style.WARNING(
+                '{} has not been through export_model; every server process '
+                'will hold its own copy of it.'.format(resolved)))
+
+        # Write the new pointer beside the old one and rename it into place,
+        # so that servers never read a half-written path.
+        tmp = '{}.tmp'.format(pointer)
+        with open(tmp, 'w') as f:
+            f.write(model_file + '\n')
+        os.replace(tmp, pointer)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Switched to {}; servers will pick it up within {} '
+            'seconds'.format(resolved, settings.HAMLET_MODEL_CHECK_INTERVAL)))
@@ -0,0 +1,65 @@
+import json
+import os
+import platform
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from hamlet.neural.benchmark import (SIZES, benchmark_inference,
+                                     benchmark_size)
+from hamlet.neural.provider import get_model
+
+
+class Command(BaseCommand):
+    help = ('Benchmark similarity search on synthetic corpora of various '
+            'sizes, and vector inference on the real model, and write the '
+            'results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                            help="Numbers of documents to benchmark "
+                                 "(default: %(default)s)")
+        parser.add_argument('--dimensions', type=int, default=52,
+                            help="Length of the synthetic document vectors")
+        parser.add_argument('--queries', type=int, default=100,
+                            help="Queries to time for each operation")
+        parser.add_argument('--skip-inference', action='store_true',
+                            help="Don't load the real model to time "
+                                 "infer_vector")
+        parser.add_argument('-o', '--output', default='benchmark.json',
+                            help="File to write results to")
+
+    def handle(self, *args, **options):
+        results = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+            },
+            'settings': {
+                'HAMLET_ANN_NPROBE': settings.HAMLET_ANN_NPROBE,
+            },
+            'corpora': [],
+        }
+
+        for count in options['sizes']:
+            self.stdout.write('Benchmarking {} documents'.format(count))
+            results['corpora'].append(benchmark_size(
+                count, size=options['dimensions'],
+                queries=options['queries'],
+                nprobe=settings.HAMLET_ANN_NPROBE,
+                log=self.stdout.write))
+
+        if not options['skip_inference']:
+            self.stdout.write('Benchmarking inference on {}'.format(
+                settings.MODEL_FILE))
+            results['inference'] = benchmark_inference(get_model())
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote results to {}'.format(options['output'])))
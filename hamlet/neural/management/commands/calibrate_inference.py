@@ -0,0 +1,93 @@
+import json
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from hamlet.common.document import factory
+from hamlet.neural.inference import MAX_DOCUMENT_TOKENS, calibrate
+from hamlet.neural.provider import get_model
+
+
+class Command(BaseCommand):
+    help = ('Measure how long vector inference takes on this machine, and '
+            'how much the vectors change with fewer epochs or tokens, to '
+            'choose the HAMLET_INFERENCE_* settings')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help="Documents (.txt or .docx) to infer vectors "
+                                 "for. If there are none, we make some up "
+                                 "from the model's vocabulary.")
+        parser.add_argument('--tokens', type=int, nargs='+',
+                            default=[1000, 2500, 5000, MAX_DOCUMENT_TOKENS],
+                            help="Document lengths to try, up to the {} "
+                                 "tokens inference reads (default: "
+                                 "%(default)s)".format(MAX_DOCUMENT_TOKENS))
+        parser.add_argument('--epochs', type=int, nargs='+',
+                            default=[1, 3, 5, 10],
+                            help="Epoch counts to try (default: %(default)s)")
+        parser.add_argument('--repeats', type=int, default=3,
+                            help="Inferences per document and setting")
+        parser.add_argument('--agreement', type=float, default=0.9,
+                            help="How similar a vector should be to the best "
+                                 "we can do, for suggesting "
+                                 "HAMLET_INFERENCE_MIN_EPOCHS")
+        parser.add_argument('-o', '--output',
+                            help="Also write the results to this JSON file")
+
+    def get_documents(self, model, options):
+        if options['files']:
+            documents = []
+            for filename in options['files']:
+                with open(filename, 'rb') as f:
+                    documents.append(factory(File(f)).tokens)
+            return [document for document in documents if document]
+
+        rng = np.random.RandomState(0)
+        vocabulary = list(model.wv.vocab)
+        return [[vocabulary[i] for i in
+                 rng.randint(0, len(vocabulary), size=max(options['tokens']))]
+                for _ in range(3)]
+
+    def handle(self, *args, **options):
+        # Anything longer is read as MAX_DOCUMENT_TOKENS.
+        options['tokens'] = sorted({min(tokens, MAX_DOCUMENT_TOKENS)
+                                    for tokens in options['tokens']})
+        model = get_model()
+        documents = self.get_documents(model, options)
+        results = calibrate(model, documents, options['tokens'],
+                            options['epochs'], options['repeats'])
+
+        self.stdout.write('{:>8} {:>7} {:>10} {:>12} {:>10} {:>10}'.format(
+            'tokens', 'epochs', 'seconds', 'cost', 'stability', 'agreement'))
+        for result in results:
+            self.stdout.write(
+                '{:>8} {:>7} {:>10.3f} {:>12.3e} {:>10.3f} {:>10.3f}'.format(
+                    *result))
+
+        longest = max(options['tokens'])
+        costs = [result.cost for result in results if result.tokens == longest]
+        good_enough = [result.epochs for result in results
+                       if result.tokens == longest and
+                       result.agreement >= options['agreement']]
+        self.stdout.write('\nThe model runs {} epochs by default.'.format(
+            model.epochs))
+        self.stdout.write('Suggested settings:')
+        self.stdout.write('HAMLET_INFERENCE_COST = {:.1e}'.format(
+            float(np.median(costs))))
+        if good_enough:
+            self.stdout.write('HAMLET_INFERENCE_MIN_EPOCHS = {}'.format(
+                min(good_enough)))
+        else:
+            self.stdout.write('(No epoch count reached an agreement of {}; '
+                              'try more epochs.)'.format(options['agreement']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'default_epochs': model.epochs,
+                           'results': [result._asdict()
+                                       for result in results]},
+                          f, indent=2)
+            self.stdout.write(self.style.SUCCESS(
+                'Wrote results to {}'.format(options['output'])))
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from hamlet.neural.index import SimilarityIndex
+from hamlet.neural.loading import load_model
+from hamlet.theses.centroids import KINDS, build_centroids
+
+
+class Command(BaseCommand):
+    help = ('Average the document vectors of each author, advisor and '
+            'department and save them beside an exported model')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model_file', nargs='?',
+                            help="Path to the exported model (default: "
+                                 "settings.MODEL_FILE)")
+
+    def handle(self, *args, **options):
+        model_file = options['model_file'] or settings.MODEL_FILE
+        self.stdout.write('Loading {}'.format(model_file))
+        model = load_model(model_file)
+        index = SimilarityIndex.load(model, model_file)
+
+        for kind in KINDS:
+            centroids = build_centroids(index, kind)
+            centroids.save(model_file, kind)
+            self.stdout.write('Saved {} centroids for {}'.format(
+                len(centroids), kind))
+
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from gensim.models.doc2vec import Doc2Vec
+
+from hamlet.neural.ann import IVFIndex
+from hamlet.neural.index import (NEIGHBOUR_COUNT, export_identifiers,
+                                 export_neighbour_table)
+from hamlet.neural.loading import export_model
+from hamlet.neural.quantisation import DTYPES, QuantisedVectors
+
+
+class Command(BaseCommand):
+    help = ('Re-save a trained model so that it can be memory-mapped and '
+            'shared between server processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Path to the trained model")
+        parser.add_argument('destination',
+                            help="Path to write the exported model to; "
+                                 "extra .npy files will be written beside it")
+        parser.add_argument('-n', '--neighbours', type=int,
+                            default=NEIGHBOUR_COUNT,
+                            help="Number of nearest neighbours to precompute "
+                                 "for each thesis (0 to skip)")
+        parser.add_argument('--ann-lists', type=int, default=0,
+                            help="Number of clusters in the approximate "
+                                 "search index (default: square root of the "
+                                 "number of theses; -1 to skip)")
+
+    def handle(self, *args, **options):
+        self.stdout.write('Loading {}'.format(options['source']))
+        model = Doc2Vec.load(options['source'])
+
+        self.stdout.write('Exporting to {}'.format(options['destination']))
+        export_model(model, options['destination'])
+        export_identifiers(model, options['destination'])
+
+        if options['neighbours']:
+            self.stdout.write('Precomputing {} neighbours per thesis'.format(
+                options['neighbours']))
+            export_neighbour_table(model, options['destination'],
+                                   topn=options['neighbours'])
+
+        if options['ann_lists'] >= 0:
+            self.stdout.write('Building approximate search index')
+            ann = IVFIndex.build(model.docvecs.vectors_docs_norm,
+                                 nlist=options['ann_lists'] or None)
+            ann.save(options['destination'])
+
+        for dtype in DTYPES:
+            self.stdout.write('Saving {} copy of vectors'.format(dtype))
+            QuantisedVectors.build(model.docvecs.vectors_docs_norm,
+                                   dtype=dtype).save(options['destination'])
+
+        self.stdout.write(self.style.SUCCESS('Done'))
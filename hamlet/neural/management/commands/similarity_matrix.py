@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from hamlet.neural.index import MATRIX_BLOCK_SIZE, get_index
+from hamlet.neural.matrix import write_matrix
+from hamlet.theses.models import Thesis
+
+
+class Command(BaseCommand):
+    help = ('Write the cosine similarities between every pair of a set of '
+            'theses to a .npy or .csv file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write (.npy or .csv)")
+        parser.add_argument('identifiers', nargs='*', type=int,
+                            help="Identifiers of the theses to compare")
+        parser.add_argument('--file',
+                            help="Read identifiers from this file, one per "
+                                 "line, as well")
+        parser.add_argument('--department', type=int,
+                            help="Compare every thesis in the department "
+                                 "with this pk, as well")
+        parser.add_argument('--block-size', type=int,
+                            default=MATRIX_BLOCK_SIZE,
+                            help="Rows of the matrix to compute at a time")
+
+    def handle(self, *args, **options):
+        identifiers = list(options['identifiers'])
+        if options['file']:
+            with open(options['file']) as f:
+                identifiers += [int(line) for line in f if line.strip()]
+        if options['department'] is not None:
+            identifiers += Thesis.objects.filter(
+                department=options['department'], unextractable=False
+            ).values_list('identifier', flat=True)
+
+        # Dedupe, but keep the order we were given.
+        identifiers = list(dict.fromkeys(identifiers))
+        index = get_index()
+        missing = [x for x in identifiers if x not in index]
+        if missing:
+            self.stdout.write(self.style.WARNING(
+                'Skipping {} theses not in the model: {}'.format(
+                    len(missing), ', '.join(map(str, missing)))))
+            identifiers = [x for x in identifiers if x in index]
+        if not identifiers:
+            raise CommandError('No theses to compare')
+
+        try:
+            write_matrix(index, identifiers, options['output'],
+                         block_size=options['block_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote {n}x{n} matrix to {output}'.format(
+                n=len(identifiers), output=options['output'])))
@@ -0,0 +1,51 @@
+"""Writing similarity matrices (see SimilarityIndex.similarity_matrix) to
+files, for analysis elsewhere."""
+import csv
+import io
+
+import numpy as np
+
+from .index import MATRIX_BLOCK_SIZE
+
+
+def iter_csv(index, identifiers, block_size=MATRIX_BLOCK_SIZE):
+    """Yield the similarity matrix for identifiers as lines of CSV: a header
+    row of identifiers, then one row per identifier, starting with the
+    identifier itself."""
+    identifiers = list(identifiers)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow([''] + list(identifiers))
+    yield flush()
+
+    rows = index.rows_for(identifiers)
+    for start, block in index.similarity_blocks(rows, block_size):
+        for identifier, sims in zip(identifiers[start:], block):
+            writer.writerow([identifier] + ['{:.4f}'.format(x) for x in sims])
+        yield flush()
+
+
+def write_matrix(index, identifiers, path, block_size=MATRIX_BLOCK_SIZE):
+    """Write the similarity matrix for identifiers to path, as .npy or .csv
+    depending on its extension. Matrices are written a block at a time, so
+    they needn't fit in memory."""
+    if path.endswith('.npy'):
+        out = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.float32,
+            shape=(len(identifiers), len(identifiers)))
+        index.similarity_matrix(identifiers, out=out, block_size=block_size)
+        out.flush()
+    elif path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            for chunk in iter_csv(index, identifiers, block_size):
+                f.write(chunk)
+    else:
+        raise ValueError('Can only write .npy or .csv files, not '
+                         '{}'.format(path))
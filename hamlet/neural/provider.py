@@ -0,0 +1,163 @@
+"""Access to the model the site serves.
+
+Loading a model is slow, and most processes that import the settings (migrate,
+collectstatic, other management commands) never use it, so it is loaded the
+first time something asks for it with get_model(), not when the settings are
+read. Servers call warm_model() as each worker starts (see gunicorn.conf.py),
+so that no visitor has to wait for the load.
+
+Which model to serve is normally fixed by settings.MODEL_FILE. If
+settings.HAMLET_MODEL_POINTER is set, it instead names a small text file
+holding the path of the model to serve (relative paths are relative to the
+pointer), and new models can be rolled out by pointing it elsewhere (see the
+activate_model management command) without restarting anything. Each process
+rereads the pointer at most every settings.HAMLET_MODEL_CHECK_INTERVAL
+seconds; when it changes, the new model and its search index are loaded in a
+background thread while the old one carries on serving, and then swapped in
+in one step. Requests that started before the swap keep using the old model
+until they finish (see PinModelMiddleware)."""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from hamlet.common.threads import start_background
+
+from .index import SimilarityIndex
+from .loading import load_model
+
+logger = logging.getLogger(__name__)
+
+
+class ServedModel(object):
+    """A model, the file it came from, and its similarity index."""
+    def __init__(self, model_file):
+        self.model_file = model_file
+        self.model = load_model(model_file)
+        self.index = SimilarityIndex.load(self.model, model_file)
+
+
+_served = None
+_lock = threading.Lock()
+_local = threading.local()
+
+# State for noticing a new model.
+_next_check = 0
+_loader = None
+_failed_file = None
+
+
+def current_model_file():
+    """Return the path of the model that should be served right now."""
+    pointer = settings.HAMLET_MODEL_POINTER
+    if not pointer:
+        return settings.MODEL_FILE
+
+    with open(pointer, 'r') as f:
+        target = f.read().strip()
+    return os.path.join(os.path.dirname(os.path.abspath(pointer)), target)
+
+
+def _load_in_background(model_file):
+    global _served, _failed_file, _loader
+    try:
+        started = time.time()
+        served = ServedModel(model_file)
+        # A single assignment, so every request sees either the old model or
+        # the new one, never a mixture.
+        _served = served
+        logger.info('Now serving %s (loaded in %.1fs)', model_file,
+                    time.time() - started)
+    except Exception:
+        logger.exception('Could not load %s; still serving %s', model_file,
+                         _served.model_file)
+        _failed_file = model_file
+    finally:
+        # _check_for_new_model holds the lock until it has recorded this
+        # loader, so this can't happen before that, however fast the load.
+        with _lock:
+            _loader = None
+
+
+def _check_for_new_model():
+    global _next_check, _loader
+    now = time.monotonic()
+    if _loader is not None or now < _next_check:
+        return
+    _next_check = now + settings.HAMLET_MODEL_CHECK_INTERVAL
+
+    try:
+        model_file = current_model_file()
+    except IOError:
+        logger.warning('Could not read the model pointer %s',
+                       settings.HAMLET_MODEL_POINTER)
+        return
+
+    if model_file in (_served.model_file, _failed_file):
+        return
+
+    with _lock:
+        if _loader is not None:
+            return
+        logger.info('Loading %s to replace %s', model_file,
+                    _served.model_file)
+        # On an OS thread even under gevent, or the load would hold up every
+        # request this worker is serving.
+        _loader = start_background(_load_in_background, model_file)
+
+
+def get_served():
+    """Return the ServedModel for this request."""
+    global _served
+    if _served is None:
+        with _lock:
+            # Someone else may have loaded it while we waited for the lock.
+            if _served is None:
+                _served = ServedModel(current_model_file())
+    elif settings.HAMLET_MODEL_POINTER:
+        _check_for_new_model()
+
+    pinned = getattr(_local, 'served', None)
+    if pinned is not None:
+        return pinned
+
+    served = _served
+    if getattr(_local, 'pin', False):
+        _local.served = served
+    return served
+
+
+def get_model():
+    """Return the model being served, loading it if need be."""
+    return get_served().model
+
+
+def warm_model():
+    """Load the model and everything needed to search it now, rather than on
+    the first request."""
+    get_served()
+
+
+@contextmanager
+def pin_model():
+    """Within this block, once this thread has used a model, keep using that
+    one even if a new one is swapped in."""
+    previous = (getattr(_local, 'pin', False), getattr(_local, 'served', None))
+    _local.pin, _local.served = True, None
+    try:
+        yield
+    finally:
+        _local.pin, _local.served = previous
+
+
+class PinModelMiddleware(object):
+    """Serve each request from start to finish with the same model."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pin_model():
+            return self.get_response(request)
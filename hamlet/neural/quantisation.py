@@ -0,0 +1,98 @@
+"""Compact copies of the document vectors for similarity search.
+
+Serving only needs cosine similarities, and those don't need full float32
+precision to tell which documents are close. We keep a float16 or int8 copy of
+the unit-normalised vectors for scanning, shortlist the best few candidates
+from it, and compute their exact similarities from the float32 vectors (which
+stay memory-mapped on disk, so only the shortlisted rows are ever read).
+
+int8 codes use a separate scale for each dimension, so that dimensions with a
+small range don't lose all their precision."""
+import os
+
+import numpy as np
+
+from .loading import sidecar_path
+
+DTYPES = ('float16', 'int8')
+
+# Scanning converts the codes to float32 this many rows at a time, which
+# bounds the scratch memory a query needs.
+CHUNK_SIZE = 16384
+
+
+class QuantisedVectors(object):
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def dtype(self):
+        return self.codes.dtype.name
+
+    @classmethod
+    def build(cls, vectors, dtype='int8'):
+        if dtype == 'float16':
+            return cls(np.asarray(vectors, dtype=np.float16))
+        elif dtype == 'int8':
+            scales = (np.abs(vectors).max(axis=0) / 127).astype(np.float32)
+            scales[scales == 0] = 1
+            codes = np.round(vectors / scales).astype(np.int8)
+            return cls(codes, scales)
+        else:
+            raise ValueError('Unknown dtype {}; options are {}'.format(
+                dtype, ', '.join(DTYPES)))
+
+    def save(self, model_file):
+        name = 'vectors_' + self.dtype
+        np.save(sidecar_path(model_file, name), self.codes)
+        if self.scales is not None:
+            np.save(sidecar_path(model_file, name + '_scales'), self.scales)
+
+    @classmethod
+    def load(cls, model_file, dtype):
+        """Load the vectors of the given dtype saved beside model_file, or
+        return None if there aren't any."""
+        name = 'vectors_' + dtype
+        codes_path = sidecar_path(model_file, name)
+        if not os.path.exists(codes_path):
+            return None
+
+        codes = np.load(codes_path, mmap_mode='r')
+        scales = None
+        if dtype == 'int8':
+            scales = np.load(sidecar_path(model_file, name + '_scales'))
+        return cls(codes, scales)
+
+    def similarities(self, query, rows=None):
+        """Approximate the similarities between the unit vector query and the
+        given rows (all rows, if rows is None)."""
+        if self.scales is not None:
+            # (codes * scales) . query == codes . (scales * query)
+            query = query * self.scales
+        query = query.astype(np.float32)
+
+        codes = self.codes if rows is None else self.codes[rows]
+        sims = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), CHUNK_SIZE):
+            stop = start + CHUNK_SIZE
+            sims[start:stop] = np.dot(
+                codes[start:stop].astype(np.float32), query)
+        return sims
+
+    def shortlist(self, query, size, rows=None, exclude=()):
+        """Return the (approximately) size rows most similar to query, in no
+        particular order, choosing from rows (or all rows if it is None) and
+        skipping anything in exclude."""
+        if rows is None:
+            rows = np.arange(len(self))
+        if len(exclude):
+            rows = rows[~np.isin(rows, exclude)]
+        if len(rows) <= size:
+            return rows
+
+        sims = self.similarities(query, rows)
+        return rows[np.argpartition(-sims, size - 1)[:size]]
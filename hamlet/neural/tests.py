@@ -0,0 +1,529 @@
+import glob
+import os
+import shutil
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+import numpy as np
+
+from . import provider
+from .ann import IVFIndex
+from .benchmark import benchmark_size
+from .centroids import Centroids
+from . import inference
+from .index import (SimilarityIndex, build_neighbour_table, get_index,
+                    identifiers_from_model, top_neighbours)
+from .matrix import write_matrix
+from .quantisation import QuantisedVectors
+from .tokens import iter_tokens, tokenize, tokenize_many
+
+
+def random_unit_vectors(count, size=52, seed=0):
+    vectors = np.random.RandomState(seed).randn(count, size).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+
+def exact_nearest(vectors, row, topn):
+    sims = np.dot(vectors, vectors[row])
+    sims[row] = -np.inf
+    return np.argsort(-sims)[:topn]
+
+
+def fake_model(vectors):
+    # Just enough of a Doc2Vec for SimilarityIndex.
+    docvecs = SimpleNamespace(init_sims=lambda: None,
+                              vectors_docs_norm=vectors)
+    return SimpleNamespace(docvecs=docvecs)
+
+
+def fake_identifiers(count):
+    # Deliberately not in row order.
+    return (np.arange(count, dtype=np.int64) * 7919) % 100003 + 1000
+
+
+class NeighbourTableTestCase(SimpleTestCase):
+    def test_matches_brute_force(self):
+        vectors = random_unit_vectors(300)
+        neighbours, scores = build_neighbour_table(vectors, topn=10,
+                                                   batch_size=64)
+
+        for row in (0, 63, 64, 299):
+            sims = np.dot(vectors, vectors[row])
+            sims[row] = -np.inf
+            expected = np.argsort(-sims)[:10]
+            assert list(neighbours[row]) == list(expected)
+            assert np.allclose(scores[row], sims[expected])
+
+    def test_excludes_self(self):
+        vectors = random_unit_vectors(50)
+        neighbours, _ = build_neighbour_table(vectors, topn=5)
+        for row in range(50):
+            assert row not in neighbours[row]
+
+    def test_selected_rows(self):
+        vectors = random_unit_vectors(300)
+        neighbours, _ = top_neighbours(vectors, [5, 250, 17], topn=10,
+                                       batch_size=2)
+        for i, row in enumerate([5, 250, 17]):
+            assert list(neighbours[i]) == list(
+                exact_nearest(vectors, row, 10))
+
+    def test_topn_larger_than_corpus(self):
+        vectors = random_unit_vectors(5)
+        neighbours, scores = build_neighbour_table(vectors, topn=50)
+        assert neighbours.shape == (5, 4)
+        assert scores.shape == (5, 4)
+
+
+class IVFIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.vectors = random_unit_vectors(400)
+        self.ivf = IVFIndex.build(self.vectors, nlist=20)
+
+    def test_every_row_filed_once(self):
+        assert len(self.ivf) == 20
+        assert sorted(self.ivf.rows) == list(range(400))
+        assert self.ivf.offsets[0] == 0
+        assert self.ivf.offsets[-1] == 400
+
+    def test_probing_everything_proposes_everything(self):
+        candidates = self.ivf.candidates(self.vectors[0], nprobe=20)
+        assert sorted(candidates) == list(range(400))
+
+    def test_probing_less_scans_less(self):
+        candidates = self.ivf.candidates(self.vectors[0], nprobe=2)
+        assert 0 < len(candidates) < 400
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_file = os.path.join(tmpdir, 'test.model')
+            assert IVFIndex.load(model_file) is None
+
+            self.ivf.save(model_file)
+            loaded = IVFIndex.load(model_file)
+            assert np.array_equal(loaded.centroids, self.ivf.centroids)
+            assert np.array_equal(loaded.rows, self.ivf.rows)
+
+
+class QuantisedVectorsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.vectors = random_unit_vectors(400)
+
+    def test_similarities_are_close(self):
+        exact = np.dot(self.vectors, self.vectors[3])
+        for dtype in ('int8', 'float16'):
+            quantised = QuantisedVectors.build(self.vectors, dtype=dtype)
+            approx = quantised.similarities(self.vectors[3])
+            assert np.abs(approx - exact).max() < 0.05
+
+    def test_int8_is_a_quarter_of_the_size(self):
+        quantised = QuantisedVectors.build(self.vectors, dtype='int8')
+        assert quantised.codes.nbytes * 4 == self.vectors.nbytes
+
+    def test_shortlist_respects_rows_and_exclude(self):
+        quantised = QuantisedVectors.build(self.vectors)
+        rows = np.arange(100, 200)
+        shortlist = quantised.shortlist(self.vectors[150], 10, rows=rows,
+                                        exclude=[150])
+        assert len(shortlist) == 10
+        assert 150 not in shortlist
+        assert all(100 <= row < 200 for row in shortlist)
+
+    def test_save_and_load(self):
+        quantised = QuantisedVectors.build(self.vectors)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_file = os.path.join(tmpdir, 'test.model')
+            assert QuantisedVectors.load(model_file, 'int8') is None
+
+            quantised.save(model_file)
+            loaded = QuantisedVectors.load(model_file, 'int8')
+            assert np.array_equal(loaded.codes, quantised.codes)
+            assert np.array_equal(loaded.scales, quantised.scales)
+
+
+class SimilarityIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.vectors = random_unit_vectors(400)
+        self.model = fake_model(self.vectors)
+        self.identifiers = fake_identifiers(400)
+
+    def assert_exact(self, index, nprobe=0):
+        for row in (0, 199, 399):
+            rows, sims = index.nearest(self.vectors[row], 10, exclude=[row],
+                                       nprobe=nprobe)
+            expected = exact_nearest(self.vectors, row, 10)
+            assert list(rows) == list(expected)
+            assert np.allclose(sims, np.dot(self.vectors[expected],
+                                            self.vectors[row]))
+
+    def test_exhaustive(self):
+        self.assert_exact(SimilarityIndex(self.model, self.identifiers))
+
+    def test_quantised_results_are_exact(self):
+        for dtype in ('int8', 'float16'):
+            quantised = QuantisedVectors.build(self.vectors, dtype=dtype)
+            self.assert_exact(SimilarityIndex(self.model, self.identifiers,
+                                              quantised=quantised))
+
+    def test_probing_everything_is_exact(self):
+        ann = IVFIndex.build(self.vectors, nlist=20)
+        self.assert_exact(SimilarityIndex(self.model, self.identifiers,
+                                          ann=ann), nprobe=20)
+
+    def test_approximate_index_falls_back_to_exhaustive(self):
+        ann = IVFIndex.build(self.vectors, nlist=20)
+        index = SimilarityIndex(self.model, self.identifiers, ann=ann)
+        rows, _ = index.nearest(self.vectors[0], 300, exclude=[0], nprobe=1)
+        assert len(rows) == 300
+
+    def test_searching_a_subset(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        rows = np.arange(0, 400, 3)
+        for dtype in (None, 'int8'):
+            if dtype:
+                index.quantised = QuantisedVectors.build(self.vectors, dtype)
+            found, sims = index.nearest(self.vectors[9], 5, exclude=[9],
+                                        rows=rows)
+            sims_in_subset = np.dot(self.vectors[rows], self.vectors[9])
+            sims_in_subset[rows == 9] = -np.inf
+            assert list(found) == list(rows[np.argsort(-sims_in_subset)[:5]])
+
+    def test_similarity_matrix(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        rows = [5, 300, 17, 42, 99]
+        matrix = index.similarity_matrix(self.identifiers[rows],
+                                         block_size=2)
+        expected = np.dot(self.vectors[rows], self.vectors[rows].T)
+        assert matrix.shape == (5, 5)
+        assert np.allclose(matrix, expected)
+
+        with self.assertRaises(KeyError):
+            index.similarity_matrix([self.identifiers[0], 999])
+
+    def test_write_matrix(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        identifiers = list(self.identifiers[[3, 1, 4]])
+        expected = index.similarity_matrix(identifiers)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'matrix.npy')
+            write_matrix(index, identifiers, path, block_size=2)
+            assert np.allclose(np.load(path), expected)
+
+            path = os.path.join(tmpdir, 'matrix.csv')
+            write_matrix(index, identifiers, path, block_size=2)
+            with open(path) as f:
+                lines = [line.split(',') for line in f.read().splitlines()]
+            assert [int(x) for x in lines[0][1:]] == identifiers
+            assert [int(line[0]) for line in lines[1:]] == identifiers
+            assert np.allclose([[float(x) for x in line[1:]]
+                                for line in lines[1:]], expected, atol=1e-4)
+
+    def test_rows_for(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        rows = index.rows_for([self.identifiers[7], 999, self.identifiers[3]])
+        assert list(rows) == [7, -1, 3]
+
+    def test_rows_and_identifiers(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        for row in (0, 1, 250, 399):
+            assert index.row(self.identifiers[row]) == row
+
+        with self.assertRaises(KeyError):
+            index.row(999)
+        with self.assertRaises(KeyError):
+            index.row(10 ** 9)
+
+    def test_most_similar_returns_identifiers(self):
+        index = SimilarityIndex(self.model, self.identifiers)
+        results = index.most_similar(self.identifiers[5], topn=10, nprobe=0)
+        expected = exact_nearest(self.vectors, 5, 10)
+        assert [identifier for identifier, _ in results] == list(
+            self.identifiers[expected])
+
+    def test_identifiers_from_model(self):
+        class DocVecs(list):
+            index_to_doctag = list.__getitem__
+
+        labels = ['1721.1-{}.txt'.format(i) for i in (17, 4, 12345)]
+        model = SimpleNamespace(docvecs=DocVecs(labels))
+        assert list(identifiers_from_model(model)) == [17, 4, 12345]
+
+
+class ProviderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.served = provider._served
+        self.tmpdir = tempfile.mkdtemp()
+        # Two copies of the test model, so there is something to switch to.
+        for name in ('one', 'two'):
+            os.mkdir(os.path.join(self.tmpdir, name))
+            for path in glob.glob(settings.MODEL_FILE + '*'):
+                shutil.copy(path, os.path.join(self.tmpdir, name))
+        self.pointer = os.path.join(self.tmpdir, 'current')
+
+    def tearDown(self):
+        provider._served = self.served
+        provider._next_check = 0
+        shutil.rmtree(self.tmpdir)
+
+    def model_file(self, name):
+        return os.path.join(self.tmpdir, name,
+                            os.path.basename(settings.MODEL_FILE))
+
+    def wait_for_loader(self):
+        loader = provider._loader
+        if loader is not None:
+            loader.join()
+
+    def activate(self, name):
+        call_command('activate_model', self.model_file(name),
+                     stdout=open(os.devnull, 'w'))
+        provider._next_check = 0
+
+    def test_swaps_to_new_model(self):
+        with override_settings(HAMLET_MODEL_POINTER=self.pointer):
+            self.activate('one')
+            provider._served = None
+            first = provider.get_served()
+            assert first.model_file == self.model_file('one')
+
+            # The old model carries on serving while the new one loads.
+            loaded = threading.Event()
+            load = provider.ServedModel
+
+            def slow_load(model_file):
+                loaded.wait()
+                return load(model_file)
+
+            with patch.object(provider, 'ServedModel', side_effect=slow_load):
+                self.activate('two')
+                assert provider.get_served() is first
+                loaded.set()
+                self.wait_for_loader()
+
+            second = provider.get_served()
+            assert second.model_file == self.model_file('two')
+            assert get_index() is second.index
+
+    def test_requests_keep_their_model(self):
+        with override_settings(HAMLET_MODEL_POINTER=self.pointer):
+            self.activate('one')
+            provider._served = None
+
+            with provider.pin_model():
+                first = provider.get_served()
+                self.activate('two')
+                provider.get_served()
+                self.wait_for_loader()
+                assert provider.get_served() is first
+
+            assert provider.get_served() is not first
+
+    def test_loads_on_os_thread_under_gevent(self):
+        # gevent turns threading.Thread into a greenlet, which would stall
+        # the worker for the whole load; its threadpool is a real thread.
+        class FakePool(object):
+            def spawn(self, func, *args):
+                thread = threading.Thread(target=func, args=args)
+                thread.start()
+                return SimpleNamespace(wait=thread.join)
+
+        pool = FakePool()
+        with override_settings(HAMLET_MODEL_POINTER=self.pointer), \
+                patch('hamlet.common.threads.gevent_threads',
+                      return_value=True), \
+                patch('hamlet.common.threads._gevent_threadpool',
+                      return_value=pool), \
+                patch.object(pool, 'spawn', wraps=pool.spawn) as spawn:
+            self.activate('one')
+            provider._served = None
+            provider.get_served()
+            self.activate('two')
+            provider.get_served()
+            self.wait_for_loader()
+            assert spawn.called
+            assert provider.get_served().model_file == self.model_file('two')
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_benchmark_size(self):
+        results = benchmark_size(500, size=16, queries=5, nprobe=2)
+        assert results['documents'] == 500
+        for name in ('most_similar_table', 'most_similar_exact',
+                     'most_similar_to_vector_ivf_int8', 'similarity'):
+            assert results['ms'][name]['runs'] == 5
+            assert results['ms'][name]['median_ms'] >= 0
+
+
+class TokensTestCase(SimpleTestCase):
+    def test_tokenize(self):
+        text = "Dr. Smith's  thesis (2005) covered fluids, etc.; did it?!"
+        # Like WordPunctTokenizer, with single punctuation marks dropped
+        # (but not every run of them, as before).
+        assert tokenize(text) == ['dr', 'smith', 's', 'thesis', '2005',
+                                  'covered', 'fluids', 'etc', '.;', 'did',
+                                  'it', '?!']
+        assert list(iter_tokens(text)) == tokenize(text)
+
+    def test_punctuation_runs(self):
+        # Runs are only dropped if they're in string.punctuation as they
+        # stand.
+        assert tokenize('f() g), h...') == ['f', 'g', '),', 'h', '...']
+
+    def test_tokenize_unicode(self):
+        assert tokenize('Über naïve café') == ['über', 'naïve', 'café']
+
+    def test_tokenize_many(self):
+        texts = ['One two.', 'Three, four!', '']
+        expected = [['one', 'two'], ['three', 'four'], []]
+        assert list(tokenize_many(texts)) == expected
+        assert list(tokenize_many(texts, processes=2)) == expected
+
+    def test_tokenize_many_reads_ahead_a_batch_at_most(self):
+        read = []
+
+        def texts():
+            for i in range(100):
+                read.append(i)
+                yield 'Text {}'.format(i)
+
+        tokens = tokenize_many(texts(), processes=2, chunksize=2, batches=1)
+        assert next(tokens) == ['text', '0']
+        # This batch and the next, of four texts each.
+        assert len(read) == 8
+        assert list(tokens)[-1] == ['text', '99']
+
+
+class InferenceTestCase(SimpleTestCase):
+    def setUp(self):
+        inference.reset_cost()
+        self.addCleanup(inference.reset_cost)
+
+    def test_plan_within_budget(self):
+        plan = inference.plan_inference(1000, 20, budget=1, cost=1e-6,
+                                         min_epochs=3)
+        assert plan == inference.InferencePlan(20, 1000, 1000)
+
+    def test_plan_cuts_epochs_first(self):
+        plan = inference.plan_inference(5000, 20, budget=1, cost=2e-5,
+                                         min_epochs=3)
+        assert plan == inference.InferencePlan(10, 5000, 5000)
+
+    def test_plan_then_samples_tokens(self):
+        plan = inference.plan_inference(5000, 20, budget=1, cost=2e-4,
+                                         min_epochs=3)
+        assert plan == inference.InferencePlan(3, 1666, 5000)
+
+    def test_plan_only_counts_tokens_inference_reads(self):
+        # Only the first MAX_DOCUMENT_TOKENS would be read, so only they
+        # count towards the budget.
+        plan = inference.plan_inference(1000000, 20, budget=1, cost=1e-6,
+                                         min_epochs=3)
+        assert plan == inference.InferencePlan(
+            20, inference.MAX_DOCUMENT_TOKENS, 1000000)
+        plan = inference.plan_inference(1000000, 20, budget=1, cost=1e-5,
+                                         min_epochs=3)
+        assert plan == inference.InferencePlan(
+            10, inference.MAX_DOCUMENT_TOKENS, 1000000)
+
+    def test_sample_tokens(self):
+        words = list(range(10000))
+        sample = inference.sample_tokens(words, 1000)
+        assert len(sample) == 1000
+        assert sample == sorted(sample)
+        assert sample[0] == 0 and sample[-1] == 9999
+        assert inference.sample_tokens(words[:10], 1000) == words[:10]
+
+    def test_samples_no_more_than_inference_reads(self):
+        words = list(range(100000))
+        for count in (inference.MAX_DOCUMENT_TOKENS, len(words)):
+            sample = inference.sample_tokens(words, count)
+            assert len(sample) == inference.MAX_DOCUMENT_TOKENS
+            assert sample == sorted(sample)
+            # From start to finish, not just the start.
+            assert sample[0] == 0 and sample[-1] == 99999
+
+    @override_settings(HAMLET_INFERENCE_BUDGET=1,
+                       HAMLET_INFERENCE_MIN_EPOCHS=3,
+                       HAMLET_INFERENCE_COST=1e-4)
+    def test_infer_within_budget(self):
+        calls = []
+
+        def infer_vector(words, epochs=None):
+            calls.append((len(words), epochs))
+            return np.zeros(4)
+
+        model = SimpleNamespace(epochs=20, infer_vector=infer_vector)
+        vector, plan = inference.infer_within_budget(model, ['a'] * 1000000)
+        assert calls == [(3333, 3)]
+        assert plan == inference.InferencePlan(3, 3333, 1000000)
+
+        # The time it actually took now guides the next plan.
+        assert inference.get_cost() != 1e-4
+
+        with override_settings(HAMLET_INFERENCE_BUDGET=None):
+            inference.infer_within_budget(model, ['a'] * 1000000)
+        assert calls[-1] == (inference.MAX_DOCUMENT_TOKENS, 20)
+
+    @override_settings(HAMLET_INFERENCE_BUDGET=None)
+    def test_long_uploads_are_sampled_throughout(self):
+        # Uploads keep more tokens than inference reads, so that it can read
+        # some from all over them.
+        assert (settings.HAMLET_UPLOAD_TOKEN_LIMIT >
+                inference.MAX_DOCUMENT_TOKENS)
+        read = []
+        model = SimpleNamespace(
+            epochs=20, infer_vector=lambda words, epochs: read.extend(words))
+        words = list(range(settings.HAMLET_UPLOAD_TOKEN_LIMIT))
+        inference.infer_within_budget(model, words)
+        assert len(read) == inference.MAX_DOCUMENT_TOKENS
+        assert read[-1] == words[-1]
+
+    def test_cost_is_per_token_read(self):
+        plan = inference.InferencePlan(
+            10, inference.MAX_DOCUMENT_TOKENS, 1000000)
+        inference.record_cost(1.0, plan)
+        assert abs(inference.get_cost() - 1e-5) < 1e-12
+
+
+class CentroidsTestCase(SimpleTestCase):
+    def setUp(self):
+        vectors = random_unit_vectors(30)
+        self.index = SimilarityIndex(fake_model(vectors),
+                                     fake_identifiers(30))
+        # Groups 7 and 3 have five theses each; thesis 99999 isn't in the
+        # model.
+        identifiers = list(self.index.identifiers[:10]) + [99999]
+        keys = [7] * 5 + [3] * 5 + [5]
+        self.centroids = Centroids.build(self.index, identifiers, keys)
+
+    def test_build(self):
+        assert list(self.centroids.keys) == [3, 7]
+        assert list(self.centroids.counts) == [5, 5]
+        mean = self.index.vectors[5:10].mean(axis=0)
+        assert np.allclose(self.centroids.vector(3),
+                           mean / np.linalg.norm(mean), atol=1e-6)
+        assert self.centroids.vector(5) is None
+
+    def test_rank(self):
+        ranked = self.centroids.rank(self.index.vectors[0])
+        assert [key for key, _ in ranked] == [7, 3]
+        assert ranked[0][1] > ranked[1][1]
+        assert self.centroids.rank(self.index.vectors[0], exclude={7}) == \
+            ranked[1:]
+
+    def test_save_and_load(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        model_file = os.path.join(tmpdir, 'hamlet.model')
+        assert Centroids.load(model_file, 'advisors') is None
+
+        self.centroids.save(model_file, 'advisors')
+        loaded = Centroids.load(model_file, 'advisors')
+        assert np.array_equal(loaded.vectors, self.centroids.vectors)
+        assert list(loaded.keys) == [3, 7]
@@ -0,0 +1,64 @@
+"""Turning text into the tokens our models are trained on.
+
+Training and inference must tokenise text the same way, or uploaded
+documents are described in words the model has never seen (or has seen with
+different capitalisation and punctuation attached). Everything that feeds
+text to a model should go through here.
+
+Tokens are lowercased runs of word characters, or runs of punctuation, as
+with NLTK's WordPunctTokenizer, which this replaces. As before, a token is
+dropped if it occurs in string.punctuation as a substring: that is every
+single punctuation mark, but only those runs which happen to be adjacent
+there (like '()' or ':;'), so most runs (like '),' or '...') are kept. Our
+models were trained on tokens filtered that way, so it stays. We used to
+split text into sentences first, but no token can span a sentence boundary,
+so that made no difference to the tokens, only to the time taken."""
+from itertools import islice
+from multiprocessing import Pool
+import re
+from string import punctuation
+
+TOKEN_RE = re.compile(r'\w+|[^\w\s]+')
+
+
+def tokenize(text):
+    """Return the list of tokens in text."""
+    return [token for token in TOKEN_RE.findall(text.lower())
+            if token not in punctuation]
+
+
+def iter_tokens(text):
+    """Yield the tokens in text one at a time."""
+    for match in TOKEN_RE.finditer(text.lower()):
+        token = match.group()
+        if token not in punctuation:
+            yield token
+
+
+def tokenize_many(texts, processes=None, chunksize=8, batches=4):
+    """Yield the list of tokens for each text in texts, in order.
+
+    If processes is more than 1, texts are tokenised in that many worker
+    processes. That pays off for a whole corpus of theses, not for a handful
+    of short documents.
+
+    Pool.imap reads its input and queues up results as fast as the workers
+    go, however slowly they're used, which for a corpus could mean holding
+    most of it in memory. So the workers are given texts a batch (of
+    batches * chunksize per process) at a time, and only work on the next
+    batch while this one is used."""
+    if not processes or processes < 2:
+        for text in texts:
+            yield tokenize(text)
+        return
+
+    texts = iter(texts)
+    size = processes * chunksize * batches
+    with Pool(processes) as pool:
+        batch = list(islice(texts, size))
+        pending = pool.imap(tokenize, batch, chunksize)
+        while batch:
+            batch = list(islice(texts, size))
+            following = pool.imap(tokenize, batch, chunksize)
+            yield from pending
+            pending = following
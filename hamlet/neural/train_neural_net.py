@@ -5,20 +5,21 @@ import os
 import random
 import re
 import shutil
-from string import punctuation
 import time
 import xml.etree.ElementTree as ET
 
 from gensim.models.doc2vec import LabeledSentence, Doc2Vec
-from nltk import sent_tokenize, WordPunctTokenizer
 import requests
 from tika import parser as tikaparser
 
 from django.db.models import Count
 from django.db.utils import DataError
 
+from hamlet.common.page_cache import batched_revisions
 from hamlet.theses.models import Thesis, Contribution, Person
 
+from .tokens import tokenize, tokenize_many
+
 # See https://medium.com/@klintcho/doc2vec-tutorial-using-gensim-ab3ac03d3a1
 
 logger = logging.getLogger(__name__)
@@ -42,28 +43,25 @@ METS_NAMESPACE = {'mets': 'http://www.loc.gov/METS/',
 
 
 class LabeledLineSentence(object):
-    def __init__(self, subdir):
+    def __init__(self, subdir, processes=None):
         doc_list = glob(os.path.join(CUR_DIR, FILES_DIR, subdir, '*'))
 
         self.doc_list = [doc for doc in doc_list if doc.endswith('.txt')]
+        # gensim reads the whole corpus once to build the vocabulary and
+        # again for each training epoch, so it's worth tokenising in several
+        # processes on a big machine.
+        self.processes = processes
 
-    def __iter__(self):
+    def _read(self):
         for filename in self.doc_list:
             with open(filename, 'r') as f:
-                doc = f.read()
-            yield LabeledSentence(words=self._tokenize(doc),
-                                  tags=[os.path.basename(filename)])
+                yield f.read()
 
-    def _tokenize(self, doc):
-        all_tokens = []
-        sentences = sent_tokenize(doc)
-
-        tokenizer = WordPunctTokenizer()
-        for sentence in sentences:
-            words = tokenizer.tokenize(sentence.lower())
-            words = [word for word in words if word not in punctuation]
-            all_tokens.extend(words)
-        return all_tokens
+    def __iter__(self):
+        tokens = tokenize_many(self._read(), self.processes)
+        for filename, words in zip(self.doc_list, tokens):
+            yield LabeledSentence(words=words,
+                                  tags=[os.path.basename(filename)])
 
 
 class MetadataWriter(object):
@@ -349,7 +347,7 @@ class ModelTrainer(object):
     MAIN_FILES_DIR = os.path.join(CUR_DIR, FILES_DIR, 'main')
     STARTING_FILES = os.listdir(MAIN_FILES_DIR)
 
-    def __init__(self, files_subdirs=None):
+    def __init__(self, files_subdirs=None, processes=None):
         # If a list of subdirectory names is passed in, ModelTrainer will
         # split files into those directories and train a model on each.
         # If not, it will train on the entire contents of the main file
@@ -358,6 +356,8 @@ class ModelTrainer(object):
             files_subdirs = ['main']
 
         self.FILES_SUBDIRS = files_subdirs
+        # How many processes to tokenise text in; see LabeledLineSentence.
+        self.processes = processes
 
     def reset_directories(self):
         print('Resetting directories')
@@ -444,7 +444,7 @@ class ModelTrainer(object):
             shutil.copy2(filepath, destination)
 
     def get_iterator(self, subdir):
-        return LabeledLineSentence(subdir)
+        return LabeledLineSentence(subdir, self.processes)
 
     def inner_train_model(self, window, size, iterator, filename,
                           max_vocab_size=None):
@@ -566,7 +566,6 @@ class Evaluator(object):
         self.queryset = self.get_queryset()
         self.tuples = self.choose_tuples()
         self.scores = []
-        self.tokenizer = LabeledLineSentence('fake')  # used only for tokenizer
 
     def get_queryset(self):
         """
@@ -640,7 +639,7 @@ class Evaluator(object):
         with open(filename, 'r') as f:
             doc = f.read()
 
-        return self.tokenizer._tokenize(doc)
+        return tokenize(doc)
 
     def trained_similarities(self, model, a_label, b_label, c_label):
         a_to_b = model.docvecs.similarity(a_label, b_label)
@@ -719,7 +718,10 @@ class Evaluator(object):
 
 def write_metadata(args):
     fetcher = DocFetcher()
-    fetcher.get_network_files(args)
+    # An ingest changes too many theses to invalidate their pages one by
+    # one; invalidate them all once it's done.
+    with batched_revisions():
+        fetcher.get_network_files(args)
 
 
 def train_model(args):
@@ -727,7 +729,7 @@ def train_model(args):
     fn = args['filename']
     subdirs = args['subdir_list']
 
-    mt = ModelTrainer(subdirs)
+    mt = ModelTrainer(subdirs, args.get('processes'))
     mt.train_model(fn, qs)
 
     model_list = os.listdir(os.path.join(CUR_DIR, 'nets'))
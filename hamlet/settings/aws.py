@@ -5,7 +5,6 @@ import sys
 import requests
 
 from .base import *  # noqa
-from gensim.models.doc2vec import Doc2Vec
 
 logger = logging.getLogger(__name__)
 
@@ -72,7 +71,6 @@ COMPRESS_OFFLINE = True
 # MODELS_DIR is an env variable defined in eb as /models.
 MODELS_DIR = os.environ.get('MODELS_DIR')
 MODEL_FILE = os.path.join(MODELS_DIR, 'hamlet.model')
-NEURAL_NET = Doc2Vec.load(MODEL_FILE)
 
 
 # LOGGING CONFIGURATION
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -36,6 +37,7 @@ DJANGO_APPS = [
 HAMLET_APPS = [
     'hamlet.theses',
     'hamlet.citations',
+    'hamlet.neural',
 ]
 
 THIRD_PARTY_APPS = [
@@ -51,6 +53,8 @@ INSTALLED_APPS = THIRD_PARTY_APPS + DJANGO_APPS + HAMLET_APPS
 # -----------------------------------------------------------------------------
 
 MIDDLEWARE = [
+    # First, so that it times everything else.
+    'hamlet.common.metrics.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'hamlet.neural.provider.PinModelMiddleware',
 ]
 
 
@@ -94,6 +99,66 @@ DATABASES = {
 }
 
 
+# CACHE CONFIGURATION
+# -----------------------------------------------------------------------------
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+# The local-memory backend evicts least-recently-used entries once it holds
+# MAX_ENTRIES. Servers can point these at a shared backend (e.g. file-based or
+# memcached) to share entries between processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Results of similarity searches (see hamlet.neural.index). Keys include
+    # the model fingerprint, so entries never go stale; they just stop being
+    # asked for when the model changes, and age out.
+    'similarity': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'similarity',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+    # Vectors inferred from uploaded documents (see
+    # hamlet.common.inferred_vectors), keyed by the document's text and the
+    # model fingerprint. Entries are a few KB each.
+    'inference': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'inference',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+    # Status of background upload jobs (see hamlet.common.jobs). This has to
+    # be visible to every server process, so it lives on disk; on a
+    # multi-machine deployment, point it at a shared cache instead.
+    'jobs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'hamlet-jobs'),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+    # Rendered similarity pages and fragments of them (see
+    # hamlet.common.page_cache). Keys include the model fingerprint and the
+    # revisions of the metadata shown, which are kept here too, so entries
+    # never go stale. Shared between processes for the same reasons as
+    # 'jobs'.
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'hamlet-pages'),
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
+
 # GENERAL CONFIGURATION
 # -----------------------------------------------------------------------------
 
@@ -153,6 +218,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'hamlet.common.page_cache.page_cache',
             ],
         },
     },
@@ -248,3 +314,78 @@ INSTALLED_APPS += (
     'health_check.cache',
     'health_check.storage',
 )
+
+
+# HAMLET CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# A file holding the path of the model to serve, which can be changed while
+# the site is running to switch to a new model (see hamlet.neural.provider and
+# the activate_model management command). If unset, MODEL_FILE is served.
+HAMLET_MODEL_POINTER = os.environ.get('DJANGO_MODEL_POINTER')
+
+# How often, in seconds, each server process checks the pointer for a new
+# model.
+HAMLET_MODEL_CHECK_INTERVAL = 30
+
+# How many clusters of the approximate nearest-neighbour index to search for
+# each query (see hamlet.neural.ann). Higher values are slower but find more of
+# the true nearest neighbours; 0 always searches the whole corpus exactly.
+HAMLET_ANN_NPROBE = 16
+
+# Which compact copy of the document vectors to scan when searching for
+# similar theses: 'int8' (a quarter of the memory of the full vectors),
+# 'float16' (half), or 'float32' to scan the full vectors. The top candidates
+# are always re-ranked with the full vectors, so results are the same; see
+# hamlet.neural.quantisation.
+HAMLET_VECTOR_DTYPE = 'int8'
+
+# How long, in seconds, to keep the thesis metadata used to filter similarity
+# searches (see hamlet.theses.filters) before reading it again.
+HAMLET_PARTITION_TTL = 60 * 60
+
+# The cache (from CACHES) for similarity search results.
+HAMLET_SIMILARITY_CACHE = 'similarity'
+
+# The cache (from CACHES) for vectors inferred from uploaded documents.
+HAMLET_INFERENCE_CACHE = 'inference'
+
+# Only the first this-many tokens of an uploaded document are read. Inference
+# itself reads at most 10,000 (see hamlet.neural.inference), sampled evenly
+# from all the tokens we have; the rest are here so that the sample can come
+# from the whole of a typical thesis rather than its first few chapters. Past
+# a hundred thousand tokens, reading on costs more than it tells us.
+HAMLET_UPLOAD_TOKEN_LIMIT = 100000
+
+# Roughly how long, in seconds, inferring a vector for an uploaded document may
+# take (None for no limit). Long documents get fewer training epochs, but no
+# fewer than HAMLET_INFERENCE_MIN_EPOCHS, and then only part of them is read.
+# HAMLET_INFERENCE_COST is the seconds per token per epoch to assume until
+# we've timed some inference; see hamlet.neural.inference, and the
+# calibrate_inference management command for measuring these on your hardware.
+HAMLET_INFERENCE_BUDGET = 5.0
+HAMLET_INFERENCE_MIN_EPOCHS = 3
+HAMLET_INFERENCE_COST = 2e-6
+
+# If True, similarity searches for uploaded documents run as background jobs
+# (see hamlet.common.jobs) and the browser polls until they're done, instead of
+# holding a server worker for the whole search.
+HAMLET_ASYNC_UPLOADS = False
+
+# How many upload jobs each server process runs at once, and how many it will
+# accept (running or waiting) before asking users to try again later.
+HAMLET_UPLOAD_WORKERS = 2
+HAMLET_UPLOAD_QUEUE_SIZE = 8
+
+# The cache (from CACHES) for the status of upload jobs.
+HAMLET_JOB_CACHE = 'jobs'
+
+# The cache (from CACHES) for rendered similarity pages.
+HAMLET_PAGE_CACHE = 'pages'
+
+# Who may see /metrics/ (see hamlet.common.metrics): requests from these
+# addresses, and, if DJANGO_METRICS_TOKEN is set, requests with the header
+# "Authorization: Bearer <token>". Everyone else gets a 404. Behind a proxy or
+# load balancer every request seems to come from the proxy, so use the token.
+HAMLET_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+HAMLET_METRICS_TOKEN = os.environ.get('DJANGO_METRICS_TOKEN')
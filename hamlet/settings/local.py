@@ -1,5 +1,4 @@
 # This file is designed for use with `heroku local`.
-from gensim.models.doc2vec import Doc2Vec
 import os
 
 from .heroku import *  # noqa
@@ -23,8 +22,6 @@ if modelpath:
 else:
     MODEL_FILE = os.path.join(PROJECT_DIR, 'testmodels', 'testmodel.model')
 
-NEURAL_NET = Doc2Vec.load(MODEL_FILE)
-
 # The string "PASSED" will pass any captcha.
 # Don't use this in production!
 # http://django-simple-captcha.readthedocs.io/en/latest/advanced.html#captcha-test-mode
@@ -1,4 +1,3 @@
-from gensim.models.doc2vec import Doc2Vec
 import os
 
 from .base import *
@@ -8,5 +7,10 @@ from .base import *
 #   * contain everything we need to run the tests
 MODEL_FILE = os.path.join(PROJECT_DIR, 'testmodels', 'testmodel.model')
 
-NEURAL_NET = Doc2Vec.load(MODEL_FILE)
 CAPTCHA_TEST_MODE = True
+
+# Keep the tests' pages out of the development server's cache.
+CACHES['pages'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'pages',
+}
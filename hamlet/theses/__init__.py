@@ -0,0 +1 @@
+default_app_config = 'hamlet.theses.apps.ThesesConfig'
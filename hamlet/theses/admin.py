@@ -1,8 +1,30 @@
 from django.contrib import admin
+from django.http import StreamingHttpResponse
+
+from hamlet.neural.index import get_index
+from hamlet.neural.matrix import iter_csv
 
 from .models import Thesis, Person, Department, Contribution
 
 
+def download_similarity_matrix(modeladmin, request, queryset):
+    """Download the similarities between every pair of the selected theses
+    as CSV. Theses which aren't in the neural net are left out."""
+    index = get_index()
+    theses = queryset.distinct().order_by('identifier')
+    identifiers = [x for x in theses.values_list('identifier', flat=True)
+                   if x in index]
+    response = StreamingHttpResponse(iter_csv(index, identifiers),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = \
+        'attachment; filename="similarity_matrix.csv"'
+    return response
+
+
+download_similarity_matrix.short_description = \
+    'Download similarity matrix (CSV)'
+
+
 class ContributionInline(admin.TabularInline):
     model = Contribution
     # This is important! There are enough Persons in our data set that the
@@ -11,6 +33,7 @@ class ContributionInline(admin.TabularInline):
 
 
 class ThesisAdmin(admin.ModelAdmin):
+    actions = (download_similarity_matrix,)
     inlines = (ContributionInline,)
     list_filter = ('department', 'degree')
     search_fields = ('contribution__person__name',
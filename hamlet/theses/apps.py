@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 
 class ThesesConfig(AppConfig):
-    name = 'theses'
+    name = 'hamlet.theses'
+
+    def ready(self):
+        # Connects the signal handlers keeping the autocomplete indexes and
+        # cached pages up to date.
+        from . import ngrams, signals  # noqa
@@ -0,0 +1,124 @@
+"""Ranking people and departments by how close their theses are to a
+document.
+
+Each kind of group (authors, advisors, departments) has a
+hamlet.neural.centroids.Centroids matrix for the served model. If the model
+was exported with them (see the export_centroids management command), they
+are loaded from beside it; otherwise they are built from the database the
+first time they're needed, and rebuilt after settings.HAMLET_PARTITION_TTL
+seconds, like hamlet.theses.filters.Partitions."""
+import threading
+import time
+
+from django.conf import settings
+
+from hamlet.common.inferred_vectors import get_inferred_vector
+from hamlet.common.metrics import timer
+from hamlet.neural.centroids import Centroids
+from hamlet.neural.provider import get_served
+
+from .models import Contribution, Department, Person, Thesis
+
+AUTHORS = 'authors'
+ADVISORS = 'advisors'
+DEPARTMENTS = 'departments'
+KINDS = (AUTHORS, ADVISORS, DEPARTMENTS)
+
+ROLES = {AUTHORS: Contribution.AUTHOR, ADVISORS: Contribution.ADVISOR}
+
+
+def memberships(kind):
+    """Return (identifiers, keys): the Thesis.identifier of each thesis in a
+    group of the given kind, and the pk of the Person or Department."""
+    if kind in ROLES:
+        pairs = Contribution.objects.filter(
+            role=ROLES[kind], thesis__unextractable=False).values_list(
+            'thesis__identifier', 'person_id')
+    elif kind == DEPARTMENTS:
+        pairs = Thesis.department.through.objects.filter(
+            thesis__unextractable=False).values_list(
+            'thesis__identifier', 'department_id')
+    else:
+        raise ValueError('Unknown kind of centroid {}; options are '
+                         '{}'.format(kind, ', '.join(KINDS)))
+
+    pairs = list(pairs)
+    if not pairs:
+        return [], []
+    identifiers, keys = zip(*pairs)
+    return identifiers, keys
+
+
+def build_centroids(index, kind):
+    return Centroids.build(index, *memberships(kind))
+
+
+class ServedCentroids(object):
+    def __init__(self, served):
+        self.index = served.index
+        self.built = time.monotonic()
+        self.exported = True
+        self.centroids = {}
+        dimensions = self.index.vectors.shape[1]
+        for kind in KINDS:
+            centroids = Centroids.load(served.model_file, kind)
+            if centroids is None or centroids.vectors.shape[1] != dimensions:
+                self.exported = False
+                centroids = build_centroids(self.index, kind)
+            self.centroids[kind] = centroids
+
+    def stale(self, index):
+        return self.index is not index or (
+            not self.exported and time.monotonic() - self.built >
+            settings.HAMLET_PARTITION_TTL)
+
+
+_served_centroids = None
+_lock = threading.Lock()
+
+
+def get_centroids(kind):
+    """Return the Centroids of the given kind for the served model."""
+    global _served_centroids
+    served = get_served()
+    current = _served_centroids
+    if current is None or current.stale(served.index):
+        with _lock:
+            if _served_centroids is current:
+                _served_centroids = ServedCentroids(served)
+            current = _served_centroids
+    return current.centroids[kind]
+
+
+def thesis_vector(thesis):
+    """The vector of thesis in the served model, or None if it isn't in it."""
+    index = get_served().index
+    try:
+        return index.vectors[index.row(thesis.identifier)]
+    except KeyError:
+        return None
+
+
+def with_objects(kind, ranked):
+    """Turn [(key, similarity)] for groups of the given kind into [(Person or
+    Department, similarity)], in one query."""
+    model = Department if kind == DEPARTMENTS else Person
+    objects = model.objects.in_bulk([key for key, _ in ranked])
+    return [(objects[key], score) for key, score in ranked if key in objects]
+
+
+def rank(kind, vector, topn=10, exclude=()):
+    """Return [(Person or Department, similarity)] for the topn groups of the
+    given kind nearest to vector, nearest first."""
+    return with_objects(kind, get_centroids(kind).rank(
+        vector, topn=topn, exclude=exclude))
+
+
+def rank_for_upload(words, subset=None, topn=10):
+    """Return {kind: [(key, similarity)]} for the groups of each kind nearest
+    to a document with the given words. For UploadView.search, so it returns
+    keys rather than objects, and ignores subset: filters are for theses."""
+    vector = get_inferred_vector(words)
+    with timer('similarity'):
+        return {kind: get_centroids(kind).rank(vector, topn=topn)
+                for kind in KINDS}
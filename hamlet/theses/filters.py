@@ -0,0 +1,144 @@
+"""Restricting similarity searches to part of the corpus.
+
+People often want "similar theses, but only from my department" or "only
+since 2010". Filtering the usual top 50 after the fact often leaves nothing,
+so instead we search only the theses that match: Partitions maps thesis
+metadata onto rows of the served model, and turns a set of filters into a
+hamlet.neural.index.Subset of rows for SimilarityIndex to scan. A filtered
+search scans fewer vectors than an unfiltered one, so it is also faster.
+
+Partitions are built from the database with a couple of queries the first
+time they're needed, and rebuilt when the model changes, when this process
+changes thesis metadata (see hamlet.theses.signals), or after
+settings.HAMLET_PARTITION_TTL seconds (so that metadata ingested by other
+processes shows up eventually)."""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+import numpy as np
+
+from hamlet.neural.index import Subset, get_index
+
+from .models import Thesis
+
+
+class Partitions(object):
+    def __init__(self, index):
+        self.index = index
+        self.built = time.monotonic()
+
+        theses = list(Thesis.objects.filter(unextractable=False).values_list(
+            'identifier', 'year', 'degree'))
+        identifiers, years, degrees = zip(*theses) if theses else ((), (), ())
+        rows = index.rows_for(identifiers)
+        present = rows >= 0
+
+        # Rows in order of year, so that any range of years is a contiguous
+        # slice of them.
+        rows, years = rows[present], np.asarray(years)[present]
+        order = np.argsort(years, kind='stable')
+        self.rows_by_year = rows[order]
+        self.years = years[order]
+
+        by_degree = defaultdict(list)
+        for row, degree in zip(rows, np.asarray(degrees)[present]):
+            by_degree[degree].append(row)
+        self.degrees = {degree: np.sort(np.array(members, dtype=np.int64))
+                        for degree, members in by_degree.items()}
+
+        by_department = defaultdict(list)
+        links = list(Thesis.department.through.objects.values_list(
+            'thesis__identifier', 'department_id'))
+        if links:
+            thesis_identifiers, departments = zip(*links)
+            for row, department in zip(index.rows_for(thesis_identifiers),
+                                       departments):
+                if row >= 0:
+                    by_department[department].append(row)
+        self.departments = {
+            department: np.unique(np.array(members, dtype=np.int64))
+            for department, members in by_department.items()}
+
+    def subset(self, department=None, year_from=None, year_to=None,
+               degree=None):
+        """Return the Subset of theses matching all of the given filters
+        (department is a Department pk), or None if there are no filters."""
+        key = []
+        rows = None
+
+        if department is not None:
+            key.append('dept={}'.format(department))
+            rows = self.departments.get(department, np.array([], np.int64))
+
+        if degree:
+            key.append('degree={}'.format(degree))
+            degree_rows = self.degrees.get(degree, np.array([], np.int64))
+            rows = (degree_rows if rows is None else
+                    np.intersect1d(rows, degree_rows, assume_unique=True))
+
+        if year_from is not None or year_to is not None:
+            key.append('years={}-{}'.format(year_from or '', year_to or ''))
+            start = (0 if year_from is None else
+                     np.searchsorted(self.years, year_from, side='left'))
+            stop = (len(self.years) if year_to is None else
+                    np.searchsorted(self.years, year_to, side='right'))
+            year_rows = np.sort(self.rows_by_year[start:stop])
+            rows = (year_rows if rows is None else
+                    np.intersect1d(rows, year_rows, assume_unique=True))
+
+        if rows is None:
+            return None
+        # Filtered results are cached under the key, so it has to change
+        # when the rows the filters pick out do (say, when a thesis's year is
+        # corrected), not just when the filters do. Degrees are free text, so
+        # hash the key to keep it cache-safe.
+        digest = hashlib.sha1('|'.join(key).encode('utf-8'))
+        digest.update(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+        return Subset('subset-' + digest.hexdigest()[:16], rows)
+
+
+_partitions = None
+_lock = threading.Lock()
+
+
+def get_partitions():
+    """Return the Partitions for the served model, building them if need
+    be."""
+    global _partitions
+    index = get_index()
+    partitions = _partitions
+    if (partitions is None or partitions.index is not index or
+            time.monotonic() - partitions.built >
+            settings.HAMLET_PARTITION_TTL):
+        with _lock:
+            if _partitions is partitions:
+                _partitions = Partitions(index)
+            partitions = _partitions
+    return partitions
+
+
+def reset_partitions():
+    """Forget the Partitions, so that they are rebuilt from the database
+    when next needed."""
+    global _partitions
+    with _lock:
+        _partitions = None
+
+
+def degrees_changed(thesis):
+    """Whether saving thesis might have changed which degrees there are
+    theses for (and so the choices SimilarityFilterForm offers), judging by
+    this process's Partitions. They aren't built just for this: without
+    them, we can't tell, so assume it has."""
+    partitions = _partitions
+    if partitions is None:
+        return True
+    row = partitions.index.rows_for([thesis.identifier])[0]
+    listed = {degree for degree, rows in partitions.degrees.items()
+              if row in rows}
+    if row < 0 or thesis.unextractable:
+        return bool(listed)
+    return listed != {thesis.degree}
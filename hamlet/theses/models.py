@@ -1,11 +1,17 @@
+from copy import copy
 from functools import reduce
+from itertools import chain
 import re
 
-from django.conf import settings
 from django.urls import reverse
 from django.db import models
+from django.db.models import Prefetch
 from django.utils.functional import cached_property
 
+from hamlet.common.metrics import timer
+from hamlet.common.page_cache import page_version, thesis_revision
+from hamlet.neural.index import get_index
+
 
 class Person(models.Model):
     # NOTE: distinct people with the same name may be stored as the same Person
@@ -102,6 +108,31 @@ class Department(models.Model):
         ordering = ['name']
 
 
+class PeopleList(list):
+    """Prefetched authors or advisors of a thesis.
+
+    Thesis.authors and Thesis.advisors are querysets unless the thesis was
+    fetched with_metadata(), when they're one of these instead. It answers
+    all() and first() too, so templates can use either."""
+    def all(self):
+        return self
+
+    def first(self):
+        return self[0] if self else None
+
+
+class ThesisQuerySet(models.QuerySet):
+    def with_metadata(self):
+        """Fetch authors, advisors and departments along with the theses, in
+        two more queries however many theses there are, rather than two or
+        three per thesis."""
+        return self.prefetch_related(
+            Prefetch('contribution_set',
+                     queryset=Contribution.objects.select_related(
+                         'person').order_by('person__name', 'pk')),
+            'department')
+
+
 class Thesis(models.Model):
     REPLS = (('E.E', 'Elec.E'), ('Elect.E', 'Elec.E'), ('OceanE', 'Ocean.E'),
              ('M.ArchAS', 'M.Arch.A.S'), ('PhD', 'Ph.D'), ('ScD', 'Sc.D'))
@@ -135,6 +166,8 @@ class Thesis(models.Model):
             'the pdf failed; such theses are not part of the neural net, '
             'and cannot be used in data visualization.')
 
+    objects = ThesisQuerySet.as_manager()
+
     def __str__(self):
         return self.title
 
@@ -142,17 +175,23 @@ class Thesis(models.Model):
     def label(self):
         return '1721.1-{}.txt'.format(self.identifier)
 
+    def _people(self, role):
+        if 'contribution_set' in getattr(self, '_prefetched_objects_cache',
+                                         {}):
+            return PeopleList(contrib.person for contrib in
+                              self.contribution_set.all()
+                              if contrib.role == role)
+
+        contribs = Contribution.objects.filter(thesis=self, role=role)
+        return Person.objects.filter(contribution__in=contribs)
+
     @cached_property
     def authors(self):
-        contribs = Contribution.objects.filter(
-            thesis=self, role=Contribution.AUTHOR)
-        return Person.objects.filter(contribution__in=contribs)
+        return self._people(Contribution.AUTHOR)
 
     @cached_property
     def advisors(self):
-        contribs = Contribution.objects.filter(
-            thesis=self, role=Contribution.ADVISOR)
-        return Person.objects.filter(contribution__in=contribs)
+        return self._people(Contribution.ADVISOR)
 
     @cached_property
     def dspace_url(self):
@@ -212,27 +251,58 @@ class Thesis(models.Model):
 
     # See https://radimrehurek.com/gensim/models/doc2vec.html for affordances
     # offered by doc2vec.
-    def get_most_similar(self, threshold=0.75, topn=50):
+    def get_most_similar(self, threshold=0.75, topn=50, subset=None):
         """Find theses above a given similarity threshold. If there are more
         than topn, only the topn most similar will be returned (to a maximum
-        of 50).
+        of 50). If subset (see hamlet.theses.filters) is given, only theses
+        in it are considered.
 
         Threshold defaults to 0.75, because in practice that seems to usually
         result in theses that humans find similar, but also a manageable number
         of results."""
 
         topn = min(topn, 50)
-        friends = settings.NEURAL_NET.docvecs.most_similar(
-            [self.label], topn=topn)
+        # Served from the precomputed neighbour table when the model was
+        # exported with one, so this usually skips the vector math entirely.
+        with timer('similarity'):
+            friends = get_index().most_similar(self.identifier, topn=topn,
+                                               subset=subset)
 
-        friend_labels = [x[0] for x in friends if x[1] > threshold]
-        friend_ids = [x.split('-')[1].split('.')[0] for x in friend_labels]
-        return Thesis.objects.filter(identifier__in=friend_ids)
+        return RankedTheses([x for x in friends if x[1] > threshold])
+
+    @classmethod
+    def get_most_similar_for(cls, theses, threshold=0.75, topn=50):
+        """Like get_most_similar, but for many theses at once.
+
+        Returns a dict mapping the pk of each thesis to the RankedTheses most
+        similar to it. The similarity search for all of them happens in one
+        go, and all of the similar theses are fetched together."""
+        topn = min(topn, 50)
+        with timer('similarity'):
+            friends = get_index().most_similar_batch(
+                [thesis.identifier for thesis in theses], topn=topn)
+
+        ranked = {thesis.pk: [x for x in friends[thesis.identifier]
+                              if x[1] > threshold]
+                  for thesis in theses}
+
+        by_identifier = RankedTheses.fetch(set(
+            x[0] for x in chain.from_iterable(ranked.values())))
+        return {pk: RankedTheses(friends, by_identifier)
+                for pk, friends in ranked.items()}
 
     def get_similarity(self, thesis):
         """Get the similarity between this and another thesis."""
-        return settings.NEURAL_NET.docvecs.similarity(
-            self.label, thesis.label)
+        return get_index().similarity(self.identifier, thesis.identifier)
+
+    @classmethod
+    def get_similarity_matrix(cls, theses):
+        """Get the similarities between every pair of the given theses, as a
+        square numpy array in the same order. Much faster than calling
+        get_similarity for each pair. Raises KeyError if any of the theses
+        aren't in the neural net (unextractable ones never are)."""
+        return get_index().similarity_matrix(
+            [thesis.identifier for thesis in theses])
 
     class Meta:
         verbose_name_plural = 'theses'
@@ -250,3 +320,66 @@ class Contribution(models.Model):
     thesis = models.ForeignKey(Thesis, on_delete=models.CASCADE)
     person = models.ForeignKey(Person, on_delete=models.CASCADE)
     role = models.CharField(max_length=7, choices=ROLE_CHOICES)
+
+
+class RankedTheses(object):
+    """Theses in order of similarity, most similar first, each with its
+    similarity as its score attribute.
+
+    Made from [(Thesis.identifier, similarity)] pairs. The theses, with their
+    authors, advisors and departments, are fetched the first time they're
+    needed, in three queries however many there are (or none, if
+    by_identifier already holds them; see fetch()), so pages can show them
+    without any more. Theses the database doesn't have are left out."""
+    def __init__(self, ranked, by_identifier=None):
+        self.ranked = list(ranked)
+        self._by_identifier = by_identifier
+        self._theses = None
+
+    @staticmethod
+    def fetch(identifiers):
+        """Return {identifier: Thesis} for the given identifiers, with their
+        metadata."""
+        return {thesis.identifier: thesis for thesis in
+                Thesis.objects.filter(
+                    identifier__in=list(identifiers)).with_metadata()}
+
+    @property
+    def identifiers(self):
+        return [identifier for identifier, _ in self.ranked]
+
+    @property
+    def page_version(self):
+        """The version of these suggestions as shown in a page, for caching
+        them (see hamlet.common.page_cache)."""
+        return page_version([thesis_revision(identifier)
+                             for identifier in self.identifiers])
+
+    @property
+    def theses(self):
+        if self._theses is None:
+            by_identifier = self._by_identifier
+            if by_identifier is None:
+                by_identifier = self.fetch(self.identifiers)
+            self._theses = []
+            for identifier, score in self.ranked:
+                if identifier in by_identifier:
+                    # A copy, since the same thesis may rank differently in
+                    # another list sharing by_identifier.
+                    thesis = copy(by_identifier[identifier])
+                    thesis.score = score
+                    self._theses.append(thesis)
+        return self._theses
+
+    def __iter__(self):
+        return iter(self.theses)
+
+    def __len__(self):
+        return len(self.theses)
+
+    def __getitem__(self, i):
+        # Templates try suggestions['ranked'] before suggestions.ranked; that
+        # shouldn't fetch the theses.
+        if isinstance(i, str):
+            raise TypeError('RankedTheses indices must be integers')
+        return self.theses[i]
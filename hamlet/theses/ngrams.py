@@ -0,0 +1,379 @@
+"""Autocompleting thesis titles and author names without the database.
+
+The autocomplete views used to run an icontains query on every keystroke,
+which can't use an index (and the Postgres extensions that would let it need
+superuser rights to install). Instead, each process keeps an NgramIndex of the
+titles of extractable theses and another of the names of authors, and
+answers autocomplete queries from memory:
+
+* a query of three or more characters matches the labels containing it, as
+  icontains did. Every trigram of every label is indexed, so the candidates
+  are the labels having the query's rarest trigram, which we then check;
+* a query of one or two characters is too short to have trigrams, and would
+  match nearly everything anyway, so it matches the labels with a word
+  starting with it.
+
+Matches are ranked labels-starting-with-the-query first, then labels with a
+word starting with it, then the rest, and shorter labels first within those.
+The last few result lists are cached, since everyone's queries start with the
+same few letters; the slowest, for queries of one letter, are cached as soon
+as an index is built.
+
+The indexes are built from the database the first time they're needed (or by
+warm_ngrams(), as each server process starts), kept up to date as this
+process saves and deletes theses, people and contributions, and rebuilt in
+the background after settings.HAMLET_PARTITION_TTL seconds to pick up changes
+made by other processes, such as ingests."""
+from array import array
+from collections import OrderedDict, defaultdict
+from functools import partial
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from hamlet.common.threads import start_background
+
+from .models import Contribution, Person, Thesis
+
+TITLES = 'titles'
+AUTHORS = 'authors'
+
+# How many result lists each index remembers.
+CACHE_SIZE = 256
+
+_WORDS = re.compile(r'\w+')
+
+# Marks the n-grams which are the starts of words, to tell them apart from
+# trigrams.
+WORD_START = '\0'
+
+
+def fold(text):
+    return text.casefold()
+
+
+def ngrams(folded):
+    """The keys under which a (folded) label is indexed: its trigrams, and
+    the first one and two characters of each of its words (after
+    WORD_START)."""
+    grams = {folded[i:i + 3] for i in range(len(folded) - 2)}
+    for word in _WORDS.findall(folded):
+        grams.add(WORD_START + word[:1])
+        grams.add(WORD_START + word[:2])
+    return grams
+
+
+def matches(query, folded):
+    """Whether a (folded) query matches a (folded) label."""
+    if not query:
+        return True
+    if len(query) < 3:
+        return any(word.startswith(query) for word in _WORDS.findall(folded))
+    return query in folded
+
+
+class NgramIndex(object):
+    """Labels (titles, names) by key (pk), searchable by substring."""
+    def __init__(self, labels=()):
+        self.labels = {}
+        # Every process keeps its own indexes, and there are several
+        # postings per character of every label, so they are kept as arrays
+        # of (32-bit, like the primary keys) ints rather than sets, which
+        # take about five times the memory.
+        self.postings = defaultdict(partial(array, 'i'))
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        for key, label in labels:
+            self._add(key, label)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _add(self, key, label):
+        folded = fold(label)
+        self.labels[key] = (label, folded)
+        for gram in ngrams(folded):
+            self.postings[gram].append(key)
+
+    def _remove(self, key):
+        _, folded = self.labels.pop(key)
+        for gram in ngrams(folded):
+            keys = self.postings[gram]
+            keys.remove(key)
+            if not keys:
+                del self.postings[gram]
+
+    def _forget(self, folded):
+        """Drop the cached results that a label, being added or removed,
+        would have been in."""
+        for query in [query for query in self.cache
+                      if matches(query, folded)]:
+            del self.cache[query]
+
+    def add(self, key, label):
+        """Index label under key, replacing whatever was there."""
+        with self.lock:
+            if self.labels.get(key, (None,))[0] == label:
+                return
+            if key in self.labels:
+                self._forget(self.labels[key][1])
+                self._remove(key)
+            self._add(key, label)
+            self._forget(self.labels[key][1])
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.labels:
+                self._forget(self.labels[key][1])
+                self._remove(key)
+
+    def _candidates(self, query):
+        if not query:
+            return set(self.labels)
+        if len(query) < 3:
+            return set(self.postings.get(WORD_START + query, ()))
+
+        # Checking the labels with the query's rarest trigram is quicker than
+        # intersecting the postings of all of them.
+        keys = min((self.postings.get(query[i:i + 3], ())
+                    for i in range(len(query) - 2)), key=len)
+        return {key for key in keys if query in self.labels[key][1]}
+
+    def _ranked(self, query, keys):
+        labels = self.labels
+        if len(query) < 3:
+            # Every candidate has a word starting with the query.
+            def rank(key):
+                folded = labels[key][1]
+                return (not folded.startswith(query), len(folded), folded)
+        else:
+            word_start = re.compile(r'(?<!\w)' + re.escape(query)).search
+
+            def rank(key):
+                folded = labels[key][1]
+                if folded.startswith(query):
+                    kind = 0
+                elif word_start(folded):
+                    kind = 1
+                else:
+                    kind = 2
+                return (kind, len(folded), folded)
+
+        return tuple(sorted(keys, key=rank))
+
+    def warm(self):
+        """Cache the results of the empty query and of every one-character
+        query, which match so much that they are the slowest to rank."""
+        self.search('')
+        for gram in [gram for gram in self.postings
+                     if len(gram) == 2 and gram[0] == WORD_START]:
+            self.search(gram[1])
+
+    def label(self, key):
+        """The label of key, or '' if it has been removed since a search
+        found it."""
+        return self.labels.get(key, ('',))[0]
+
+    def search(self, query):
+        """Return the keys of every label matching query, best first. An
+        empty query matches everything, alphabetically."""
+        query = fold(query or '').strip()
+        with self.lock:
+            keys = self.cache.get(query)
+            if keys is None:
+                if query:
+                    keys = self._ranked(query, self._candidates(query))
+                else:
+                    keys = tuple(sorted(
+                        self.labels, key=lambda key: self.labels[key][1]))
+                self.cache[query] = keys
+                if len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(query)
+            return keys
+
+
+def load_labels(kind):
+    """Return [(pk, label)] for everything the index of the given kind
+    should hold."""
+    if kind == TITLES:
+        return Thesis.objects.filter(unextractable=False).values_list(
+            'pk', 'title')
+    elif kind == AUTHORS:
+        return Person.objects.filter(
+            contribution__role=Contribution.AUTHOR).distinct().values_list(
+            'pk', 'name')
+    raise ValueError('Unknown kind of autocomplete index {}; options are '
+                     '{}, {}'.format(kind, TITLES, AUTHORS))
+
+
+class ServedIndex(object):
+    def __init__(self, kind):
+        self.built = time.monotonic()
+        self.refreshing = False
+        self.index = NgramIndex(load_labels(kind))
+        self.index.warm()
+
+    def stale(self):
+        return (time.monotonic() - self.built >
+                settings.HAMLET_PARTITION_TTL)
+
+
+_served = {}
+_lock = threading.Lock()
+
+
+def _refresh(kind, current):
+    try:
+        fresh = ServedIndex(kind)
+        with _lock:
+            if _served.get(kind) is current:
+                _served[kind] = fresh
+    finally:
+        # This thread's own connection, which nothing else will close.
+        connection.close()
+
+
+def get_ngram_index(kind):
+    """Return the NgramIndex of the given kind, building it if need be."""
+    current = _served.get(kind)
+    if current is None:
+        fresh = ServedIndex(kind)
+        with _lock:
+            current = _served.setdefault(kind, fresh)
+    elif current.stale():
+        # Building an index of every title takes seconds, so rather than
+        # make one visitor wait for it, rebuild it in the background and
+        # carry on with the old one in the meantime.
+        with _lock:
+            start, current.refreshing = not current.refreshing, True
+        if start:
+            # A real thread even under gevent (see hamlet.common.threads):
+            # this is seconds of pure Python.
+            start_background(_refresh, kind, current)
+    return current.index
+
+
+def warm_ngrams():
+    for kind in (TITLES, AUTHORS):
+        get_ngram_index(kind)
+
+
+def reset_ngrams():
+    """Forget the indexes, so that they are rebuilt when next needed."""
+    with _lock:
+        _served.clear()
+
+
+def _built(kind):
+    """The index of the given kind if it has been built; if it hasn't, there
+    is nothing to keep up to date."""
+    served = _served.get(kind)
+    return served.index if served is not None else None
+
+
+class Matches(object):
+    """The results of a search of index, as instances of model, to hand to
+    the autocomplete views in place of a queryset. All that they need is pk
+    and str(), so the instances are made from the index as they're needed,
+    without the database."""
+    def __init__(self, model, field, index, keys):
+        self.model = model
+        self.field = field
+        self.index = index
+        self.keys = keys
+
+    def _instance(self, key):
+        return self.model(**{'pk': key, self.field: self.index.label(key)})
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return (self._instance(key) for key in self.keys)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._instance(key) for key in self.keys[i]]
+        return self._instance(self.keys[i])
+
+
+def _matches(model, field, kind, query):
+    index = get_ngram_index(kind)
+    return Matches(model, field, index, index.search(query))
+
+
+def matching_theses(query):
+    """Extractable theses with titles matching query, best first."""
+    return _matches(Thesis, 'title', TITLES, query)
+
+
+def matching_authors(query):
+    """Authors with names matching query, best first."""
+    return _matches(Person, 'name', AUTHORS, query)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Keeping up to date ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@receiver(post_save, sender=Thesis)
+def thesis_saved(sender, instance, **kwargs):
+    index = _built(TITLES)
+    if index is None:
+        return
+    if instance.unextractable:
+        index.remove(instance.pk)
+    else:
+        index.add(instance.pk, instance.title)
+
+
+@receiver(post_delete, sender=Thesis)
+def thesis_deleted(sender, instance, **kwargs):
+    index = _built(TITLES)
+    if index is not None:
+        index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Person)
+def person_saved(sender, instance, **kwargs):
+    index = _built(AUTHORS)
+    # People are only in the index if they've written something, which a
+    # Person who has just been saved may not have yet.
+    if index is not None and instance.pk in index.labels:
+        index.add(instance.pk, instance.name)
+
+
+@receiver(post_delete, sender=Person)
+def person_deleted(sender, instance, **kwargs):
+    index = _built(AUTHORS)
+    if index is not None:
+        index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Contribution)
+def contribution_saved(sender, instance, **kwargs):
+    index = _built(AUTHORS)
+    if index is None:
+        return
+    if instance.role == Contribution.AUTHOR:
+        name = Person.objects.filter(pk=instance.person_id).values_list(
+            'name', flat=True).first()
+        if name is not None:
+            index.add(instance.person_id, name)
+    else:
+        # It might have been changed from an authorship.
+        contribution_deleted(sender, instance, **kwargs)
+
+
+@receiver(post_delete, sender=Contribution)
+def contribution_deleted(sender, instance, **kwargs):
+    index = _built(AUTHORS)
+    if index is not None and not Contribution.objects.filter(
+            person_id=instance.person_id,
+            role=Contribution.AUTHOR).exists():
+        index.remove(instance.person_id)
@@ -0,0 +1,80 @@
+"""Invalidating cached pages (see hamlet.common.page_cache) and similarity
+filters (see hamlet.theses.filters) when the metadata they depend on
+changes.
+
+Pages are invalidated by bumping the revisions of the theses and people
+whose metadata changed, including those that show the changed metadata: a
+thesis shows its authors, advisors and departments, so their changes bump
+it. Within hamlet.common.page_cache.batched_revisions(), the querysets
+here are never evaluated."""
+from itertools import chain
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from hamlet.common.page_cache import (CONTRIBUTIONS_REVISION,
+                                      DEGREES_REVISION, FILTERS_REVISION,
+                                      bump_metadata_revision, bump_revisions,
+                                      person_revision, thesis_revision)
+
+from .filters import degrees_changed, reset_partitions
+from .models import Contribution, Department, Person, Thesis
+
+
+def thesis_revisions(theses):
+    """The revision keys for a queryset of theses, looked up lazily."""
+    return (thesis_revision(identifier) for identifier in
+            theses.values_list('identifier', flat=True).iterator())
+
+
+@receiver(post_save, sender=Thesis)
+@receiver(post_delete, sender=Thesis)
+def thesis_changed(sender, instance, signal, **kwargs):
+    keys = [thesis_revision(instance.identifier), FILTERS_REVISION]
+    if signal is post_delete or degrees_changed(instance):
+        keys.append(DEGREES_REVISION)
+    bump_revisions(keys)
+    reset_partitions()
+
+
+@receiver(m2m_changed, sender=Thesis.department.through)
+def departments_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        bump_revisions([thesis_revision(instance.identifier),
+                        FILTERS_REVISION])
+    elif pk_set is None:
+        # A department was cleared of all its theses; we no longer know
+        # which they were.
+        bump_metadata_revision()
+    else:
+        bump_revisions(chain(
+            [FILTERS_REVISION],
+            thesis_revisions(Thesis.objects.filter(pk__in=pk_set))))
+    reset_partitions()
+
+
+@receiver(post_save, sender=Contribution)
+@receiver(post_delete, sender=Contribution)
+def contribution_changed(sender, instance, **kwargs):
+    bump_revisions(chain(
+        [person_revision(instance.person_id), CONTRIBUTIONS_REVISION],
+        thesis_revisions(Thesis.objects.filter(pk=instance.thesis_id))))
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_delete, sender=Person)
+def person_changed(sender, instance, **kwargs):
+    bump_revisions(chain(
+        [person_revision(instance.pk)],
+        thesis_revisions(Thesis.objects.filter(
+            contribution__person=instance.pk).distinct())))
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def department_changed(sender, **kwargs):
+    # Departments are few, rarely change, and are offered as filters on
+    # every page.
+    bump_metadata_revision()
@@ -0,0 +1,31 @@
+from django.test import TestCase
+
+from hamlet.neural.provider import get_served
+
+from .. import centroids
+from ..models import Department, Person, Thesis
+
+
+class CentroidsTestCase(TestCase):
+    fixtures = ['theses.json', 'departments.json', 'authors.json',
+                'contributions.json']
+
+    def test_built_from_database(self):
+        served = centroids.ServedCentroids(get_served())
+        assert not served.exported
+        assert list(served.centroids[centroids.ADVISORS].keys) == [29903]
+        assert list(served.centroids[centroids.AUTHORS].keys) == [63970]
+        # The unextractable thesis is in a department of its own.
+        assert list(served.centroids[centroids.DEPARTMENTS].keys) == [275]
+
+    def test_rank(self):
+        vector = centroids.thesis_vector(Thesis.objects.get(pk=76265))
+        ranked = centroids.rank(centroids.ADVISORS, vector)
+        assert [person for person, _ in ranked] == [
+            Person.objects.get(pk=29903)]
+        ranked = centroids.rank(centroids.DEPARTMENTS, vector)
+        assert [department for department, _ in ranked] == [
+            Department.objects.get(pk=275)]
+
+    def test_unextractable_thesis_has_no_vector(self):
+        assert centroids.thesis_vector(Thesis.objects.get(pk=32600)) is None
@@ -1,10 +1,13 @@
 import os
+from io import BytesIO
+from unittest import mock
 
 from django.core.files.uploadedfile import UploadedFile
 from django.conf import settings
 from django.test import SimpleTestCase
 
-from hamlet.common.document import DocxDocument, factory
+from hamlet.common.document import (
+    DocxDocument, TextDocument, factory, split_stream)
 
 
 class DocumentTestCase(SimpleTestCase):
@@ -21,3 +24,40 @@ class DocumentTestCase(SimpleTestCase):
             doc = DocxDocument(UploadedFile(fp))
             assert doc.words[0] == 'Time'
             assert doc.words[-1] == 'oneself.'
+
+    def test_tokens(self):
+        with open(os.path.join(self.fixtures, 'thesis.txt'), 'rb') as fp:
+            doc = factory(UploadedFile(fp))
+            assert doc.tokens[:5] == ['since', 'the', 'dawn', 'of', 'time']
+            assert doc.tokens[-1] == 'fluids'
+
+    def test_tokens_are_capped(self):
+        fp = UploadedFile(BytesIO(b'a.b,c the dawn of time'))
+        with self.settings(HAMLET_UPLOAD_TOKEN_LIMIT=5):
+            doc = TextDocument(fp)
+            assert doc.tokens == ['a', 'b', 'c', 'the', 'dawn']
+            assert list(doc.iter_tokens()) == doc.tokens
+            # The words aren't capped.
+            assert doc.words == ['a.b,c', 'the', 'dawn', 'of', 'time']
+
+    def test_tokens_are_read_once(self):
+        with open(os.path.join(self.fixtures, 'thesis.txt'), 'rb') as fp:
+            doc = factory(UploadedFile(fp))
+            with mock.patch.object(doc, '_iter_all_words',
+                                   wraps=doc._iter_all_words) as read:
+                assert doc.tokens is doc.tokens
+            assert read.call_count == 1
+
+    def test_words_span_chunks(self):
+        text = 'première idée ' * 20000
+        fp = UploadedFile(BytesIO(text.encode('latin-1')))
+        doc = TextDocument(fp)
+        with mock.patch('hamlet.common.document.CHUNK_SIZE', 1000):
+            words = doc.words
+        assert doc.encoding.lower() in ('iso-8859-1', 'windows-1252')
+        assert len(words) == 40000
+        assert set(words) == {'première', 'idée'}
+
+    def test_split_stream(self):
+        assert list(split_stream(['one tw', 'o  three', '', ' four'])) == \
+            ['one', 'two', 'three', 'four']
@@ -0,0 +1,55 @@
+from django.test import TestCase
+
+from hamlet.neural.index import get_index
+
+from ..filters import Partitions
+from ..models import Thesis
+
+
+class PartitionsTestCase(TestCase):
+    fixtures = ['theses.json', 'departments.json', 'authors.json',
+                'contributions.json']
+
+    def setUp(self):
+        self.index = get_index()
+        self.partitions = Partitions(self.index)
+
+    def identifiers(self, subset):
+        return set(int(x) for x in self.index.identifiers[subset.rows])
+
+    def test_no_filters(self):
+        assert self.partitions.subset() is None
+
+    def test_department(self):
+        subset = self.partitions.subset(department=275)
+        assert {111908, 66473, 33360} <= self.identifiers(subset)
+
+        assert not self.identifiers(self.partitions.subset(department=287))
+
+    def test_years(self):
+        subset = self.partitions.subset(year_from=2010)
+        identifiers = self.identifiers(subset)
+        assert {111908, 66473} <= identifiers
+        assert 33360 not in identifiers
+
+        subset = self.partitions.subset(year_from=2005, year_to=2011)
+        identifiers = self.identifiers(subset)
+        assert {33360, 66473} <= identifiers
+        assert 111908 not in identifiers
+
+    def test_filters_combine(self):
+        subset = self.partitions.subset(department=275, year_to=2011,
+                                        degree="Master's degree")
+        identifiers = self.identifiers(subset)
+        assert {33360, 66473} <= identifiers
+        assert 111908 not in identifiers
+
+    def test_get_most_similar_in_subset(self):
+        thesis = Thesis.objects.get(pk=76265)
+        similar = Thesis.objects.get(pk=60330)
+
+        subset = self.partitions.subset(year_to=2012)
+        assert similar in thesis.get_most_similar(topn=10, subset=subset)
+
+        subset = self.partitions.subset(year_from=2015)
+        assert similar not in thesis.get_most_similar(topn=10, subset=subset)
@@ -1,7 +1,13 @@
+from unittest.mock import PropertyMock, patch
+
+from django.conf import settings
+from django.core.cache import caches
 from django.urls import reverse
 from django.test import TestCase
 
-from ..models import Person, Department, Thesis
+from hamlet.neural.index import SimilarityIndex
+
+from ..models import Contribution, Person, Department, Thesis
 
 
 class PersonTestCase(TestCase):
@@ -181,3 +187,73 @@ class ThesisTestCase(TestCase):
         expected = reverse('theses:similar_to',
                            kwargs={'identifier': t.identifier})
         assert t.get_absolute_url() == expected
+
+    def test_get_most_similar_is_cached(self):
+        caches[settings.HAMLET_SIMILARITY_CACHE].clear()
+        thesis = Thesis.objects.get(pk=76265)
+        expected = set(thesis.get_most_similar(topn=10))
+        assert Thesis.objects.get(pk=60330) in expected
+
+        # The second time around, we shouldn't need to search at all.
+        with patch.object(SimilarityIndex, 'nearest',
+                          side_effect=AssertionError):
+            assert set(thesis.get_most_similar(topn=10)) == expected
+
+    def test_get_similarity_is_symmetric_and_cached(self):
+        caches[settings.HAMLET_SIMILARITY_CACHE].clear()
+        thesis1 = Thesis.objects.get(pk=76265)
+        thesis2 = Thesis.objects.get(pk=60330)
+        similarity = thesis1.get_similarity(thesis2)
+        assert similarity > 0.75
+
+        with patch.object(SimilarityIndex, 'vectors',
+                          new_callable=PropertyMock,
+                          side_effect=AssertionError):
+            assert thesis2.get_similarity(thesis1) == similarity
+
+    def test_get_similarity_matrix(self):
+        theses = list(Thesis.objects.filter(pk__in=[76265, 60330, 43703]))
+        matrix = Thesis.get_similarity_matrix(theses)
+        assert matrix.shape == (3, 3)
+        for i, thesis1 in enumerate(theses):
+            for j, thesis2 in enumerate(theses):
+                if i != j:
+                    assert abs(matrix[i, j] -
+                               thesis1.get_similarity(thesis2)) < 1e-5
+
+    def test_get_most_similar_is_ranked(self):
+        thesis = Thesis.objects.get(pk=76265)
+        results = thesis.get_most_similar(topn=10)
+        scores = [result.score for result in results]
+        assert scores == sorted(scores, reverse=True)
+        assert results[0] == Thesis.objects.get(pk=60330)
+
+    def test_with_metadata(self):
+        thesis = Thesis.objects.with_metadata().get(pk=60330)
+        with self.assertNumQueries(0):
+            assert thesis.authors.first().pk == 63970
+            assert [p.pk for p in thesis.advisors.all()] == [29903]
+            assert [d.pk for d in thesis.department.all()] == [275]
+
+    def test_with_metadata_orders_people_by_name(self):
+        thesis = Thesis.objects.get(pk=60330)
+        for name in ['Zwicky, Fritz', 'Abelson, Harold']:
+            Contribution.objects.create(
+                thesis=thesis, person=Person.objects.create(name=name),
+                role=Contribution.ADVISOR)
+        advisors = [p.name for p in thesis.advisors.all()]
+        assert advisors == sorted(advisors)
+        fetched = Thesis.objects.with_metadata().get(pk=60330)
+        assert [p.name for p in fetched.advisors] == advisors
+
+    def test_get_most_similar_for(self):
+        theses = list(Thesis.objects.filter(pk__in=[76265, 60330]))
+        # The theses, then their authors and advisors, then departments.
+        with self.assertNumQueries(3):
+            results = Thesis.get_most_similar_for(theses, topn=10)
+            for thesis in theses:
+                list(results[thesis.pk])
+
+        for thesis in theses:
+            assert (set(results[thesis.pk]) ==
+                    set(thesis.get_most_similar(topn=10)))
@@ -0,0 +1,124 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from .. import ngrams
+from ..models import Contribution, Person, Thesis
+
+
+class NgramIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.index = ngrams.NgramIndex([
+            (1, 'Ultra low power receivers'),
+            (2, 'Architecture for ultra-low power transmitters'),
+            (3, 'Nonultrasonic forces'),
+            (4, 'Clock division'),
+        ])
+
+    def test_substring(self):
+        assert set(self.index.search('ULTRA')) == {1, 2, 3}
+        assert self.index.search('ultra-low') == (2,)
+        assert self.index.search('not there') == ()
+
+    def test_ranking(self):
+        # Starts with the query, then a word starting with it, then the rest.
+        assert self.index.search('ultra') == (1, 2, 3)
+
+    def test_short_queries_match_word_starts(self):
+        assert self.index.search('c') == (4,)
+        assert set(self.index.search('ul')) == {1, 2}
+
+    def test_empty_query_matches_everything(self):
+        assert self.index.search('') == (2, 4, 3, 1)
+        assert self.index.search(None) == (2, 4, 3, 1)
+
+    def test_add_and_remove(self):
+        assert self.index.search('ultra') == (1, 2, 3)
+        self.index.add(5, 'Ultra')
+        self.index.remove(1)
+        assert self.index.search('ultra') == (5, 2, 3)
+        self.index.add(5, 'Division')
+        assert self.index.search('ultra') == (2, 3)
+        assert self.index.search('divi') == (5, 4)
+        assert self.index.label(5) == 'Division'
+
+    def test_postings(self):
+        # Each key once per gram, and nothing left of a label once it goes.
+        assert list(self.index.postings['ult']) == [1, 2, 3]
+        self.index.remove(3)
+        assert list(self.index.postings['ult']) == [1, 2]
+        assert 'son' not in self.index.postings
+
+    def test_cache_is_bounded(self):
+        for i in range(ngrams.CACHE_SIZE + 10):
+            self.index.search('q{}'.format(i))
+        assert len(self.index.cache) == ngrams.CACHE_SIZE
+
+    def test_changes_reach_cached_results(self):
+        self.index.warm()
+        assert self.index.search('c') == (4,)
+        assert 'c' in self.index.cache and 'u' in self.index.cache
+        self.index.add(5, 'Cats')
+        assert self.index.search('c') == (5, 4)
+        # Results the change couldn't affect are still cached.
+        assert 'u' in self.index.cache
+
+
+class ServedNgramsTestCase(TestCase):
+    fixtures = ['theses.json', 'departments.json', 'authors.json',
+                'contributions.json']
+
+    def setUp(self):
+        ngrams.reset_ngrams()
+
+    def test_built_from_database(self):
+        # Not the unextractable thesis, nor the advisor.
+        assert set(ngrams.get_ngram_index(ngrams.TITLES).labels) == {
+            43703, 60330, 76265}
+        assert set(ngrams.get_ngram_index(ngrams.AUTHORS).labels) == {63970}
+
+    def test_matches(self):
+        matches = ngrams.matching_authors('aru')
+        assert len(matches) == 1
+        assert [(person.pk, str(person)) for person in matches] == [
+            (63970, 'Paidimarri, Aru')]
+        assert matches[:1][0].pk == 63970
+
+    def test_kept_up_to_date(self):
+        ngrams.warm_ngrams()
+        thesis = Thesis.objects.get(pk=43703)
+        thesis.title = 'Clockwork oranges'
+        thesis.save()
+        assert [t.pk for t in ngrams.matching_theses('orange')] == [43703]
+
+        thesis.unextractable = True
+        thesis.save()
+        assert not ngrams.matching_theses('orange')
+
+        Contribution.objects.create(
+            thesis=thesis, person_id=29903, role=Contribution.AUTHOR)
+        assert [p.pk for p in ngrams.matching_authors('anantha')] == [29903]
+
+        person = Person.objects.get(pk=29903)
+        person.name = 'Chandrakasan, Anantha'
+        person.save()
+        assert [str(p) for p in ngrams.matching_authors('anantha')] == [
+            'Chandrakasan, Anantha']
+
+        Contribution.objects.filter(person_id=29903,
+                                    role=Contribution.AUTHOR).delete()
+        assert not ngrams.matching_authors('anantha')
+
+        Thesis.objects.filter(pk=60330).delete()
+        assert [t.pk for t in ngrams.matching_theses('ultra')] == [76265]
+
+    def test_stale_index_rebuilt_in_background(self):
+        index = ngrams.get_ngram_index(ngrams.TITLES)
+        with self.settings(HAMLET_PARTITION_TTL=-1), \
+                patch.object(ngrams, 'start_background') as start:
+            assert ngrams.get_ngram_index(ngrams.TITLES) is index
+            start.assert_called_once_with(ngrams._refresh, ngrams.TITLES,
+                                          ngrams._served[ngrams.TITLES])
+            # Only once, however many requests see it stale.
+            ngrams.get_ngram_index(ngrams.TITLES)
+            assert start.call_count == 1
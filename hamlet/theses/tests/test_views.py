@@ -1,12 +1,26 @@
+import json
 import os
 import re
+import time
+from unittest.mock import patch
 
 from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
 from django.urls import reverse
 from django.test import Client, RequestFactory, TestCase, override_settings
+from django.views import View
+
+from hamlet.common import jobs
+from hamlet.common.forms import SimilarityFilterForm
+from hamlet.common.page_cache import (CachedPageMixin, batched_revisions,
+                                      get_page_cache, thesis_revision)
+from hamlet.neural.provider import get_model
 
 from ..forms import AuthorAutocompleteForm, TitleAutocompleteForm
+from ..filters import get_partitions, reset_partitions
 from ..models import Thesis, Person, Contribution
+from ..ngrams import reset_ngrams
 from .. import views
 
 
@@ -32,6 +46,13 @@ class BaseTestCase(TestCase):
     def setup(self):
         self.client = Client()
 
+    def setUp(self):
+        # Pages, filters and searches cached by one test mustn't turn up in
+        # another, whose database may differ.
+        caches[settings.HAMLET_PAGE_CACHE].clear()
+        caches[settings.HAMLET_SIMILARITY_CACHE].clear()
+        reset_partitions()
+
 
 class SimilarToViewTests(BaseTestCase):
 
@@ -62,6 +83,183 @@ class SimilarToViewTests(BaseTestCase):
 
         assert 'Architecture for ultra-low power multi-channel transmitters for Body Area Networks using RF resonators' in content  # noqa
 
+    def test_filtered_suggestions(self):
+        thesis = Thesis.objects.get(pk=76265)
+        similar = Thesis.objects.get(pk=60330)
+        url = reverse('theses:similar_to',
+                      kwargs={'identifier': thesis.identifier})
+
+        response = self.client.get(url, {'department': 275})
+        assert similar in response.context['suggestions']
+
+        response = self.client.get(url, {'year_from': 2015})
+        assert similar not in response.context['suggestions']
+
+    def test_filtered_suggestions_follow_metadata(self):
+        thesis = Thesis.objects.get(pk=76265)
+        similar = Thesis.objects.get(pk=60330)
+        url = reverse('theses:similar_to',
+                      kwargs={'identifier': thesis.identifier})
+        response = self.client.get(url, {'year_from': 2015})
+        assert similar not in response.context['suggestions']
+
+        similar.year = 2016
+        similar.save()
+        response = self.client.get(url, {'year_from': 2015})
+        assert similar in response.context['suggestions']
+
+    def test_constant_queries(self):
+        # The thesis, its authors and advisors, and its departments; the
+        # departments for the filter form (its degrees come from the
+        # partitions, which a running server already has); then three for all
+        # of the suggestions together.
+        get_partitions()
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        with self.assertNumQueries(7):
+            response = self.client.get(url)
+        assert len(response.context['suggestions'])
+
+    def test_filter_form(self):
+        # Its degrees don't need the database...
+        get_partitions()
+        with self.assertNumQueries(0):
+            choices = list(SimilarityFilterForm().fields['degree'].choices)
+        assert ("Master's degree", "Master's degree") in choices
+
+        # ...and a request only builds it once.
+        built = []
+        original = SimilarityFilterForm.__init__
+
+        def init(form, *args, **kwargs):
+            built.append(form)
+            original(form, *args, **kwargs)
+
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        with patch.object(SimilarityFilterForm, '__init__', init):
+            response = self.client.get(url, {'department': 275})
+        assert len(built) == 1
+        assert response.context['filter_form'] is built[0]
+
+    def test_cached_page(self):
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        assert second.content == first.content
+
+        # Changing the metadata shown on the page invalidates it.
+        similar = Thesis.objects.get(pk=60330)
+        similar.title = 'A brand new title'
+        similar.save()
+        response = self.client.get(url)
+        assert 'A brand new title' in response.content.decode('utf-8')
+
+    def test_page_cache_keys(self):
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        first = self.client.get(url)
+        # Made-up parameters don't make new pages.
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'utm_source': 'anything'})
+        assert response.content == first.content
+        assert response['Content-Type'] == first['Content-Type']
+
+        # Filters do, once they're valid.
+        self.client.get(url, {'department': 275, 'junk': 1})
+        with self.assertNumQueries(1):
+            # Checking the department takes one.
+            self.client.get(url, {'department': 275})
+        self.client.get(url, {'year_from': 'soon'})
+        response = self.client.get(url, {'year_from': 'soon'})
+        assert 'filter_form' in response.context
+
+    def test_cached_pages_keep_headers(self):
+        class HeaderView(CachedPageMixin, View):
+            def get(self, request):
+                response = HttpResponse('hello')
+                response['Vary'] = 'Accept-Language'
+                return response
+
+        view = HeaderView.as_view()
+        view(RequestFactory().get('/somewhere/'))
+        with patch.object(HeaderView, 'get') as get:
+            response = view(RequestFactory().get('/somewhere/'))
+        assert not get.called
+        assert response.content == b'hello'
+        assert response['Vary'] == 'Accept-Language'
+
+    def test_conditional_requests(self):
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        response = self.client.get(url)
+        etag = response['ETag']
+        assert response['Last-Modified']
+
+        # No queries, and no similarity search either.
+        with self.assertNumQueries(0), \
+                patch('hamlet.neural.index.SimilarityIndex.most_similar') as \
+                most_similar:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert not most_similar.called
+
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        assert response.status_code == 304
+
+        # Filtered pages are different pages.
+        response = self.client.get(url, {'department': 275},
+                                   HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+
+        Thesis.objects.get(pk=60330).save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_validators_follow_the_theses_shown(self):
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        get_partitions()
+        etag = self.client.get(url)['ETag']
+
+        # A thesis the page doesn't show...
+        unrelated = Thesis.objects.get(pk=32600)
+        unrelated.title = 'A brand new title'
+        unrelated.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+        # ...or one of its suggestions' authors.
+        Person.objects.get(pk=63970).save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+
+    def test_batched_revisions(self):
+        url = reverse('theses:similar_to', kwargs={'identifier': 111908})
+        etag = self.client.get(url)['ETag']
+        key = thesis_revision(66473)
+        revision = get_page_cache().get(key)
+
+        with batched_revisions(), self.assertNumQueries(2):
+            # Just the save; nothing is looked up for the revisions.
+            Contribution.objects.filter(thesis=60330).first().save()
+            assert get_page_cache().get(key) == revision
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == 304
+
+        # Everything is invalidated at the end.
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+
+    def test_fragments_shared_with_author_pages(self):
+        self.client.get(reverse('theses:similar_to_by_author',
+                                kwargs={'pk': 63970}))
+        # The suggestions for the author's thesis are already rendered, so
+        # they aren't fetched again.
+        get_partitions()
+        url = reverse('theses:similar_to', kwargs={'identifier': 66473})
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        assert 'Ultra low power' in response.content.decode('utf-8')
+
     def test_get_correct_object(self):
         # We use the thesis identifier in the URL to aid in URL hacking -
         # make sure we are getting the Thesis object by identifier and not by
@@ -91,6 +289,12 @@ class SimilarToByAuthorViewTests(BaseTestCase):
 
         assert 'Ultra low power, high sensitivity secure wake-up receiver for the Internet of Things' in content  # noqa
 
+    def test_conditional_requests(self):
+        url = reverse('theses:similar_to_by_author', kwargs={'pk': 63970})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
     def test_get_theses(self):
         url = reverse('theses:similar_to_by_author', kwargs={'pk': 63970})
         request = RequestFactory().get(url)
@@ -101,6 +305,40 @@ class SimilarToByAuthorViewTests(BaseTestCase):
         assert [60330] == pks
 
 
+class NearbyPeopleViewTests(BaseTestCase):
+    def test_ranks_people_and_departments(self):
+        url = reverse('theses:nearby_people', kwargs={'identifier': 111908})
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert ([person.pk for person, _ in response.context['advisors']] ==
+                [29903])
+        assert ([dept.pk for dept, _ in response.context['departments']] ==
+                [275])
+
+    def test_own_authors_left_out(self):
+        url = reverse('theses:nearby_people', kwargs={'identifier': 66473})
+        response = self.client.get(url)
+        assert response.context['authors'] == []
+
+    def test_unextractable(self):
+        url = reverse('theses:nearby_people', kwargs={'identifier': 17134})
+        response = self.client.get(url)
+        assert response.context['unextractable'] is True
+
+    def test_upload(self):
+        url = reverse('theses:upload_people')
+        path = os.path.join(settings.BASE_DIR, 'hamlet/theses/fixtures',
+                            '1721.1-33360.txt')
+        with open(path, 'rb') as fp:
+            response = self.client.post(url,
+                {"file": fp, "captcha_0": "sometext", "captcha_1": "PASSED"})
+        assert response.status_code == 200
+        assert ([dept.pk for dept, _ in response.context['departments']] ==
+                [275])
+        assert ([person.pk for person, _ in response.context['advisors']] ==
+                [29903])
+
+
 class SimilarToSearchViewTests(BaseTestCase):
     def test_author_post_returns_author_view(self):
         response = self.client.post(reverse('theses:similar_to'),
@@ -134,6 +372,11 @@ class SimilarToSearchViewTests(BaseTestCase):
 
 
 class AutocompleteAuthorViewTests(BaseTestCase):
+    def setUp(self):
+        super(AutocompleteAuthorViewTests, self).setUp()
+        # The index outlives the test database.
+        reset_ngrams()
+
     def test_base_queryset_is_all_authors(self):
         url = reverse('theses:autocomplete_author')
         request = RequestFactory().get(url)
@@ -187,6 +430,11 @@ class AutocompleteAuthorViewTests(BaseTestCase):
 
 
 class AutocompleteThesisViewTests(BaseTestCase):
+    def setUp(self):
+        super(AutocompleteThesisViewTests, self).setUp()
+        # The index outlives the test database.
+        reset_ngrams()
+
     def test_base_queryset_is_all_extractable_theses(self):
         url = reverse('theses:autocomplete_thesis')
         request = RequestFactory().get(url)
@@ -236,6 +484,16 @@ class AutocompleteThesisViewTests(BaseTestCase):
         assert not view_theses
         assert not db_theses
 
+    def test_ranked_without_queries(self):
+        url = reverse('theses:autocomplete_thesis')
+        self.client.get(url, {'q': 'power'})
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': 'ULTRA'})
+        results = json.loads(response.content.decode('utf-8'))['results']
+        # The title starting with the query comes first.
+        assert [result['id'] for result in results] == ['76265', '60330']
+        assert results[0]['text'] == Thesis.objects.get(pk=76265).title
+
 
 class UploadRecommendationViewTests(BaseTestCase):
     fix_path = os.path.join(settings.BASE_DIR, 'hamlet/theses/fixtures')
@@ -255,3 +513,186 @@ class UploadRecommendationViewTests(BaseTestCase):
                 {"file": fp, "captcha_0": "sometext", "captcha_1": "PASSED"})
         assert "Clock division as a power saving strategy" in \
             response.content.decode('utf-8')
+
+    def test_repeat_upload_skips_inference(self):
+        caches[settings.HAMLET_INFERENCE_CACHE].clear()
+        url = reverse('theses:upload_recommend')
+        path = os.path.join(self.fix_path, '1721.1-33360.txt')
+        with open(path, 'rb') as fp:
+            first = self.client.post(url,
+                {"file": fp, "captcha_0": "sometext", "captcha_1": "PASSED"})
+
+        with patch.object(get_model(), 'infer_vector',
+                          side_effect=AssertionError):
+            with open(path, 'rb') as fp:
+                second = self.client.post(url,
+                    {"file": fp, "captcha_0": "sometext",
+                     "captcha_1": "PASSED"})
+
+        assert (set(first.context['suggestions']) ==
+                set(second.context['suggestions']))
+
+
+@override_settings(HAMLET_ASYNC_UPLOADS=True)
+class AsyncUploadTests(BaseTestCase):
+    fix_path = os.path.join(settings.BASE_DIR, 'hamlet/theses/fixtures')
+
+    def upload(self):
+        url = reverse('theses:upload_recommend')
+        with open(os.path.join(self.fix_path, '1721.1-33360.txt'), 'rb') as fp:
+            return self.client.post(url,
+                {"file": fp, "captcha_0": "sometext", "captcha_1": "PASSED"})
+
+    def test_upload_redirects_to_result(self):
+        response = self.upload()
+        assert response.status_code == 302
+        job_id = response.url.rstrip('/').split('/')[-1]
+
+        status_url = reverse('job_status', kwargs={'job_id': job_id})
+        for _ in range(100):
+            status = self.client.get(status_url).json()['status']
+            if status != jobs.PENDING:
+                break
+            time.sleep(0.1)
+        assert status == jobs.DONE
+
+        response = self.client.get(response.url)
+        assert "Clock division as a power saving strategy" in \
+            response.content.decode('utf-8')
+
+    def test_pending_page(self):
+        with patch.object(jobs, 'get_job',
+                          return_value={'status': jobs.PENDING}):
+            response = self.client.get(reverse('theses:upload_recommend',
+                kwargs={'job_id': '2c7f3a3e-8fd4-4a5e-9a8e-0a5c4e0b7b0d'}))
+        assert response.status_code == 200
+        assert 'upload_pending.html' in [t.name for t in response.templates]
+
+    def test_unknown_job(self):
+        job_id = '2c7f3a3e-8fd4-4a5e-9a8e-0a5c4e0b7b0d'
+        response = self.client.get(
+            reverse('theses:upload_recommend', kwargs={'job_id': job_id}))
+        assert response.status_code == 404
+        response = self.client.get(
+            reverse('job_status', kwargs={'job_id': job_id}))
+        assert response.status_code == 404
+
+    def test_jobs_close_their_connections(self):
+        with patch.object(jobs, 'connection') as connection, \
+                patch.object(jobs, '_queued', 2), \
+                self.assertLogs('hamlet.common.jobs', 'ERROR'):
+            jobs._run('job', lambda: None, ())
+            jobs._run('job', lambda: 1 / 0, ())
+        assert connection.close.call_count == 2
+
+    @override_settings(HAMLET_UPLOAD_QUEUE_SIZE=0)
+    def test_full_queue_asks_user_to_retry(self):
+        response = self.upload()
+        assert response.status_code == 503
+        assert 'Retry-After' in response
+
+
+class SimilarityAPIViewTests(BaseTestCase):
+    url = reverse('theses:similarity_api')
+
+    def test_returns_ranked_neighbours(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                self.url, {'identifiers': '111908,1', 'topn': 10})
+        assert response.status_code == 200
+        results = response.json()['results']
+
+        assert [r['identifier'] for r in results] == [111908, 1]
+        assert results[0]['found']
+        assert not results[1]['found']
+
+        neighbours = results[0]['neighbours']
+        assert 66473 in [n['identifier'] for n in neighbours]
+        scores = [n['score'] for n in neighbours]
+        assert scores == sorted(scores, reverse=True)
+
+    def test_large_batches_are_streamed(self):
+        identifiers = [111908, 66473] + list(range(1, 100))
+        response = self.client.get(
+            self.url, {'identifiers': ','.join(map(str, identifiers))})
+        assert response.streaming
+        data = json.loads(b''.join(response.streaming_content).decode())
+        assert [r['identifier'] for r in data['results']] == identifiers
+        assert data['results'][0]['found']
+
+    def test_conditional_requests(self):
+        params = {'identifiers': '111908'}
+        etag = self.client.get(self.url, params)['ETag']
+        # Answered without searching or querying.
+        with self.assertNumQueries(0), \
+                patch('hamlet.neural.index.SimilarityIndex.'
+                      'most_similar_batch') as most_similar_batch:
+            response = self.client.get(self.url, params,
+                                       HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert not most_similar_batch.called
+
+        # The neighbours' titles and years might have changed.
+        thesis = Thesis.objects.get(pk=60330)
+        thesis.title = 'Ultra low power, revisited'
+        thesis.save()
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['Last-Modified']
+        etag = response['ETag']
+
+        # The neighbours' URLs are on the host we were asked for.
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_HOST='127.0.0.1')
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+        assert 'Host' in response['Vary']
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag,
+                                   secure=True)
+        assert response.status_code == 200
+
+    def test_bad_requests(self):
+        for params in ({}, {'identifiers': 'abc'},
+                       {'identifiers': '111908', 'topn': 0},
+                       {'identifiers': ','.join(map(str, range(1000)))}):
+            response = self.client.get(self.url, params)
+            assert response.status_code == 400
+
+
+class TimingTests(BaseTestCase):
+    def test_server_timing_header(self):
+        thesis = Thesis.objects.get(pk=76265)
+        response = self.client.get(thesis.get_absolute_url())
+        timing = response['Server-Timing']
+        assert 'similarity;dur=' in timing
+        assert 'sql;dur=' in timing
+        assert 'total;dur=' in timing
+        assert re.search(r'queries;desc="\d+ SQL queries"', timing)
+
+    def test_metrics(self):
+        thesis = Thesis.objects.get(pk=76265)
+        self.client.get(thesis.get_absolute_url())
+
+        response = self.client.get(reverse('metrics'))
+        assert response.status_code == 200
+        content = response.content.decode('utf-8')
+        assert re.search(r'hamlet_requests_total\{pid="\d+",'
+                         r'view="theses:similar_to"\} \d+', content)
+        assert 'hamlet_timer_seconds_total{pid=' in content
+
+    def test_metrics_are_private(self):
+        url = reverse('metrics')
+        outside = {'REMOTE_ADDR': '18.9.22.69'}
+        assert self.client.get(url, **outside).status_code == 404
+
+        with self.settings(HAMLET_METRICS_TOKEN='s3cret'):
+            assert self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer guess',
+                **outside).status_code == 404
+            assert self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer s3cret',
+                **outside).status_code == 200
+
+        with self.settings(HAMLET_METRICS_ALLOWED_IPS=['18.9.22.69']):
+            assert self.client.get(url, **outside).status_code == 200
+            assert self.client.get(url).status_code == 404
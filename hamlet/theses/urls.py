@@ -9,12 +9,22 @@ urlpatterns = [
         views.SimilarToSearchView.as_view(), name='similar_to'),
     path('similar_to/<int:identifier>/',
         views.SimilarToView.as_view(), name='similar_to'),
+    path('similar_to/<int:identifier>/people/',
+        views.NearbyPeopleView.as_view(), name='nearby_people'),
     path('similar_to/author/<int:pk>/',
         views.SimilarToByAuthorView.as_view(), name='similar_to_by_author'),
+    path('api/similar/',
+        views.SimilarityAPIView.as_view(), name='similarity_api'),
     path('autocomplete/author/',
         views.AutocompleteAuthorView.as_view(), name='autocomplete_author'),
     path('autocomplete/thesis/',
         views.AutocompleteThesisView.as_view(), name='autocomplete_thesis'),
     path('upload/recommend/',
         views.UploadRecommendationView.as_view(), name='upload_recommend'),
+    path('upload/recommend/<uuid:job_id>/',
+        views.UploadRecommendationView.as_view(), name='upload_recommend'),
+    path('upload/people/',
+        views.UploadNearbyPeopleView.as_view(), name='upload_people'),
+    path('upload/people/<uuid:job_id>/',
+        views.UploadNearbyPeopleView.as_view(), name='upload_people'),
 ]
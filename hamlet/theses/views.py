@@ -1,46 +1,126 @@
+import hashlib
+import json
+
 from dal import autocomplete
 
 from django.contrib import messages
-from django.http import Http404, HttpResponseRedirect
+from django.http import (Http404, HttpResponseRedirect, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views import View
 from django.views.generic import TemplateView
 from django.views.generic.detail import DetailView
-from django.views.generic.edit import FormView
 
-from hamlet.common.document import factory
-from hamlet.common.forms import UploadFileForm
-from hamlet.common.inferred_vectors import get_similar_documents
+from hamlet.common.forms import DocumentUploadForm, SimilarityFilterForm
+from hamlet.common.page_cache import (CONTRIBUTIONS_REVISION,
+                                      DEGREES_REVISION, FILTERS_REVISION,
+                                      CachedPageMixin, page_last_modified,
+                                      page_version, person_revision,
+                                      thesis_revision)
+from hamlet.common.views import UploadView
+from hamlet.neural.index import NEIGHBOUR_COUNT, get_index
 
+from . import centroids
 from .forms import TitleAutocompleteForm, AuthorAutocompleteForm
 from .models import Thesis, Person, Contribution
+from .ngrams import matching_authors, matching_theses
+
 
+class ThesisByIdentifierMixin(object):
+    def get_object(self, queryset=None):
+        identifier = self.kwargs.get('identifier', None)
 
-class SimilarToView(DetailView):
+        try:
+            return Thesis.objects.with_metadata().get(identifier=identifier)
+        except Thesis.DoesNotExist:
+            raise Http404('No matching thesis was found')
+
+
+class SimilarToView(CachedPageMixin, ThesisByIdentifierMixin, DetailView):
     """Given a Thesis, shows the most similar Theses."""
     template_name = 'theses/similar_to.html'
+    filter_form = None
+
+    def get_filter_form(self):
+        """The filters for this request's suggestions, built (and checked)
+        once however often they're needed."""
+        if self.filter_form is None:
+            self.filter_form = SimilarityFilterForm(self.request.GET or None)
+        return self.filter_form
+
+    def get_page_params(self, request):
+        # Only the filters matter, and only once they've been checked, so
+        # that nobody can fill the page cache by making up query strings.
+        if not any(field in request.GET
+                   for field in SimilarityFilterForm.base_fields):
+            return []
+        form = self.get_filter_form()
+        if not form.is_valid():
+            # The page shows the errors, which aren't worth caching.
+            return None
+        return [(field, getattr(value, 'pk', value))
+                for field, value in form.cleaned_data.items()
+                if value not in (None, '')]
 
     def get_context_data(self, **kwargs):
         context = super(SimilarToView, self).get_context_data(**kwargs)
 
-        thesis = self.get_object()
+        thesis = self.object
         if thesis.unextractable:
             context['unextractable'] = True
         else:
-            context['suggestions'] = thesis.get_most_similar(topn=10)
+            # Optionally only suggest theses from a given department, range
+            # of years or degree.
+            form = self.get_filter_form()
+            subset = form.get_subset() if form.is_valid() else None
+            context['filter_form'] = form
+            context['suggestions'] = thesis.get_most_similar(topn=10,
+                                                             subset=subset)
 
         return context
 
-    def get_object(self, queryset=None):
-        identifier = self.kwargs.get('identifier', None)
+    def get_page_revisions(self, context):
+        keys = [thesis_revision(self.object.identifier)]
+        if 'suggestions' in context:
+            keys.extend(thesis_revision(identifier) for identifier in
+                        context['suggestions'].identifiers)
+        if 'filter_form' in context:
+            keys.append(DEGREES_REVISION)
+            if self.get_page_params(self.request):
+                # Which theses the filters allow depends on everyone's
+                # metadata.
+                keys.append(FILTERS_REVISION)
+        return keys
+
+
+class NearbyPeopleView(ThesisByIdentifierMixin, DetailView):
+    """Given a Thesis, shows the advisors, authors and departments whose
+    theses are, on average, most like it."""
+    template_name = 'theses/nearby_people.html'
 
-        try:
-            return Thesis.objects.get(identifier=identifier)
-        except Thesis.DoesNotExist:
-            raise Http404('No matching thesis was found')
+    def get_context_data(self, **kwargs):
+        context = super(NearbyPeopleView, self).get_context_data(**kwargs)
 
+        thesis = self.object
+        vector = centroids.thesis_vector(thesis)
+        if vector is None:
+            context['unextractable'] = True
+            return context
+
+        # Its own authors are bound to be near it.
+        authors = {person.pk for person in thesis.authors}
+        context['advisors'] = centroids.rank(centroids.ADVISORS, vector)
+        context['authors'] = centroids.rank(centroids.AUTHORS, vector,
+                                            exclude=authors)
+        context['departments'] = centroids.rank(centroids.DEPARTMENTS,
+                                                vector, topn=5)
+        return context
 
-class SimilarToByAuthorView(DetailView):
+
+class SimilarToByAuthorView(CachedPageMixin, DetailView):
     """Given an author, shows the most similar theses to all of their works."""
     template_name = 'theses/similar_to_by_authors.html'
     model = Person
@@ -49,7 +129,12 @@ class SimilarToByAuthorView(DetailView):
         context = super(SimilarToByAuthorView, self).get_context_data(**kwargs)
         context['theses'] = []
 
-        theses = self.get_theses()
+        theses = list(self.get_theses())
+        # Look up suggestions for all of the author's theses together, rather
+        # than searching and querying once per thesis.
+        suggestions = Thesis.get_most_similar_for(
+            [thesis for thesis in theses if not thesis.unextractable],
+            topn=10)
         for thesis in theses:
             if thesis.unextractable:
                 context['theses'].append({
@@ -59,11 +144,32 @@ class SimilarToByAuthorView(DetailView):
             else:
                 context['theses'].append({
                     'object': thesis,
-                    'suggestions': thesis.get_most_similar(topn=10)
+                    'suggestions': suggestions[thesis.pk]
                 })
 
+        # Authors whose work, taken as a whole, is most like this author's.
+        vector = centroids.get_centroids(centroids.AUTHORS).vector(
+            self.object.pk)
+        if vector is not None:
+            context['similar_authors'] = centroids.rank(
+                centroids.AUTHORS, vector, exclude={self.object.pk})
+
         return context
 
+    def get_page_revisions(self, context):
+        keys = [person_revision(self.object.pk)]
+        for thesis in context['theses']:
+            keys.append(thesis_revision(thesis['object'].identifier))
+            if 'suggestions' in thesis:
+                keys.extend(thesis_revision(identifier) for identifier in
+                            thesis['suggestions'].identifiers)
+        if 'similar_authors' in context:
+            # Which authors are similar can depend on everyone's theses.
+            keys.append(CONTRIBUTIONS_REVISION)
+            keys.extend(person_revision(author.pk) for author, _ in
+                        context['similar_authors'])
+        return keys
+
     def get_theses(self):
         contribs = Contribution.objects.filter(
             person=self.get_object(), role=Contribution.AUTHOR)
@@ -109,32 +215,163 @@ class SimilarToSearchView(TemplateView):
 class AutocompleteAuthorView(autocomplete.Select2QuerySetView):
     """enter a thesis so that the SimilarToView can find it"""
     def get_queryset(self):
-        qs = Person.objects.filter(
-            contribution__role=Contribution.AUTHOR).distinct()
-
-        if self.q:
-            qs = qs.filter(name__icontains=self.q)
-
-        return qs
+        # Not a queryset: see hamlet.theses.ngrams.
+        return matching_authors(self.q)
 
 
 class AutocompleteThesisView(autocomplete.Select2QuerySetView):
     """enter a thesis so that the SimilarToView can find it"""
     def get_queryset(self):
-        qs = Thesis.objects.filter(unextractable=False).distinct()
-
-        if self.q:
-            qs = qs.filter(title__icontains=self.q)
+        return matching_theses(self.q)
 
-        return qs
 
-
-class UploadRecommendationView(FormView):
+class UploadRecommendationView(UploadView):
     template_name = 'theses/upload_recommend.html'
-    form_class = UploadFileForm
-
-    def form_valid(self, form):
-        context = {}
-        doc = factory(self.request.FILES['file'])
-        context['suggestions'] = get_similar_documents(doc)
-        return render(self.request, 'theses/similar_to.html', context)
+    result_url_name = 'theses:upload_recommend'
+
+
+class UploadNearbyPeopleView(UploadView):
+    """Shows the advisors, authors and departments whose theses are most
+    like an uploaded document."""
+    template_name = 'theses/upload_people.html'
+    result_url_name = 'theses:upload_people'
+    form_class = DocumentUploadForm
+    search = staticmethod(centroids.rank_for_upload)
+
+    def render_result(self, result):
+        context = {
+            'advisors': centroids.with_objects(
+                centroids.ADVISORS, result[centroids.ADVISORS]),
+            'authors': centroids.with_objects(
+                centroids.AUTHORS, result[centroids.AUTHORS]),
+            'departments': centroids.with_objects(
+                centroids.DEPARTMENTS, result[centroids.DEPARTMENTS][:5]),
+        }
+        return render(self.request, 'theses/nearby_people.html', context)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _similarity_api_params(request):
+    """Return (identifiers, topn, threshold) for a SimilarityAPIView request,
+    raising BadRequest if they don't make sense."""
+    raw = ','.join(request.GET.getlist('identifiers'))
+    try:
+        identifiers = [int(x) for x in raw.split(',') if x.strip()]
+        topn = int(request.GET.get('topn', 10))
+        threshold = float(request.GET.get('threshold', 0))
+    except ValueError:
+        raise BadRequest('identifiers and topn must be integers, and '
+                         'threshold a number')
+
+    if not identifiers:
+        raise BadRequest('Please give some identifiers')
+    if len(identifiers) > SimilarityAPIView.max_identifiers:
+        raise BadRequest('Please ask for at most {} identifiers at a '
+                         'time'.format(SimilarityAPIView.max_identifiers))
+    if not 0 < topn <= NEIGHBOUR_COUNT:
+        raise BadRequest('topn must be between 1 and {}'.format(
+            NEIGHBOUR_COUNT))
+
+    # Dedupe, but keep the order we were asked in.
+    return list(dict.fromkeys(identifiers)), topn, threshold
+
+
+class SimilarityAPIView(View):
+    """Nearest neighbours, with scores, for a batch of theses, as JSON.
+
+    GET ?identifiers=111908,66473&topn=10&threshold=0.5 returns
+
+        {"model": "<model fingerprint>",
+         "results": [{"identifier": 111908, "found": true,
+                      "neighbours": [{"identifier": 66473, "score": 0.82,
+                                      "title": "...", "year": 2011,
+                                      "url": "..."}, ...]},
+                     ...]}
+
+    with results in the order asked for, and neighbours most similar first.
+    Theses which aren't in the model (including unextractable ones) come back
+    with "found": false.
+
+    All the neighbours are found in one pass over the model and all their
+    metadata in one query. Large batches are streamed. Responses carry an
+    ETag and Last-Modified, so clients can make conditional requests, which
+    are answered without a search or a query when nothing has changed."""
+    max_identifiers = 500
+    # Batches bigger than this are streamed rather than built in memory.
+    stream_threshold = 50
+
+    def get(self, request, *args, **kwargs):
+        try:
+            identifiers, topn, threshold = _similarity_api_params(request)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        # Clients which have seen this answer before are told so before we
+        # search the model or query the database.
+        etag = self._etag(identifiers, topn, threshold)
+        last_modified = page_last_modified()
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self._response(identifiers, topn, threshold)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # The neighbours' URLs are absolute, so depend on the host and scheme
+        # we were asked for (which, behind a proxy, comes from
+        # X-Forwarded-Proto).
+        patch_vary_headers(response, ['Host', 'X-Forwarded-Proto'])
+        return response
+
+    def _etag(self, identifiers, topn, threshold):
+        """A hash of everything the response depends on: the question, the
+        model and the metadata (see page_version()), and the host and scheme
+        of the neighbours' URLs."""
+        key = json.dumps([
+            page_version(), self.request.scheme, self.request.get_host(),
+            identifiers, topn, threshold])
+        return '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _response(self, identifiers, topn, threshold):
+        index = get_index()
+        found = [x for x in identifiers if x in index]
+        neighbours = index.most_similar_batch(found, topn=topn)
+        for identifier, friends in neighbours.items():
+            neighbours[identifier] = [(x, score) for x, score in friends
+                                      if score > threshold]
+
+        wanted = set(x for friends in neighbours.values() for x, _ in friends)
+        metadata = {t['identifier']: t for t in Thesis.objects.filter(
+            identifier__in=wanted).values('identifier', 'title', 'year')}
+
+        fingerprint = index.fingerprint
+        results = (self._result(x, neighbours.get(x), metadata)
+                   for x in identifiers)
+
+        if len(identifiers) <= self.stream_threshold:
+            return JsonResponse({'model': fingerprint,
+                                 'results': list(results)})
+
+        return StreamingHttpResponse(self._stream(fingerprint, results),
+                                     content_type='application/json')
+
+    def _result(self, identifier, friends, metadata):
+        if friends is None:
+            return {'identifier': identifier, 'found': False,
+                    'neighbours': []}
+
+        return {'identifier': identifier, 'found': True, 'neighbours': [
+            {'identifier': x, 'score': round(score, 4),
+             'title': metadata[x]['title'], 'year': metadata[x]['year'],
+             'url': self.request.build_absolute_uri(
+                 reverse('theses:similar_to', kwargs={'identifier': x}))}
+            # The model can know about theses the database has since lost.
+            for x, score in friends if x in metadata]}
+
+    def _stream(self, fingerprint, results):
+        yield '{{"model": {}, "results": ['.format(json.dumps(fingerprint))
+        for i, result in enumerate(results):
+            yield (',' if i else '') + json.dumps(result)
+        yield ']}'
@@ -17,6 +17,9 @@ from django.urls import include, path
 from django.contrib import admin
 from django.views.generic import TemplateView
 
+from hamlet.common.metrics import metrics_view
+from hamlet.common.views import JobStatusView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', TemplateView.as_view(template_name='home.html'), name='home'),
@@ -28,7 +31,9 @@ urlpatterns = [
     path(r'', include('hamlet.theses.urls')),
     path(r'citations/', include('hamlet.citations.urls')),
     path('captcha/', include('captcha.urls')),
+    path('jobs/<uuid:job_id>/', JobStatusView.as_view(), name='job_status'),
     path('health/', include('health_check.urls')),
+    path('metrics/', metrics_view, name='metrics'),
     path(
         'robots.txt',
         TemplateView.as_view(template_name='robots.txt', content_type='text/plain'),